@@ -0,0 +1,327 @@
+"""
+Drives the bot's event handlers, commands and stores against an
+in-process fake of Discord and reports throughput and latency.
+
+Usage: python -m benchmarks.bot_throughput [--store sqlite|json] [--no-cache]
+    [--events 500] [--concurrency 50] [--latency 0.02] [--rate-limit 5/1]
+    [--history 200] [--reconcile] [--log-flush-interval 1.0] [--guilds 1]
+    [--pool-size 0] [--create-latency 0.2] [--html-workers 0]
+    [--scenario NAME ...]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import Counter
+from typing import Awaitable, Callable, List
+
+from benchmarks.fakes import (
+    FakeBot,
+    FakeContext,
+    FakeHTTP,
+    FakeMessage,
+    FakePayload,
+    FakeUser,
+)
+from bot import Bot
+from utils import (
+    LogDispatcher,
+    MessageCapture,
+    Ticket,
+    TicketChannels,
+    TicketQueue,
+    TranscriptArchive,
+    TranscriptRenderer,
+)
+from utils.db import CachedStore, JsonStore, SqliteStore
+
+
+class CountingStore:
+    """Passes everything through to a store, counting each call."""
+
+    def __init__(self, store):
+        self.store = store
+        self.calls = Counter()
+
+    @property
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+    def __getattr__(self, name):
+        attr = getattr(self.store, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            self.calls[name] += 1
+            return attr(*args, **kwargs)
+
+        return wrapper
+
+
+class Environment:
+    """Fresh fake guilds, store and bot for one scenario.
+
+    Call ``setup`` before use.
+    """
+
+    def __init__(self, args, directory: str):
+        self.args = args
+        self.directory = directory
+
+        if args.store == "sqlite":
+            store = SqliteStore(storage_path="/")
+            store.db = os.path.join(directory, "storage.db")
+        else:
+            store = JsonStore(storage_path="/")
+            store.cwd = directory
+
+        # Counted beneath the cache, so only real storage work shows up
+        self.counter = CountingStore(store)
+        self.db = self.counter if args.no_cache else CachedStore(self.counter)
+
+        rate_limits = {}
+        if args.rate_limit:
+            requests, per = args.rate_limit.split("/")
+            rate_limits = {
+                route: (int(requests), float(per))
+                for route in (
+                    "POST /guilds/{guild_id}/channels",
+                    "PUT /channels/{channel_id}/messages/{message_id}/reactions",
+                )
+            }
+
+        route_latency = {}
+        if args.create_latency is not None:
+            route_latency["POST /guilds/{guild_id}/channels"] = args.create_latency
+
+        self.http = FakeHTTP(
+            latency=args.latency, rate_limits=rate_limits, route_latency=route_latency
+        )
+        self.bot = FakeBot(self.http, self.db, guilds=args.guilds)
+        self.bot.ticket_queue = TicketQueue(self.db, workers=args.workers)
+        self.bot.ticket_channels = TicketChannels(pool_size=args.pool_size)
+        self.bot.message_capture = MessageCapture(self.db)
+        self.bot.log_dispatcher = LogDispatcher(flush_interval=args.log_flush_interval)
+        self.bot.log_dispatcher.start()
+        self.bot.reconcile_transcripts = args.reconcile
+        self.bot.transcript_archive = TranscriptArchive(os.path.join(directory, "archive"))
+        self.bot.transcript_renderer = TranscriptRenderer(workers=args.html_workers)
+
+    async def setup(self):
+        await self.bot.configure()
+        # Filled up front, as the bot does when it connects
+        await asyncio.gather(
+            *(self.bot.ticket_channels.fill(guild.category) for guild in self.bot.guilds)
+        )
+
+    def ticket(self, author: FakeUser, channel=None, guild=None) -> Ticket:
+        return Ticket(FakeContext(self.bot, author, channel, guild), self.db)
+
+    def random_guild(self):
+        return random.choice(self.bot.guilds)
+
+    async def open_tickets(self, count: int, history: int = 0):
+        """Create tickets outside of any measurement."""
+        tickets = []
+        for _ in range(count):
+            author = FakeUser()
+            guild = self.random_guild()
+            guild.members[author.id] = author
+            await self.ticket(author, guild=guild).create_ticket(subject="Benchmark")
+
+            # Not the last channel made, with a pool that is its replacement
+            channel = guild.get_channel(await self.db.get_user_ticket(guild.id, author.id))
+            # Seeded directly, there is no need to pay for sending these
+            messages = [
+                FakeMessage(self.http, channel, f"Message {i}", author=author)
+                for i in range(history)
+            ]
+            channel.messages.extend(messages)
+            for message in messages:
+                await self.bot.message_capture.on_message(message)
+            tickets.append((author, channel))
+
+        return tickets
+
+    async def close(self):
+        await self.bot.ticket_queue.close()
+        await self.bot.ticket_channels.close()
+        await self.bot.message_capture.close()
+        await self.bot.log_dispatcher.close()
+        await self.db.close()
+        await self.bot.transcript_archive.close()
+        await self.bot.transcript_renderer.close()
+
+
+async def measure(env: Environment, events: List[Callable[[], Awaitable]], concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def run(event):
+        async with semaphore:
+            start = time.perf_counter()
+            await event()
+            timings.append(time.perf_counter() - start)
+
+    requests, db_calls, limited = env.http.requests, env.counter.total, env.http.rate_limited
+    start = time.perf_counter()
+    await asyncio.gather(*(run(event) for event in events))
+    await env.bot.ticket_queue.join()
+    # Logs are sent in the background, but still count towards the work done
+    await env.bot.log_dispatcher.flush()
+    elapsed = time.perf_counter() - start
+
+    timings.sort()
+    return {
+        "events": len(events),
+        "per_second": len(events) / elapsed,
+        "p50": statistics.median(timings) * 1000,
+        "p99": timings[max(int(len(timings) * 0.99) - 1, 0)] * 1000,
+        "db_ops": (env.counter.total - db_calls) / len(events),
+        "requests": (env.http.requests - requests) / len(events),
+        "rate_limited": env.http.rate_limited - limited,
+    }
+
+
+async def scenario_reaction_lock(env: Environment):
+    """Lock reactions on ticket welcome messages"""
+    tickets = await env.open_tickets(min(env.args.events, 200))
+    events = []
+    for _ in range(env.args.events):
+        author, channel = random.choice(tickets)
+        payload = FakePayload(channel.guild, channel, channel.messages[0].id, author, "🔒")
+        events.append(lambda payload=payload: Bot.on_raw_reaction_add(env.bot, payload))
+
+    return events
+
+
+async def scenario_reaction_ignored(env: Environment):
+    """Reactions in channels that are not tickets"""
+    channels = [guild.add_channel("general") for guild in env.bot.guilds]
+    events = []
+    for _ in range(env.args.events):
+        channel = random.choice(channels)
+        payload = FakePayload(
+            channel.guild, channel, random.randrange(1 << 60), FakeUser(), "✅"
+        )
+        events.append(lambda payload=payload: Bot.on_raw_reaction_add(env.bot, payload))
+
+    return events
+
+
+async def scenario_reaction_create(env: Environment):
+    """Ticks on the setup message, creating tickets through the queue"""
+    await asyncio.gather(
+        *(
+            env.ticket(FakeUser(), guild.new_ticket_channel).setup_new_ticket_message()
+            for guild in env.bot.guilds
+        )
+    )
+    setup_message_ids = {
+        guild.id: await env.db.get_ticket_setup_message_id(guild.id)
+        for guild in env.bot.guilds
+    }
+
+    events = []
+    for _ in range(env.args.events):
+        guild = env.random_guild()
+        payload = FakePayload(
+            guild, guild.new_ticket_channel, setup_message_ids[guild.id], FakeUser(), "✅"
+        )
+        events.append(lambda payload=payload: Bot.on_raw_reaction_add(env.bot, payload))
+
+    return events
+
+
+async def scenario_command_new(env: Environment):
+    """The new command"""
+    return [
+        lambda guild=env.random_guild(): env.ticket(FakeUser(), guild=guild).create_ticket(
+            subject="Benchmark"
+        )
+        for _ in range(env.args.events)
+    ]
+
+
+async def scenario_command_close(env: Environment):
+    """The close command, on tickets with --history messages"""
+    tickets = await env.open_tickets(min(env.args.events, 100), env.args.history)
+    return [
+        lambda author=author, channel=channel: env.ticket(author, channel).close_ticket(
+            reason="Benchmark"
+        )
+        for author, channel in tickets
+    ]
+
+
+SCENARIOS = {
+    "reaction-lock": scenario_reaction_lock,
+    "reaction-ignored": scenario_reaction_ignored,
+    "reaction-create": scenario_reaction_create,
+    "command-new": scenario_command_new,
+    "command-close": scenario_command_close,
+}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--store", choices=("sqlite", "json"), default="sqlite")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument(
+        "--rate-limit", help="requests/seconds for channel creation and reactions"
+    )
+    parser.add_argument("--history", type=int, default=200)
+    parser.add_argument("--log-flush-interval", type=float, default=1.0)
+    parser.add_argument("--guilds", type=int, default=1, help="spread events across this many")
+    parser.add_argument("--pool-size", type=int, default=0, help="pre-made channels per guild")
+    parser.add_argument(
+        "--create-latency", type=float, help="seconds to create a channel, if not --latency"
+    )
+    parser.add_argument(
+        "--reconcile", action="store_true", help="read the history on close too"
+    )
+    parser.add_argument(
+        "--html-workers", type=int, default=0, help="render HTML transcripts on close too"
+    )
+    parser.add_argument("--scenario", nargs="*", choices=SCENARIOS, default=list(SCENARIOS))
+    args = parser.parse_args()
+
+    # The handlers log every event, and a full queue warns on every rejection
+    logging.getLogger().setLevel(logging.ERROR)
+
+    print(
+        f"{args.store}{'' if args.no_cache else ' + cache'}, "
+        f"{args.latency * 1000:.0f}ms per request, concurrency {args.concurrency}"
+    )
+    print(
+        f"{'scenario':<18}{'events':>8}{'events/s':>10}{'p50 ms':>9}{'p99 ms':>9}"
+        f"{'db/event':>10}{'http/event':>12}{'429s':>6}"
+    )
+    for name in args.scenario:
+        with tempfile.TemporaryDirectory() as directory:
+            env = Environment(args, directory)
+            try:
+                await env.setup()
+                events = await SCENARIOS[name](env)
+                result = await measure(env, events, args.concurrency)
+            finally:
+                await env.close()
+
+        print(
+            f"{name:<18}{result['events']:>8}{result['per_second']:>10.1f}"
+            f"{result['p50']:>9.2f}{result['p99']:>9.2f}{result['db_ops']:>10.2f}"
+            f"{result['requests']:>12.2f}{result['rate_limited']:>6}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
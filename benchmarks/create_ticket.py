@@ -0,0 +1,68 @@
+"""
+Measures end to end latency of Ticket.create_ticket against
+a fake Discord with a fixed round trip time per request.
+
+Usage: python -m benchmarks.create_ticket [--latency 0.05] [--runs 20]
+    [--create-latency 0.25] [--pool-size 0]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from benchmarks.fakes import FakeBot, FakeContext, FakeHTTP, FakeUser
+from utils import LogDispatcher, MessageCapture, Ticket, TicketChannels
+from utils.db import SqliteStore
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--create-latency", type=float, help="seconds to create a channel, if not --latency"
+    )
+    parser.add_argument("--pool-size", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = SqliteStore(storage_path="/")
+        store.db = os.path.join(directory, "storage.db")
+
+        route_latency = {}
+        if args.create_latency is not None:
+            route_latency["POST /guilds/{guild_id}/channels"] = args.create_latency
+
+        http = FakeHTTP(latency=args.latency, route_latency=route_latency)
+        bot = FakeBot(http, store)
+        bot.ticket_channels = TicketChannels(pool_size=args.pool_size)
+        bot.message_capture = MessageCapture(store)
+        bot.log_dispatcher = LogDispatcher()
+        await bot.configure()
+        await bot.ticket_channels.fill(bot.guild.category)
+        requests = http.requests
+
+        timings = []
+        for _ in range(args.runs):
+            ctx = FakeContext(bot, FakeUser())
+            start = time.perf_counter()
+            await Ticket(ctx, store).create_ticket(subject="Benchmark")
+            timings.append(time.perf_counter() - start)
+
+        await bot.ticket_channels.close()
+        await bot.message_capture.close()
+        await bot.log_dispatcher.close()
+        await store.close()
+
+    print(
+        f"create_ticket with {args.latency * 1000:.0f}ms per request: "
+        f"p50 {statistics.median(timings) * 1000:.1f}ms, "
+        f"max {max(timings) * 1000:.1f}ms, "
+        f"{(http.requests - requests) / args.runs:.1f} requests per ticket"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
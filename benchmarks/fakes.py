@@ -0,0 +1,394 @@
+"""
+In-process stand-ins for the parts of discord.py the bot touches.
+
+Every "HTTP" call goes through FakeHTTP, which sleeps for ``latency``
+seconds to simulate a round trip and enforces per route rate limits
+the way discord.py does, by waiting for the bucket to reset. Like
+Discord's, buckets are per route and major parameter, the guild or
+channel a request is for, so busy guilds don't slow down quiet ones.
+"""
+import asyncio
+import datetime
+import itertools
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from utils.db import GuildConfig
+from utils.html_transcript import TranscriptRenderer
+from utils.inactivity import InactivityScheduler
+
+_ids = itertools.count(900_000_000_000_000_000)
+
+
+def next_id() -> int:
+    return next(_ids)
+
+
+class FakeHTTP:
+    """Counts, delays and rate limits simulated requests.
+
+    Parameters
+    ----------
+    latency: float
+        Seconds each request takes
+    rate_limits: Dict[str, Tuple[int, float]]
+        Route -> (requests, per seconds), for each major parameter.
+        Routes without an entry are never rate limited.
+    global_rate_limit: Tuple[int, float]
+        (requests, per seconds) across every route, if any
+    route_latency: Dict[str, float]
+        Route -> seconds, for routes slower than ``latency``
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        rate_limits: Optional[Dict[str, Tuple[int, float]]] = None,
+        global_rate_limit: Optional[Tuple[int, float]] = None,
+        route_latency: Optional[Dict[str, float]] = None,
+    ):
+        self.latency = latency
+        self.rate_limits = rate_limits or {}
+        self.global_rate_limit = global_rate_limit
+        self.route_latency = route_latency or {}
+
+        self.requests = 0
+        self.rate_limited = 0
+        self.routes: Counter = Counter()
+        self._buckets: Dict[Tuple[str, Optional[int]], List[float]] = defaultdict(list)
+
+    async def request(self, route: str, major: int = None):
+        limit = self.rate_limits.get(route)
+        if limit is not None:
+            await self._wait_for_bucket((route, major), *limit)
+
+        if self.global_rate_limit is not None:
+            await self._wait_for_bucket(("global", None), *self.global_rate_limit)
+
+        self.requests += 1
+        self.routes[route] += 1
+        await asyncio.sleep(self.route_latency.get(route, self.latency))
+
+    async def _wait_for_bucket(self, key, requests: int, per: float):
+        bucket = self._buckets[key]
+        while True:
+            now = time.perf_counter()
+            while bucket and bucket[0] <= now - per:
+                bucket.pop(0)
+
+            if len(bucket) < requests:
+                bucket.append(now)
+                return
+
+            self.rate_limited += 1
+            await asyncio.sleep(bucket[0] + per - now)
+
+
+class FakeUser:
+    def __init__(self, name: str = "User", *, bot: bool = False):
+        self.id = next_id()
+        self.name = name
+        self.display_name = name
+        self.mention = f"<@{self.id}>"
+        self.avatar_url = ""
+        self.bot = bot
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeRole:
+    def __init__(self, role_id: int = None):
+        self.id = role_id or next_id()
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeEmoji:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+    def __init__(self, http: FakeHTTP, channel, content=None, embed=None, author=None):
+        self.http = http
+        self.id = next_id()
+        self.channel = channel
+        self.content = content or ""
+        self.embeds = [embed] if embed else []
+        self.attachments = []
+        self.author = author
+        self.created_at = datetime.datetime.utcnow()
+        self.edited_at = None
+
+    @property
+    def guild(self):
+        return self.channel.guild if self.channel is not None else None
+
+    async def add_reaction(self, emoji):
+        await self.http.request(
+            "PUT /channels/{channel_id}/messages/{message_id}/reactions", self.channel.id
+        )
+
+    async def remove_reaction(self, emoji, member):
+        await self.http.request(
+            "DELETE /channels/{channel_id}/messages/{message_id}/reactions", self.channel.id
+        )
+
+
+class FakeHTTPException(Exception):
+    """Stands in for discord.HTTPException, which needs a real response"""
+
+
+class FakeChannel:
+    def __init__(
+        self,
+        http: FakeHTTP,
+        name: str = "channel",
+        channel_id: int = None,
+        guild=None,
+        category=None,
+        overwrites=None,
+    ):
+        self.http = http
+        self.id = channel_id or next_id()
+        self.name = name
+        self.mention = f"<#{self.id}>"
+        self.guild = guild
+        self.category_id = category.id if category is not None else None
+        self.overwrites = overwrites or {}
+        self.messages: List[FakeMessage] = []
+
+    @property
+    def last_message_id(self) -> Optional[int]:
+        return self.messages[-1].id if self.messages else None
+
+    async def send(self, content=None, *, embed=None, embeds=None, file=None, files=None):
+        await self.http.request("POST /channels/{channel_id}/messages", self.id)
+        author = self.guild.me if self.guild is not None else None
+        message = FakeMessage(self.http, self, content, embed, author)
+        if embeds:
+            message.embeds = list(embeds)
+        self.messages.append(message)
+        return message
+
+    def get_partial_message(self, message_id):
+        message = FakeMessage(self.http, self)
+        message.id = message_id
+        return message
+
+    def history(self, *, limit=None, oldest_first=False, page_size: int = 100):
+        async def iterator():
+            messages = self.messages if oldest_first else self.messages[::-1]
+            for index, message in enumerate(messages[:limit]):
+                if index % page_size == 0:
+                    await self.http.request("GET /channels/{channel_id}/messages", self.id)
+                yield message
+
+        return iterator()
+
+    async def set_permissions(self, target, **permissions):
+        await self.http.request(
+            "PUT /channels/{channel_id}/permissions/{overwrite_id}", self.id
+        )
+
+    async def edit(self, *, name=None, overwrites=None, category=None):
+        await self.http.request("PATCH /channels/{channel_id}", self.id)
+        if self.guild is None or self.guild.get_channel(self.id) is None:
+            raise FakeHTTPException("404 Not Found (error code: 10003): Unknown Channel")
+
+        if name is not None:
+            self.name = name
+        if overwrites is not None:
+            self.overwrites = overwrites
+        if category is not None:
+            self.category_id = category.id
+
+    async def delete(self):
+        await self.http.request("DELETE /channels/{channel_id}", self.id)
+        if self.guild is not None:
+            self.guild.remove_channel(self.id)
+
+
+class FakeCategory(FakeChannel):
+    @property
+    def channels(self) -> List[FakeChannel]:
+        return [
+            channel
+            for channel in self.guild.channels.values()
+            if channel.category_id == self.id
+        ]
+
+    @property
+    def text_channels(self) -> List[FakeChannel]:
+        return self.channels
+
+
+class FakeGuild:
+    """A guild with the channels and role a configured guild has.
+
+    Parameters
+    ----------
+    registry: Dict[int, FakeChannel]
+        Shared between guilds, so a bot can look up
+        any channel without searching every guild
+    """
+
+    def __init__(
+        self,
+        http: FakeHTTP,
+        me: FakeUser = None,
+        registry: Dict[int, FakeChannel] = None,
+    ):
+        self.http = http
+        self.id = next_id()
+        self.name = "Guild"
+        self.unavailable = False
+        self.default_role = FakeRole(self.id)
+        self.me = me or FakeUser("Bot", bot=True)
+        self.staff_role = FakeRole()
+        self.roles = {self.staff_role.id: self.staff_role}
+        self.channels: Dict[int, FakeChannel] = {}
+        self.members: Dict[int, FakeUser] = {}
+        self._registry = registry if registry is not None else {}
+
+        self.category = self.add_category("Tickets")
+        self.log_channel = self.add_channel("logs")
+        self.new_ticket_channel = self.add_channel("new-ticket")
+
+    @property
+    def config(self) -> GuildConfig:
+        return GuildConfig(
+            self.id,
+            self.category.id,
+            self.log_channel.id,
+            self.new_ticket_channel.id,
+            self.staff_role.id,
+        )
+
+    @property
+    def categories(self) -> List[FakeCategory]:
+        return [
+            channel for channel in self.channels.values() if isinstance(channel, FakeCategory)
+        ]
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    async def fetch_member(self, user_id):
+        await self.http.request("GET /guilds/{guild_id}/members/{user_id}", self.id)
+        return self.members.get(user_id)
+
+    def add_channel(self, name: str, category=None, overwrites=None, *, cls=FakeChannel):
+        channel = cls(self.http, name, guild=self, category=category, overwrites=overwrites)
+        self.channels[channel.id] = channel
+        self._registry[channel.id] = channel
+        return channel
+
+    def add_category(self, name: str, overwrites=None) -> FakeCategory:
+        return self.add_channel(name, overwrites=overwrites, cls=FakeCategory)
+
+    def remove_channel(self, channel_id: int) -> None:
+        self.channels.pop(channel_id, None)
+        self._registry.pop(channel_id, None)
+
+    async def create_text_channel(self, name, *, overwrites=None, category=None):
+        await self.http.request("POST /guilds/{guild_id}/channels", self.id)
+        # Discord's limit, see utils.ticket_channels.CATEGORY_LIMIT
+        if category is not None and len(category.channels) >= 50:
+            raise FakeHTTPException(
+                "400 Bad Request (error code: 50035): Maximum number of channels in category reached (50)"
+            )
+
+        return self.add_channel(name, category, overwrites)
+
+    async def create_category(self, name, *, overwrites=None):
+        await self.http.request("POST /guilds/{guild_id}/channels", self.id)
+        return self.add_category(name, overwrites)
+
+
+class FakePayload:
+    """Mirrors discord.RawReactionActionEvent"""
+
+    def __init__(self, guild, channel, message_id, member, emoji: str):
+        self.guild_id = guild.id
+        self.channel_id = channel.id
+        self.message_id = message_id
+        self.member = member
+        self.user_id = member.id
+        self.emoji = FakeEmoji(emoji)
+
+
+class FakeBot:
+    """Only the attributes the bot's handlers and Ticket read.
+
+    Call ``configure`` before use, to save every guild's
+    configuration to the store as the `configure` command would.
+    """
+
+    def __init__(self, http: FakeHTTP, ticket_db, ticket_queue=None, *, guilds: int = 1):
+        self.http = http
+        self.ticket_db = ticket_db
+        self.ticket_queue = ticket_queue
+        self.message_capture = None
+        self.log_dispatcher = None
+        self.ticket_channels = None
+        # Disabled until given a close_after
+        self.inactivity_scheduler = InactivityScheduler(self)
+        self.reconcile_transcripts = False
+        self.transcript_archive = None
+        # Disabled, so only benchmarks of it start worker processes
+        self.transcript_renderer = TranscriptRenderer(workers=0)
+        self.user = FakeUser("Bot", bot=True)
+
+        self._channels: Dict[int, FakeChannel] = {}
+        self.guilds = [
+            FakeGuild(http, self.user, self._channels) for _ in range(guilds)
+        ]
+        self._guilds = {guild.id: guild for guild in self.guilds}
+
+        # The first guild, for anything that only needs one
+        self.guild = self.guilds[0]
+        self.log_channel = self.guild.log_channel
+        self.new_ticket_channel = self.guild.new_ticket_channel
+
+    async def configure(self):
+        for guild in self.guilds:
+            await self.ticket_db.save_config(guild.config)
+
+    def get_guild(self, guild_id):
+        return self._guilds.get(guild_id)
+
+    async def wait_until_ready(self):
+        # Every guild is cached from the start
+        return
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id):
+        await self.http.request("GET /channels/{channel_id}", channel_id)
+        return self.get_channel(channel_id)
+
+
+class FakeContext:
+    def __init__(self, bot: FakeBot, author: FakeUser, channel=None, guild=None):
+        self.bot = bot
+        self.guild = guild or (channel.guild if channel is not None else bot.guild)
+        self.author = author
+        self.channel = channel
+        self.message = FakeMessage(bot.http, channel, author=author)
+
+    async def send(self, content=None, **kwargs):
+        return await (self.channel or self.guild.log_channel).send(content, **kwargs)
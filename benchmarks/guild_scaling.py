@@ -0,0 +1,99 @@
+"""
+Shows how throughput scales as the same load is spread across
+more guilds, each with its own configuration, counters and
+Discord rate limit buckets.
+
+Usage: python -m benchmarks.guild_scaling [--guilds 1 10 100 1000]
+    [--store sqlite|json] [--events 500] [--concurrency 50] [--workers 2]
+    [--latency 0.02] [--rate-limit 5/1] [--global-rate-limit 50/1]
+    [--scenario NAME ...]
+"""
+import argparse
+import asyncio
+import logging
+import tempfile
+
+from benchmarks.bot_throughput import SCENARIOS, Environment, measure
+
+DEFAULT_SCENARIOS = ("reaction-lock", "reaction-create", "command-new")
+
+
+def parse_limit(value: str):
+    requests, per = value.split("/")
+    return int(requests), float(per)
+
+
+async def run(args, name: str, guilds: int) -> dict:
+    # Everything bot_throughput's Environment reads
+    options = argparse.Namespace(
+        store=args.store,
+        no_cache=False,
+        events=args.events,
+        workers=args.workers,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        history=0,
+        log_flush_interval=1.0,
+        reconcile=False,
+        guilds=guilds,
+        pool_size=0,
+        create_latency=None,
+        html_workers=0,
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        env = Environment(options, directory)
+        if args.global_rate_limit:
+            env.http.global_rate_limit = parse_limit(args.global_rate_limit)
+
+        try:
+            await env.setup()
+            events = await SCENARIOS[name](env)
+            return await measure(env, events, args.concurrency)
+        finally:
+            await env.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--guilds", type=int, nargs="*", default=[1, 10, 100, 1000])
+    parser.add_argument("--store", choices=("sqlite", "json"), default="sqlite")
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument(
+        "--rate-limit",
+        default="5/1",
+        help="requests/seconds per guild or channel for channel creation and reactions",
+    )
+    parser.add_argument(
+        "--global-rate-limit", help="requests/seconds across every route"
+    )
+    parser.add_argument(
+        "--scenario", nargs="*", choices=SCENARIOS, default=list(DEFAULT_SCENARIOS)
+    )
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    print(
+        f"{args.store} + cache, {args.latency * 1000:.0f}ms per request, "
+        f"rate limit {args.rate_limit}, concurrency {args.concurrency}, "
+        f"{args.workers} queue workers"
+    )
+    print(
+        f"{'scenario':<18}{'guilds':>8}{'events/s':>10}{'p50 ms':>9}{'p99 ms':>9}"
+        f"{'db/event':>10}{'429s':>6}"
+    )
+    for name in args.scenario:
+        for guilds in args.guilds:
+            result = await run(args, name, guilds)
+            print(
+                f"{name:<18}{guilds:>8}{result['per_second']:>10.1f}"
+                f"{result['p50']:>9.2f}{result['p99']:>9.2f}"
+                f"{result['db_ops']:>10.2f}{result['rate_limited']:>6}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
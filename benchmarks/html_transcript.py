@@ -0,0 +1,169 @@
+"""
+Measures rendering HTML transcripts for many large tickets closed at
+once, in the event loop against in a pool of worker processes, and how
+late the event loop runs while they render.
+
+Usage: python -m benchmarks.html_transcript [--tickets 8]
+    [--messages 20000] [--workers 1 2 4]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+
+from benchmarks.fakes import FakeGuild, FakeHTTP, next_id
+from utils import TranscriptRenderer
+from utils.db import MessageRecord
+from utils.html_transcript import render_payload, serialise
+from utils.transcript import extra_lines
+
+# (content, attachments, embeds)
+SAMPLES = (
+    ("Hello, I can't log in to my account", (), ()),
+    ("Have you tried **resetting** your password? See https://example.com/reset", (), ()),
+    ("Yes, it says `invalid token` every time", (), ()),
+    ("> it says invalid token\nCould you send a screenshot?", (), ()),
+    (
+        "Sure, here it is",
+        (("screenshot.png", 184320, "https://cdn.discordapp.com/attachments/1/2/screenshot.png"),),
+        (),
+    ),
+    ("```\nTraceback (most recent call last):\n  File \"app.py\", line 12\nValueError: <token>\n```", (), ()),
+    ("Thanks <@{user}>, ~~that~~ *this* should be fixed now ||hopefully||", (), ()),
+    ("", (), (("Ticket updated", "A member of staff has been assigned"),)),
+)
+
+
+def make_records(messages: int, ticket_id: int, channel_id: int) -> list:
+    users = [(next_id(), f"user{index}") for index in range(3)]
+    start = time.time() - messages * 30
+    records = []
+    for index in range(messages):
+        author_id, name = random.choice(users)
+        content, attachments, embeds = random.choice(SAMPLES)
+        content = content.format(user=random.choice(users)[0])
+        records.append(
+            MessageRecord(
+                next_id(),
+                ticket_id,
+                channel_id,
+                author_id,
+                name,
+                start + index * 30,
+                content + extra_lines(attachments, embeds),
+                edited_at=start if random.random() < 0.05 else None,
+                attachments=attachments,
+                embeds=embeds,
+            )
+        )
+
+    return records
+
+
+class LoopProbe:
+    """Records how late a task scheduled every millisecond wakes up"""
+
+    def __init__(self):
+        self.delays = []
+        self._task = None
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        await asyncio.sleep(0.01)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # Lets a wake up held back until now record how late it was
+        await asyncio.sleep(0.01)
+        self._task.cancel()
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            self.delays.append(time.perf_counter() - start - 0.001)
+
+    @property
+    def worst(self) -> float:
+        return max(self.delays, default=0) * 1000
+
+    @property
+    def p99(self) -> float:
+        delays = sorted(self.delays)
+        return delays[int(len(delays) * 0.99)] * 1000 if delays else 0
+
+
+async def in_loop(tickets) -> float:
+    """Rendering straight in the event loop, what a plain renderer would do"""
+
+    async def render(channel, ticket_id, records):
+        payload = serialise(
+            records,
+            ticket_id=ticket_id,
+            guild_name=channel.guild.name,
+            channel_name=channel.name,
+            avatar=str,
+        )
+        return render_payload(payload)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(render(*ticket) for ticket in tickets))
+    return time.perf_counter() - start
+
+
+async def in_pool(renderer: TranscriptRenderer, tickets) -> float:
+    start = time.perf_counter()
+    pages = await asyncio.gather(*(renderer.render(*ticket) for ticket in tickets))
+    assert None not in pages
+    return time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tickets", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    guild = FakeGuild(FakeHTTP())
+    tickets = []
+    for ticket_id in range(1, args.tickets + 1):
+        channel = guild.add_channel(f"ticket-{ticket_id}")
+        tickets.append((channel, ticket_id, make_records(args.messages, ticket_id, channel.id)))
+
+    print(
+        f"{args.tickets} tickets of {args.messages} messages closed at once, "
+        f"{os.cpu_count()} CPUs"
+    )
+    print(f"{'':<18}{'seconds':>8}{'loop p99 ms':>13}{'loop max ms':>13}")
+
+    async with LoopProbe() as probe:
+        elapsed = await in_loop(tickets)
+    print(f"{'event loop':<18}{elapsed:>8.2f}{probe.p99:>13.1f}{probe.worst:>13.1f}")
+
+    for workers in args.workers:
+        renderer = TranscriptRenderer(workers=workers)
+        try:
+            # Starting the workers is paid once, when the bot starts
+            start = time.perf_counter()
+            await in_pool(renderer, tickets[:workers])
+            warm_up = time.perf_counter() - start
+
+            async with LoopProbe() as probe:
+                elapsed = await in_pool(renderer, tickets)
+        finally:
+            await renderer.close()
+
+        name = f"{workers} worker{'s' if workers > 1 else ''}"
+        print(
+            f"{name:<18}{elapsed:>8.2f}{probe.p99:>13.1f}{probe.worst:>13.1f}"
+            f"   (first renders {warm_up:.2f}s)"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,180 @@
+"""
+Measures the inactivity scheduler: loading stored deadlines, the
+cost of recording a message, how late idle tickets are closed and
+the CPU it uses compared to polling every ticket once a second.
+
+Usage: python -m benchmarks.inactivity [--store sqlite|json]
+    [--tickets 2000] [--busy 0.1] [--messages 100000] [--window 5]
+    [--close-after 4] [--warn-before 2] [--guilds 10] [--concurrency 5]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from benchmarks.fakes import FakeBot, FakeHTTP, next_id
+from benchmarks.reconcile import make_store
+from utils import InactivityScheduler, LogDispatcher, MessageCapture, TranscriptArchive
+
+
+class TimedScheduler(InactivityScheduler):
+    """Records how long after their deadline tickets are warned and closed"""
+
+    def __init__(self, bot, **kwargs):
+        super().__init__(bot, **kwargs)
+        self.deadlines = {}
+        self.warn_lateness = []
+        self.close_lateness = []
+
+    async def _warn(self, channel_id):
+        deadline = self.deadlines[channel_id] - self.warn_before
+        self.warn_lateness.append(time.time() - deadline)
+        await super()._warn(channel_id)
+
+    async def _close(self, channel_id):
+        self.close_lateness.append(time.time() - self.deadlines[channel_id])
+        await super()._close(channel_id)
+
+
+async def populate(bot: FakeBot, args) -> list:
+    """Store tickets whose warnings fall due over the next ``window`` seconds."""
+    now = time.time()
+    activity = []
+    for ticket_id in range(1, args.tickets + 1):
+        guild = random.choice(bot.guilds)
+        channel = guild.add_channel(f"ticket-{ticket_id}")
+        await bot.ticket_db.create_ticket(
+            guild.id, channel.id, ticket_id, next_id(), next_id()
+        )
+
+        last_active_at = now - args.close_after + args.warn_before + random.uniform(
+            0, args.window
+        )
+        activity.append((channel.id, last_active_at, None))
+
+    await bot.ticket_db.save_ticket_activity(activity)
+    return activity
+
+
+async def keep_busy(scheduler: InactivityScheduler, channel_ids: list, interval: float):
+    while True:
+        for channel_id in channel_ids:
+            scheduler.track(channel_id)
+        await asyncio.sleep(interval)
+
+
+def polling_scan(activity: dict, close_after: float) -> float:
+    """What a poller does each tick, check every ticket's deadline"""
+    start = time.perf_counter()
+    now = time.time()
+    [channel_id for channel_id, last in activity.items() if last + close_after <= now]
+    return time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--store", choices=("sqlite", "json"), default="sqlite")
+    parser.add_argument("--tickets", type=int, default=2000)
+    parser.add_argument(
+        "--busy", type=float, default=0.1, help="share of tickets that keep talking"
+    )
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument(
+        "--window", type=float, default=5.0, help="seconds the deadlines are spread over"
+    )
+    parser.add_argument("--close-after", type=float, default=4.0)
+    parser.add_argument("--warn-before", type=float, default=2.0)
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument(
+        "--concurrency", type=int, default=5, help="tickets warned or closed at once"
+    )
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = make_store(args.store, directory)
+        bot = FakeBot(FakeHTTP(latency=0.005), db, guilds=args.guilds)
+        bot.message_capture = MessageCapture(db)
+        bot.log_dispatcher = LogDispatcher()
+        bot.transcript_archive = TranscriptArchive(os.path.join(directory, "archive"))
+        await bot.transcript_archive.initialize()
+        await bot.configure()
+
+        scheduler = bot.inactivity_scheduler = TimedScheduler(
+            bot,
+            close_after=args.close_after,
+            warn_before=args.warn_before,
+            max_concurrent=args.concurrency,
+        )
+        busy_task = None
+        try:
+            activity = await populate(bot, args)
+            busy = [
+                channel_id
+                for channel_id, *_ in random.sample(activity, int(args.tickets * args.busy))
+            ]
+            idle = args.tickets - len(busy)
+
+            start = time.perf_counter()
+            await scheduler.load()
+            load_ms = (time.perf_counter() - start) * 1000
+            for channel_id, last_active_at, _ in activity:
+                scheduler.deadlines[channel_id] = last_active_at + args.close_after
+
+            start = time.perf_counter()
+            for _ in range(args.messages):
+                scheduler.track(random.choice(busy))
+            track_us = (time.perf_counter() - start) / args.messages * 1e6
+
+            busy_task = asyncio.create_task(keep_busy(scheduler, busy, 0.5))
+            cpu, started = time.process_time(), time.perf_counter()
+            scheduler.start()
+            limit = started + args.window + args.warn_before + 30
+            while len(scheduler.close_lateness) < idle and time.perf_counter() < limit:
+                await asyncio.sleep(0.1)
+            # Let the last closes finish
+            await asyncio.gather(*scheduler._actions)
+            elapsed = time.perf_counter() - started
+            cpu = time.process_time() - cpu
+
+            remaining = sum([1 async for _ in db.iter_tickets()])
+            assert remaining == len(busy), (remaining, len(busy))
+
+            scan = polling_scan(
+                {channel_id: last for channel_id, last, _ in activity}, args.close_after
+            )
+        finally:
+            if busy_task is not None:
+                busy_task.cancel()
+            await scheduler.close()
+            await bot.log_dispatcher.close()
+            await bot.message_capture.close()
+            await db.close()
+            await bot.transcript_archive.close()
+
+    def lateness(values):
+        values = sorted(values)
+        p99 = values[int(len(values) * 0.99) - 1] if values else 0
+        return f"p50 {statistics.median(values or [0]) * 1000:.1f}ms p99 {p99 * 1000:.1f}ms"
+
+    print(
+        f"{args.store} + cache, {args.tickets} tickets ({len(busy)} busy) across "
+        f"{args.guilds} guilds, {args.concurrency} closed at once"
+    )
+    print(f"  load stored deadlines   {load_ms:9.1f}ms")
+    print(f"  record a message        {track_us:9.2f}us")
+    print(f"  warned {len(scheduler.warn_lateness):>6}, late by   {lateness(scheduler.warn_lateness)}")
+    print(f"  closed {len(scheduler.close_lateness):>6}, late by   {lateness(scheduler.close_lateness)}")
+    print(
+        f"  {cpu:.2f}s CPU over {elapsed:.1f}s, mostly closing tickets; polling every "
+        f"second would add {scan * 1000:.2f}ms per second scanning"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
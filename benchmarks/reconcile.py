@@ -0,0 +1,99 @@
+"""
+Measures how long finding and removing tickets whose channels
+were deleted takes, batched against finalising them one at a time.
+
+Usage: python -m benchmarks.reconcile [--store sqlite|json]
+    [--tickets 100000] [--orphans 0.05] [--guilds 10]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.fakes import FakeBot, FakeHTTP, next_id
+from utils import MessageCapture, TicketReconciler, TranscriptArchive
+from utils.db import CachedStore, JsonStore, SqliteStore
+
+
+def make_store(kind: str, directory: str):
+    if kind == "sqlite":
+        store = SqliteStore(storage_path="/")
+        store.db = os.path.join(directory, "storage.db")
+    else:
+        store = JsonStore(storage_path="/")
+        store.cwd = directory
+
+    return CachedStore(store)
+
+
+async def populate(bot: FakeBot, tickets: int, orphans: float):
+    """Store tickets, leaving a share of them without a channel."""
+    orphaned = []
+    for ticket_id in range(1, tickets + 1):
+        guild = random.choice(bot.guilds)
+        if random.random() < orphans:
+            channel_id = next_id()
+            orphaned.append(channel_id)
+        else:
+            channel_id = guild.add_channel(f"ticket-{ticket_id}").id
+
+        await bot.ticket_db.create_ticket(
+            guild.id, channel_id, ticket_id, next_id(), next_id()
+        )
+
+    return orphaned
+
+
+async def run(args, batched: bool) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        db = make_store(args.store, directory)
+        bot = FakeBot(FakeHTTP(latency=0), db, guilds=args.guilds)
+        bot.message_capture = MessageCapture(db)
+        bot.transcript_archive = TranscriptArchive(os.path.join(directory, "archive"))
+        reconciler = TicketReconciler(bot, interval=None, grace_period=0)
+        try:
+            orphaned = await populate(bot, args.tickets, args.orphans)
+
+            start = time.perf_counter()
+            if batched:
+                removed = await reconciler.reconcile()
+            else:
+                removed = 0
+                async for ticket in db.iter_tickets():
+                    if bot.get_channel(ticket.channel_id) is None:
+                        await reconciler.finalise([ticket])
+                        removed += 1
+            elapsed = time.perf_counter() - start
+
+            assert removed == len(orphaned), (removed, len(orphaned))
+            remaining = sum([1 async for _ in db.iter_tickets()])
+            assert remaining == args.tickets - len(orphaned)
+            return elapsed, removed
+        finally:
+            await bot.message_capture.close()
+            await db.close()
+            await bot.transcript_archive.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--store", choices=("sqlite", "json"), default="sqlite")
+    parser.add_argument("--tickets", type=int, default=100_000)
+    parser.add_argument("--orphans", type=float, default=0.05)
+    parser.add_argument("--guilds", type=int, default=10)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    print(f"{args.store} + cache, {args.tickets} tickets across {args.guilds} guilds")
+    for batched in (False, True):
+        elapsed, removed = await run(args, batched)
+        name = "reconcile, one batch" if batched else "one at a time"
+        print(f"  {name:<22} {removed:>7} removed in {elapsed * 1000:9.1f}ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
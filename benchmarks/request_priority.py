@@ -0,0 +1,131 @@
+"""
+Measures how long opening tickets takes while a flood of log messages
+is being sent, with every request sent as soon as it is made against
+waiting its turn in the request scheduler.
+
+Usage: python -m benchmarks.request_priority [--logs 300] [--tickets 20]
+    [--guilds 100] [--latency 0.02] [--global-rate-limit 50/1]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+import discord
+
+from benchmarks.fakes import FakeBot, FakeContext, FakeHTTP, FakeUser
+from utils import (
+    BACKGROUND,
+    LogDispatcher,
+    MessageCapture,
+    Ticket,
+    TicketChannels,
+    metrics,
+    request_scheduler,
+)
+from utils.db import CachedStore, SqliteStore
+
+
+def parse_limit(value: str):
+    requests, per = value.split("/")
+    return int(requests), float(per)
+
+
+async def flood(bot: FakeBot, logs: int) -> float:
+    """Send log messages to every guild's log channel, as a busy bot would."""
+    requests = []
+    for index in range(logs):
+        channel = bot.guilds[index % len(bot.guilds)].log_channel
+        requests.append(
+            request_scheduler.request(
+                "send_logs",
+                channel.send(embed=discord.Embed(title="Log")),
+                major=channel.id,
+                priority=BACKGROUND,
+            )
+        )
+
+    start = time.perf_counter()
+    await asyncio.gather(*requests)
+    return time.perf_counter() - start
+
+
+async def open_ticket(bot: FakeBot, guild) -> float:
+    ctx = FakeContext(bot, FakeUser(), guild=guild)
+    start = time.perf_counter()
+    await Ticket(ctx, bot.ticket_db).create_ticket(subject="Benchmark")
+    return time.perf_counter() - start
+
+
+async def run(args, scheduled: bool) -> dict:
+    limit = parse_limit(args.global_rate_limit)
+    request_scheduler.global_limit = limit if scheduled else None
+    request_scheduler.reset()
+    metrics.reset()
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = SqliteStore(storage_path="/")
+        store.db = os.path.join(directory, "storage.db")
+        db = CachedStore(store)
+        http = FakeHTTP(latency=args.latency, global_rate_limit=limit)
+        bot = FakeBot(http, db, guilds=args.guilds)
+        bot.ticket_channels = TicketChannels()
+        bot.message_capture = MessageCapture(db)
+        bot.log_dispatcher = LogDispatcher(flush_interval=3600.0)
+        await bot.configure()
+        try:
+            logs = asyncio.create_task(flood(bot, args.logs))
+            # Once the flood has filled the global limit
+            await asyncio.sleep(0.05)
+            tickets = await asyncio.gather(
+                *(
+                    open_ticket(bot, bot.guilds[index % len(bot.guilds)])
+                    for index in range(args.tickets)
+                )
+            )
+            logs_elapsed = await logs
+        finally:
+            await bot.message_capture.close()
+            await db.close()
+
+    return {
+        "p50": statistics.median(tickets) * 1000,
+        "max": max(tickets) * 1000,
+        "logs": logs_elapsed,
+        "rate_limited": http.rate_limited,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--logs", type=int, default=300)
+    parser.add_argument("--tickets", type=int, default=20)
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--global-rate-limit", default="50/1")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    metrics.enabled = True
+
+    print(
+        f"{args.tickets} tickets opened during {args.logs} log messages, "
+        f"global rate limit {args.global_rate_limit}"
+    )
+    print(f"{'':<12}{'ticket p50 ms':>14}{'max ms':>9}{'logs s':>8}{'429s':>6}")
+    for scheduled in (False, True):
+        result = await run(args, scheduled)
+        print(
+            f"{'scheduled' if scheduled else 'as made':<12}{result['p50']:>14.1f}"
+            f"{result['max']:>9.1f}{result['logs']:>8.2f}{result['rate_limited']:>6}"
+        )
+        for line in metrics.summary().splitlines():
+            if line.startswith("request_queue_seconds"):
+                print(f"  {line}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+"""
+Measures the per-call latency of the lookups SqliteStore
+does on every reaction, against the current schema and the
+original unindexed one.
+
+Usage: python -m benchmarks.sqlite_lookups [--tickets 100000] [--lookups 2000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import aiosqlite
+
+from utils.db import SqliteStore
+
+LEGACY_SCHEMA = (
+    "CREATE TABLE tickets (channel_id number, ticket_id number, reaction_message_id number)",
+    "CREATE TABLE config (ticket_setup_message_id number, ticket_count number)",
+    "INSERT INTO config VALUES (0, 0)",
+)
+
+QUERIES = {
+    "check_is_ticket": "SELECT 1 FROM tickets WHERE channel_id=:id",
+    "get_ticket_id": "SELECT ticket_id FROM tickets WHERE channel_id=:id",
+    "reaction_message": "SELECT 1 FROM tickets WHERE reaction_message_id=:message_id",
+}
+
+
+def make_rows(count: int):
+    # Snowflake sized ids, like the ones Discord hands out
+    base = 800_000_000_000_000_000
+    return [(base + i, i + 1, base + count + i) for i in range(count)]
+
+
+async def time_queries(db: aiosqlite.Connection, rows, lookups: int) -> dict:
+    sample = random.sample(rows, min(lookups, len(rows)))
+    results = {}
+    for name, query in QUERIES.items():
+        timings = []
+        for channel_id, _, reaction_message_id in sample:
+            params = {"id": channel_id, "message_id": reaction_message_id}
+            start = time.perf_counter()
+            async with db.execute(query, params) as cursor:
+                await cursor.fetchone()
+            timings.append(time.perf_counter() - start)
+
+        timings.sort()
+        results[name] = (
+            statistics.median(timings) * 1e6,
+            timings[int(len(timings) * 0.99) - 1] * 1e6,
+        )
+
+    return results
+
+
+async def bench_legacy(path: str, rows, lookups: int) -> dict:
+    async with aiosqlite.connect(path) as db:
+        for statement in LEGACY_SCHEMA:
+            await db.execute(statement)
+        await db.executemany("INSERT INTO tickets VALUES (?, ?, ?)", rows)
+        await db.commit()
+        return await time_queries(db, rows, lookups)
+
+
+async def bench_current(directory: str, rows, lookups: int) -> dict:
+    store = SqliteStore(storage_path="/", database_name="current.db")
+    store.db = os.path.join(directory, "current.db")
+    await store.initialize()
+    try:
+        # noinspection PyProtectedMember
+        db = store._connection
+        await db.executemany(
+            "INSERT INTO tickets (channel_id, ticket_id, reaction_message_id) VALUES (?, ?, ?)",
+            rows,
+        )
+        await db.commit()
+        return await time_queries(db, rows, lookups)
+    finally:
+        await store.close()
+
+
+def report(title: str, results: dict) -> None:
+    print(title)
+    for name, (p50, p99) in results.items():
+        print(f"  {name:<18} p50 {p50:9.1f}us  p99 {p99:9.1f}us")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tickets", type=int, default=100_000)
+    parser.add_argument("--lookups", type=int, default=2_000)
+    args = parser.parse_args()
+
+    rows = make_rows(args.tickets)
+    with tempfile.TemporaryDirectory() as directory:
+        report(
+            f"Legacy schema, {args.tickets} tickets",
+            await bench_legacy(os.path.join(directory, "legacy.db"), rows, args.lookups),
+        )
+        report(
+            f"Current schema, {args.tickets} tickets",
+            await bench_current(directory, rows, args.lookups),
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,139 @@
+"""
+Measures copying every ticket between JsonStore and SqliteStore, the
+batched transfer against creating tickets one at a time.
+
+Usage: python -m benchmarks.transfer [--tickets 100000] [--guilds 10]
+    [--batch-size 5000]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.fakes import next_id
+from utils.db import GuildConfig, JsonStore, SqliteStore, TicketRecord
+from utils.db.transfer import transfer, verify
+
+
+def make_store(kind: str, directory: str):
+    if kind == "sqlite":
+        store = SqliteStore(storage_path="/")
+        store.db = os.path.join(directory, "storage.db")
+    else:
+        store = JsonStore(storage_path="/", flush_delay=3600.0)
+        store.cwd = directory
+
+    return store
+
+
+async def populate(store, tickets: int, guilds: int) -> None:
+    guild_ids = [next_id() for _ in range(guilds)]
+    await store.import_guilds(
+        (GuildConfig(guild_id, next_id(), next_id(), next_id(), next_id(), next_id()), 0)
+        for guild_id in guild_ids
+    )
+    now = time.time()
+    counts = dict.fromkeys(guild_ids, 0)
+    records = []
+    for _ in range(tickets):
+        guild_id = random.choice(guild_ids)
+        counts[guild_id] += 1
+        records.append(
+            TicketRecord(
+                next_id(),
+                counts[guild_id],
+                next_id(),
+                next_id(),
+                guild_id,
+                now - random.uniform(0, 86400) if random.random() < 0.5 else None,
+            )
+        )
+
+    await store.import_tickets(records)
+    for guild_id, count in counts.items():
+        for _ in range(count):
+            await store.increment_ticket_count(guild_id)
+
+
+async def one_at_a_time(source, target) -> float:
+    """What migrating by hand through the existing methods looks like"""
+    start = time.perf_counter()
+    async for config in source.iter_configs():
+        await target.save_config(config)
+        await target.save_new_ticket_message(config.guild_id, config.ticket_setup_message_id)
+        for _ in range(await source.get_ticket_count(config.guild_id)):
+            await target.increment_ticket_count(config.guild_id)
+
+    async for ticket in source.iter_tickets():
+        await target.create_ticket(
+            ticket.guild_id,
+            ticket.channel_id,
+            ticket.ticket_id,
+            ticket.reaction_message_id,
+            ticket.author_id,
+        )
+        if ticket.last_active_at is not None:
+            await target.save_ticket_activity([(ticket.channel_id, ticket.last_active_at, None)])
+
+    return time.perf_counter() - start
+
+
+async def run(args, source_kind: str, target_kind: str, batched: bool):
+    with tempfile.TemporaryDirectory() as directory:
+        os.mkdir(os.path.join(directory, "source"))
+        os.mkdir(os.path.join(directory, "target"))
+
+        source = make_store(source_kind, os.path.join(directory, "source"))
+        await populate(source, args.tickets, args.guilds)
+        await source.close()
+
+        source = make_store(source_kind, os.path.join(directory, "source"))
+        target = make_store(target_kind, os.path.join(directory, "target"))
+        try:
+            if batched:
+                elapsed = (await transfer(source, target, batch_size=args.batch_size)).seconds
+            else:
+                elapsed = await one_at_a_time(source, target)
+
+            # Included, as writing config.json only happens here
+            start = time.perf_counter()
+            await target.close()
+            elapsed += time.perf_counter() - start
+
+            target = make_store(target_kind, os.path.join(directory, "target"))
+            start = time.perf_counter()
+            problems = await verify(source, target)
+            verified = time.perf_counter() - start
+            assert not problems, problems
+        finally:
+            await target.close()
+            await source.close()
+
+    return elapsed, verified
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tickets", type=int, default=100_000)
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    print(f"{args.tickets} tickets across {args.guilds} guilds")
+    for source, target in (("json", "sqlite"), ("sqlite", "json")):
+        for batched in (False, True):
+            elapsed, verified = await run(args, source, target, batched)
+            name = f"batches of {args.batch_size}" if batched else "one at a time"
+            print(
+                f"  {source:>6} -> {target:<6} {name:<18} {elapsed * 1000:9.1f}ms, "
+                f"verified in {verified * 1000:.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,11 +1,41 @@
+import asyncio
 import json
+import io
 import logging
+import os
+import time
 from pathlib import Path
 
 import discord
 from discord.ext import commands
 
-from utils import MyContext, Ticket, JsonStore, SqliteStore
+from utils import (
+    GuildConfig,
+    InactivityScheduler,
+    MessageCapture,
+    MyContext,
+    Ticket,
+    TicketChannels,
+    TicketQueue,
+    TicketReconciler,
+    TranscriptArchive,
+    TranscriptRenderer,
+    CachedStore,
+    GLOBAL_LIMIT,
+    InstrumentedStore,
+    LogDispatcher,
+    JsonStore,
+    SqliteStore,
+    PRIORITIES,
+    ROUTE_LIMITS,
+    RateLimitCounter,
+    format_results,
+    is_configured,
+    is_staff,
+    metrics,
+    parse_query,
+    request_scheduler,
+)
 
 """
 Options for logging:
@@ -23,17 +53,40 @@ logging.basicConfig(
 log = logging.getLogger(__name__)
 
 
-class Bot(commands.Bot):
+class Bot(commands.AutoShardedBot):
+    # "minimal" only subscribes to the events tickets need and caches no
+    # members beyond the bot itself, members are looked up when needed.
+    # "full" subscribes to everything and caches every member.
+    intent_profile = "minimal"
+    # How many shards the bot runs as, None lets Discord recommend a count
+    shard_count = None
+    # Which of those shards this process runs, None for all of them.
+    # Running shards across several processes needs shard_count set.
+    shard_ids = None
+
     def __init__(self):
+        intents, member_cache_flags = self.build_intents(self.intent_profile)
         super().__init__(
             command_prefix="-",
             case_insensitive=True,
-            intents=discord.Intents.all(),
+            intents=intents,
+            member_cache_flags=member_cache_flags,
+            chunk_guilds_at_startup=intents.members,
             activity=discord.Game(name=".new for a ticket"),
+            shard_count=self.shard_count,
+            shard_ids=self.shard_ids,
         )
 
         self.cwd = str(Path(__file__).parents[0])
-
+        self._started_at = None
+        self._metrics_task = None
+        self._metrics_runner = None
+
+        # Each guild is set up with the `configure` command. If this bot
+        # ran before it supported several guilds, set this to that guild
+        # so the tickets and transcripts stored back then are given to it.
+        self.legacy_guild_id = None
+        # Optionally, configure legacy_guild_id from these on start up
         # The category to make tickets in
         self.category_id = None
         # The channel to send logs to
@@ -42,72 +95,299 @@ class Bot(commands.Bot):
         self.new_ticket_channel_id = None
         # The staff role to add to tickets
         self.staff_role_id = None
+        # Time the storage, Discord requests and reaction handling
+        self.metrics_enabled = False
+        # Requests to Discord are held back to stay within its rate limits,
+        # those a user is waiting on are sent before logs and other
+        # background work. None and {} to leave it all to discord.py.
+        request_scheduler.global_limit = GLOBAL_LIMIT
+        request_scheduler.route_limits = dict(ROUTE_LIMITS)
+        # Serve metrics at http://127.0.0.1:<port>/metrics (None to disable)
+        self.metrics_port = None
+        # Log a summary of the metrics every this many seconds (None to disable)
+        self.metrics_log_interval = None
         # The data storage medium to use (MUST implement utils.db.base.Base)
-        # self.ticket_db = JsonStore(storage_path="/bot_config/")
-        self.ticket_db = SqliteStore(storage_path="/bot_config/")
-
-        if not self.category_id \
-                or not self.log_channel_id \
-                or not self.new_ticket_channel_id \
-                or not self.staff_role_id:
-            raise RuntimeError("Please set all of these variables above")
+        # store = JsonStore(storage_path="/bot_config/")
+        store = SqliteStore(storage_path="/bot_config/")
+        if self.metrics_enabled:
+            store = InstrumentedStore(store, metrics)
+        # CachedStore keeps the ticket lookups done per reaction in memory
+        self.ticket_db = CachedStore(store)
+        # Tickets made via reactions are created by this many workers at once
+        self.ticket_queue_workers = 2
+        # How many reaction ticket creations can wait before more are turned away
+        self.ticket_queue_size = 50
+        # Ignore reactions from users who already have a ticket open
+        self.one_ticket_per_user = False
+        self.ticket_queue = TicketQueue(
+            self.ticket_db,
+            workers=self.ticket_queue_workers,
+            max_size=self.ticket_queue_size,
+            one_ticket_per_user=self.one_ticket_per_user,
+        )
+        # Keep this many hidden channels ready per guild, opening a ticket
+        # then only renames one and sets its permissions (0 to disable)
+        self.ticket_channel_pool_size = 0
+        # Tickets overflow into more categories once a category is full
+        self.ticket_channels = TicketChannels(pool_size=self.ticket_channel_pool_size)
+        # Ticket messages are saved as they are sent, so closing needn't
+        # read back the whole channel. Needs a store that keeps messages,
+        # with JsonStore transcripts come from the channel history instead.
+        self.message_capture = MessageCapture(self.ticket_db)
+        # Also read the channel history on close, saving anything the
+        # capture missed, e.g. messages sent while the bot was offline
+        self.reconcile_transcripts = False
+        # Log channel messages are batched and sent this often, in seconds
+        self.log_flush_interval = 1.0
+        self.log_dispatcher = LogDispatcher(flush_interval=self.log_flush_interval)
+        # Closed ticket transcripts are compressed into segments in here
+        self.transcript_archive = TranscriptArchive(
+            os.path.join(self.cwd, "tickets", "archive")
+        )
+        # Closed tickets are also logged as an HTML transcript, rendered
+        # by this many processes at once so large tickets don't hold up
+        # the bot (0 to only log the plain text transcript)
+        self.html_transcript_workers = 2
+        self.transcript_renderer = TranscriptRenderer(workers=self.html_transcript_workers)
+        # Tickets whose channels were deleted by hand are removed on start
+        # up and then every this many seconds (None for start up only)
+        self.reconcile_interval = 3600.0
+        self.ticket_reconciler = TicketReconciler(self, interval=self.reconcile_interval)
+        # Close tickets nobody has sent a message in for this many
+        # seconds, e.g. 48 * 3600 (None to never close them)
+        self.inactive_close_after = None
+        # Warn a ticket this many seconds before it is closed for inactivity
+        self.inactive_warn_before = 3600.0
+        self.inactivity_scheduler = InactivityScheduler(
+            self,
+            close_after=self.inactive_close_after,
+            warn_before=self.inactive_warn_before,
+        )
 
-        if not isinstance(self.category_id, int):
-            raise RuntimeError("Expected category_id to be an int")
+        for name in (
+            "legacy_guild_id",
+            "category_id",
+            "log_channel_id",
+            "new_ticket_channel_id",
+            "staff_role_id",
+        ):
+            value = getattr(self, name)
+            if value is not None and not isinstance(value, int):
+                raise RuntimeError(f"Expected {name} to be an int")
+
+        if self.legacy_config.is_configured and self.legacy_guild_id is None:
+            raise RuntimeError("Please set legacy_guild_id to the guild these ids are in")
+
+    @property
+    def legacy_config(self) -> GuildConfig:
+        """The configuration set for legacy_guild_id above"""
+        return GuildConfig(
+            self.legacy_guild_id,
+            self.category_id,
+            self.log_channel_id,
+            self.new_ticket_channel_id,
+            self.staff_role_id,
+        )
 
-        if not isinstance(self.log_channel_id, int):
-            raise RuntimeError("Expected log_channel_id to be an int")
+    @staticmethod
+    def build_intents(profile: str):
+        if profile == "full":
+            intents = discord.Intents.all()
+            return intents, discord.MemberCacheFlags.from_intents(intents)
 
-        if not isinstance(self.new_ticket_channel_id, int):
-            raise RuntimeError("Expected new_ticket_channel_id to be an int")
+        if profile != "minimal":
+            raise RuntimeError("Expected intent_profile to be 'minimal' or 'full'")
 
-        if not isinstance(self.staff_role_id, int):
-            raise RuntimeError("Expected staff_role_id to be an int")
+        # Guilds for channels and roles, messages for commands
+        # and reactions for opening and closing tickets
+        intents = discord.Intents.none()
+        intents.guilds = True
+        intents.guild_messages = True
+        intents.guild_reactions = True
+        return intents, discord.MemberCacheFlags.none()
 
     async def get_context(self, message, *, cls=MyContext):
         return await super().get_context(message, cls=cls)
 
+    async def start(self, *args, **kwargs):
+        # discord.py 2.0 calls setup_hook itself, 1.7 has no such step
+        if discord.version_info.major < 2:
+            await self.setup_hook()
+
+        await super().start(*args, **kwargs)
+
+    async def setup_hook(self):
+        """Get everything ready before we connect and start receiving events."""
+        self._started_at = time.perf_counter()
+
+        # Opens the store, applies any migrations and loads the ticket index
+        await self.ticket_db.initialize()
+        await self.transcript_archive.initialize()
+        if self.legacy_guild_id is not None:
+            await self.claim_legacy_guild()
+        self.ticket_queue.start()
+        self.log_dispatcher.start()
+        self.transcript_renderer.start()
+        # Waits until we are connected and the guilds are cached
+        self.ticket_reconciler.start()
+        self.inactivity_scheduler.start()
+        if self.metrics_enabled:
+            await self.start_metrics()
+
+        log.info(
+            "Storage ready in %.1fms",
+            (time.perf_counter() - self._started_at) * 1000,
+        )
+
+    async def claim_legacy_guild(self):
+        """Give legacy_guild_id everything stored before guilds were tracked."""
+        await self.ticket_db.claim_legacy_data(self.legacy_guild_id)
+        await self.transcript_archive.claim_legacy_data(self.legacy_guild_id)
+
+        # Only fills in a missing configuration, so the
+        # `configure` command has the final say
+        config = await self.ticket_db.get_config(self.legacy_guild_id)
+        if self.legacy_config.is_configured and (
+            config is None or not config.is_configured
+        ):
+            await self.ticket_db.save_config(self.legacy_config)
+            log.info("Configured guild %s from the bot's settings", self.legacy_guild_id)
+
+    async def start_metrics(self):
+        metrics.enabled = True
+        logging.getLogger("discord.http").addHandler(RateLimitCounter(metrics))
+
+        metrics.gauge("ticket_queue_depth", lambda: self.ticket_queue.depth)
+        metrics.gauge("log_queue_depth", lambda: self.log_dispatcher.depth)
+        metrics.gauge("ticket_channel_pool_size", lambda: self.ticket_channels.pooled)
+        metrics.gauge("ticket_queue_in_flight", lambda: self.ticket_queue.in_flight)
+        metrics.gauge("inactivity_tracked", lambda: self.inactivity_scheduler.tracked)
+        for priority in PRIORITIES:
+            metrics.gauge(
+                "request_queue_depth",
+                lambda priority=priority: request_scheduler.depth(priority),
+                priority=priority,
+            )
+        for stat in self.ticket_queue.stats:
+            metrics.gauge(
+                "ticket_queue_events",
+                lambda stat=stat: self.ticket_queue.stats[stat],
+                stat=stat,
+            )
+
+        if self.metrics_port:
+            self._metrics_runner = await metrics.serve(port=self.metrics_port)
+
+        if self.metrics_log_interval:
+            self._metrics_task = asyncio.create_task(
+                metrics.log_periodically(self.metrics_log_interval)
+            )
+
+    async def close(self):
+        # Sent while we are still connected
+        await self.log_dispatcher.close()
+        await super().close()
+
+        if self._metrics_task:
+            self._metrics_task.cancel()
+        if self._metrics_runner:
+            await self._metrics_runner.cleanup()
+
+        await self.ticket_reconciler.close()
+        await self.inactivity_scheduler.close()
+        await self.ticket_queue.close()
+        await self.ticket_channels.close()
+        await self.message_capture.close()
+        await self.ticket_db.close()
+        await self.transcript_archive.close()
+        await self.transcript_renderer.close()
+        log.info("Closed the ticket storage")
+
     async def on_ready(self):
         log.info(f"{self.user.display_name} is up and ready to go!")
 
-    async def on_raw_reaction_add(self, payload):
-        log.debug("Parsing a raw reaction add")
-        if not await Ticket.validate_reaction_event(self, payload, ["🔒", "✅"]):
+        # on_ready fires again after reconnects, only the first is start up
+        if self._started_at is not None:
+            log.info("Started up in %.2fs", time.perf_counter() - self._started_at)
+            self._started_at = None
+
+    async def on_shard_ready(self, shard_id):
+        log.info("Shard %s is ready", shard_id)
+
+    async def on_guild_available(self, guild):
+        # Fill the channel pool before anyone needs it
+        config = await self.ticket_db.get_config(guild.id)
+        if config is None or not config.is_configured:
             return
 
-        reaction = str(payload.emoji)
-        if (
-                payload.message_id == await self.ticket_db.get_ticket_setup_message_id()
-                and reaction == "✅"
-        ):
-            log.info("Attempting to create a ticket via reaction.")
-            await Ticket.reaction_create_ticket(self, payload)
+        category = guild.get_channel(config.category_id)
+        if category is not None:
+            self.ticket_channels.refill(category)
 
-        elif reaction == "🔒":
-            # Simply add a tick to the message
-            channel = self.get_channel(payload.channel_id)
-            message = await channel.fetch_message(payload.message_id)
-            await message.add_reaction("✅")
+    async def on_guild_channel_delete(self, channel):
+        self.inactivity_scheduler.forget(channel.id)
+        await self.ticket_reconciler.on_guild_channel_delete(channel)
 
-        elif reaction == "✅":
-            # Time to delete the ticket!
-            log.info("Attempting to close a ticket via reaction.")
-            await Ticket.reaction_close_ticket(self, payload)
+    async def on_message(self, message):
+        await self.message_capture.on_message(message)
+        await self.inactivity_scheduler.on_message(message)
+        await self.process_commands(message)
 
-    async def on_raw_reaction_remove(self, payload):
-        log.debug("Parsing a raw reaction remove")
-        if not await Ticket.validate_reaction_event(self, payload, ["🔒"]):
-            return
+    async def on_raw_message_edit(self, payload):
+        await self.message_capture.on_raw_message_edit(payload)
+
+    async def on_raw_message_delete(self, payload):
+        await self.message_capture.on_raw_message_delete(payload)
 
-        reaction = str(payload.emoji)
-        if reaction == "🔒":
-            # Simply remove a tick from the message
-            guild = bot.get_guild(payload.guild_id)
-            member = await guild.fetch_member(bot.user.id)
+    async def on_raw_bulk_message_delete(self, payload):
+        await self.message_capture.on_raw_bulk_message_delete(payload)
+
+    async def on_raw_reaction_add(self, payload):
+        with metrics.timer("reaction_event_seconds", event="add"):
+            log.debug("Parsing a raw reaction add")
+            if not await Ticket.validate_reaction_event(self, payload, ["🔒", "✅"]):
+                return
+
+            reaction = str(payload.emoji)
+            if (
+                    payload.message_id
+                    == await self.ticket_db.get_ticket_setup_message_id(payload.guild_id)
+                    and reaction == "✅"
+            ):
+                log.info("Attempting to create a ticket via reaction.")
+                await Ticket.reaction_create_ticket(self, payload)
+
+            elif reaction == "🔒":
+                # Simply add a tick to the message, a partial message
+                # is enough to react with and saves fetching it first
+                channel = self.get_channel(payload.channel_id)
+                message = channel.get_partial_message(payload.message_id)
+                await request_scheduler.request(
+                    "add_reaction", message.add_reaction("✅"), major=channel.id
+                )
+
+            elif reaction == "✅":
+                # Time to delete the ticket!
+                log.info("Attempting to close a ticket via reaction.")
+                await Ticket.reaction_close_ticket(self, payload)
 
-            channel = bot.get_channel(payload.channel_id)
-            message = await channel.fetch_message(payload.message_id)
-            await message.remove_reaction("✅", member)
+    async def on_raw_reaction_remove(self, payload):
+        with metrics.timer("reaction_event_seconds", event="remove"):
+            log.debug("Parsing a raw reaction remove")
+            if not await Ticket.validate_reaction_event(self, payload, ["🔒"]):
+                return
+
+            reaction = str(payload.emoji)
+            if reaction == "🔒":
+                # Simply remove a tick from the message
+                guild = self.get_guild(payload.guild_id)
+                channel = self.get_channel(payload.channel_id)
+                message = channel.get_partial_message(payload.message_id)
+                await request_scheduler.request(
+                    "remove_reaction",
+                    message.remove_reaction("✅", guild.me),
+                    major=channel.id,
+                )
 
 
 if __name__ == "__main__":
@@ -116,6 +396,7 @@ if __name__ == "__main__":
 
     @bot.command(name="new", description="Create a new ticket.", usage="[subject]")
     @commands.guild_only()
+    @is_configured()
     async def new(ctx, *, subject=None):
         log.info("Trying to create a new ticket via command.")
         await ctx.ticket.create_ticket(subject=subject)
@@ -128,14 +409,46 @@ if __name__ == "__main__":
     )
     @commands.guild_only()
     @commands.is_owner()
+    @is_configured()
     async def sudonew(ctx, user: discord.Member):
         log.info("Trying to create a new ticket on behalf via command.")
         await ctx.ticket.create_ticket(subject="Sudo Ticket Creation", sudo_author=user)
 
 
+    @bot.command(
+        name="configure",
+        description="Choose where this server's tickets and logs go.",
+        usage="<category> <log channel> <new ticket channel> <staff role>",
+    )
+    @commands.guild_only()
+    @commands.has_guild_permissions(manage_guild=True)
+    async def configure(
+        ctx,
+        category: discord.CategoryChannel,
+        log_channel: discord.TextChannel,
+        new_ticket_channel: discord.TextChannel,
+        staff_role: discord.Role,
+    ):
+        log.info(f"Configuring guild {ctx.guild.id}")
+        await bot.ticket_db.save_config(
+            GuildConfig(
+                ctx.guild.id,
+                category.id,
+                log_channel.id,
+                new_ticket_channel.id,
+                staff_role.id,
+            )
+        )
+        await ctx.send(
+            f"Configured, run `{ctx.prefix}setup` to send the "
+            f"new ticket message to {new_ticket_channel.mention}."
+        )
+
+
     @bot.command(name="setup", description="Initial setup of the bot.")
     @commands.guild_only()
-    @commands.is_owner()
+    @commands.has_guild_permissions(manage_guild=True)
+    @is_configured()
     async def setup(ctx):
         log.info("Setting up the ticket bot.")
         await ctx.ticket.setup_new_ticket_message()
@@ -166,7 +479,7 @@ if __name__ == "__main__":
         usage="<user>",
     )
     @commands.guild_only()
-    @commands.has_role(bot.staff_role_id)
+    @is_staff()
     async def removeuser(ctx, user: discord.Member):
         log.info(f"Attempting to remove {user.display_name} from a ticket.")
         await ctx.ticket.remove_user(user)
@@ -176,7 +489,7 @@ if __name__ == "__main__":
         name="adduser", description="Add a user to this ticket", usage="<user>"
     )
     @commands.guild_only()
-    @commands.has_role(bot.staff_role_id)
+    @is_staff()
     async def adduser(ctx, user: discord.Member):
         log.info(f"Attempted to add {user.display_name} to a ticket")
         await ctx.ticket.add_user(user)
@@ -189,6 +502,58 @@ if __name__ == "__main__":
         await ctx.ticket.close_ticket(reason=reason)
 
 
+    @bot.command(
+        name="transcript",
+        description="Fetch the transcript of a closed ticket.",
+        usage="<ticket id>",
+    )
+    @commands.guild_only()
+    @is_staff()
+    async def transcript(ctx, ticket_id: int):
+        log.info(f"Fetching the transcript for ticket {ticket_id}")
+        text = await bot.transcript_archive.read(ctx.guild.id, ticket_id)
+        if text is None:
+            return await ctx.send(f"There is no transcript for ticket {ticket_id}.")
+
+        file_object = discord.File(
+            io.BytesIO(text.encode("utf8")), filename=f"{ticket_id}.txt"
+        )
+        await ctx.send(file=file_object)
+
+
+    @bot.command(
+        name="search",
+        description="Search the messages of closed tickets.",
+        usage="[from:<user>] [after:YYYY-MM-DD] [before:YYYY-MM-DD] [text]",
+    )
+    @commands.guild_only()
+    @is_staff()
+    async def search(ctx, *, query):
+        log.info(f"Searching tickets for '{query}'")
+        try:
+            query = parse_query(query)
+        except ValueError:
+            return await ctx.send(
+                "Expected `from:` to be a user and dates to look like `2021-12-31`."
+            )
+
+        messages = await bot.ticket_db.search_messages(
+            ctx.guild.id,
+            query.text,
+            author_id=query.author_id,
+            after=query.after,
+            before=query.before,
+            limit=10,
+        )
+        if not messages:
+            return await ctx.send("No messages matched that search.")
+
+        await ctx.send(
+            format_results(messages),
+            allowed_mentions=discord.AllowedMentions.none(),
+        )
+
+
     # <-- Start the bot -->
     with open(bot.cwd + "/bot_config/token.json", "r") as file:
         secret_file = json.load(file)
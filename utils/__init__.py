@@ -1,4 +1,24 @@
+from .archive import ArchiveWriter, TranscriptArchive
+from .capture import MessageCapture
+from .checks import is_configured, is_staff
 from .custom_context import MyContext
-from .db import JsonStore, SqliteStore
+from .html_transcript import TranscriptRenderer
+from .inactivity import InactivityScheduler
+from .log_dispatcher import LogDispatcher
+from .db import CachedStore, GuildConfig, InstrumentedStore, JsonStore, SqliteStore
+from .metrics import Metrics, RateLimitCounter, metrics
 from .reaction_context import ReactionContext, Message
+from .reconcile import TicketReconciler
+from .request_scheduler import (
+    BACKGROUND,
+    GLOBAL_LIMIT,
+    INTERACTIVE,
+    PRIORITIES,
+    ROUTE_LIMITS,
+    RequestScheduler,
+    request_scheduler,
+)
+from .search import SearchQuery, format_results, parse_query
 from .ticket import Ticket
+from .ticket_channels import TicketChannels
+from .ticket_queue import TicketQueue
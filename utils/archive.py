@@ -0,0 +1,429 @@
+import asyncio
+import io
+import logging
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from typing import BinaryIO, Optional
+
+import aiosqlite
+import discord
+
+from .db import LEGACY_GUILD_ID
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+# Discord refuses uploads over 8MB for most guilds
+ATTACHMENT_LIMIT = 8 * 1024 * 1024
+# How much compressed output a writer holds before spilling it to disk
+SPILL_SIZE = 1024 * 1024
+
+
+class _GzipCodec:
+    name = "gzip"
+    extension = "gz"
+
+    @staticmethod
+    def compressor():
+        # wbits=31 produces a standalone gzip member
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return zlib.decompress(data, 31)
+
+
+class _ZstdCodec:
+    name = "zstd"
+    extension = "zst"
+
+    @staticmethod
+    def compressor():
+        return zstandard.ZstdCompressor(level=6).compressobj()
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        # Streamed frames don't record their size, so decompress as a stream
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+CODECS = {"gzip": _GzipCodec}
+if zstandard is not None:
+    CODECS["zstd"] = _ZstdCodec
+
+
+class ArchiveWriter:
+    """Compresses one transcript as it is written.
+
+    Used through ``TranscriptArchive.writer``, the compressed output
+    is spilled to a temporary file every ``SPILL_SIZE`` bytes, then
+    copied into the archive when the writer exits, so memory use
+    doesn't grow with the transcript. The uncompressed text is also
+    kept, up to ``ATTACHMENT_LIMIT``, so it can be uploaded without
+    reading anything back. Past that the temporary file is kept for
+    ``to_file`` instead.
+    """
+
+    def __init__(
+        self,
+        archive: "TranscriptArchive",
+        guild_id: int,
+        ticket_id: int,
+        channel_id: int,
+        author_id: Optional[int],
+    ):
+        self.archive = archive
+        self.guild_id = guild_id
+        self.ticket_id = ticket_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+
+        self.codec = archive.codec
+        self.size = 0
+        self.compressed_size = 0
+
+        self._compressor = self.codec.compressor()
+        self._compressed = bytearray()
+        self._spool: Optional[BinaryIO] = None
+        self._text: Optional[io.BytesIO] = io.BytesIO()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        keep_spool = False
+        try:
+            # Nothing written, nothing to archive
+            if exc_type is not None or not self.size:
+                return
+
+            self._compressed += self._compressor.flush()
+            await self._spill()
+            await self.archive.append(self)
+            # Only needed afterwards if the text was too large to keep
+            keep_spool = self._text is None
+        finally:
+            if self._spool is not None and not keep_spool:
+                self._spool.close()
+                self._spool = None
+
+    async def write(self, line: str) -> None:
+        data = line.encode("utf8")
+        self.size += len(data)
+        self._compressed += self._compressor.compress(data)
+        if len(self._compressed) >= SPILL_SIZE:
+            await self._spill()
+
+        if self._text is not None:
+            if self.size > ATTACHMENT_LIMIT:
+                # Too large to upload as text, the compressed copy is used instead
+                self._text = None
+            else:
+                self._text.write(data)
+
+    @property
+    def attachment_size(self) -> int:
+        """How large ``to_file``'s attachment is, in bytes"""
+        return self.size if self._text is not None else self.compressed_size
+
+    def to_file(self, filename: str) -> discord.File:
+        """The transcript as an attachment, built from memory.
+
+        Transcripts too large to upload as plain text are
+        attached compressed instead.
+        """
+        if self._text is not None:
+            return discord.File(io.BytesIO(self._text.getvalue()), filename=filename)
+
+        # Handed over, uploading closes it and so removes it
+        spool, self._spool = self._spool, None
+        spool.seek(0)
+        return discord.File(spool, filename=f"{filename}.{self.codec.extension}")
+
+    async def _spill(self) -> None:
+        if not self._compressed:
+            return
+
+        chunk = bytes(self._compressed)
+        self._compressed.clear()
+        self.compressed_size += len(chunk)
+        self._spool = await asyncio.get_running_loop().run_in_executor(
+            None, _spill, self._spool, chunk
+        )
+
+
+# noinspection SqlNoDataSourceInspection
+class TranscriptArchive:
+    """Stores closed ticket transcripts as compressed segment files.
+
+    Every transcript is compressed on its own and appended to the
+    current segment, a new segment is started once it grows past
+    ``segment_size``. An index records where each transcript lives
+    so one can be read back without touching any others. Ticket ids
+    are only unique within a guild, so transcripts are keyed by both.
+
+    Parameters
+    ----------
+    directory: str
+        Where to keep the segments and index
+    segment_size: int
+        Roughly how large, in bytes, a segment may grow
+    compression: str
+        ``zstd`` or ``gzip``, defaults to zstd if it is installed
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        segment_size: int = 64 * 1024 * 1024,
+        compression: str = None,
+    ):
+        self.directory = directory
+        self.segment_size = segment_size
+
+        compression = compression or ("zstd" if "zstd" in CODECS else "gzip")
+        if compression not in CODECS:
+            raise RuntimeError(f"Compression '{compression}' is not available")
+        self.codec = CODECS[compression]
+
+        self.is_initialized = False
+        self._connection: Optional[aiosqlite.Connection] = None
+        self._initialize_lock = asyncio.Lock()
+        self._append_lock = asyncio.Lock()
+        self._segment = 0
+
+    async def initialize(self):
+        if self.is_initialized:
+            return
+
+        async with self._initialize_lock:
+            if self.is_initialized:
+                return
+
+            os.makedirs(self.directory, exist_ok=True)
+            db = await aiosqlite.connect(os.path.join(self.directory, "index.db"))
+            await db.execute("PRAGMA journal_mode=WAL")
+            await self._migrate(db)
+
+            rows = await db.execute_fetchall("SELECT MAX(segment) FROM transcripts")
+            self._segment = rows[0][0] or 0
+
+            self._connection = db
+            self.is_initialized = True
+
+    @staticmethod
+    async def _migrate(db: aiosqlite.Connection) -> None:
+        rows = await db.execute_fetchall("PRAGMA user_version")
+        if rows[0][0] >= 1:
+            return
+
+        # Indexes written before guilds were tracked are keyed by
+        # ticket id alone, their transcripts go to LEGACY_GUILD_ID
+        await db.execute("BEGIN")
+        try:
+            rows = await db.execute_fetchall(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='transcripts'"
+            )
+            has_legacy = bool(rows)
+            if has_legacy:
+                await db.execute("ALTER TABLE transcripts RENAME TO legacy_transcripts")
+
+            await db.execute(
+                """
+                CREATE TABLE transcripts (
+                    guild_id INTEGER NOT NULL,
+                    ticket_id INTEGER NOT NULL,
+                    channel_id INTEGER NOT NULL,
+                    author_id INTEGER,
+                    segment INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    compression TEXT NOT NULL,
+                    closed_at REAL NOT NULL,
+                    PRIMARY KEY (guild_id, ticket_id)
+                )
+                """
+            )
+            if has_legacy:
+                await db.execute(
+                    "INSERT INTO transcripts SELECT :guild_id, * FROM legacy_transcripts",
+                    {"guild_id": LEGACY_GUILD_ID},
+                )
+                await db.execute("DROP TABLE legacy_transcripts")
+
+            await db.execute(
+                "CREATE INDEX transcripts_channel_id ON transcripts (channel_id)"
+            )
+            await db.execute(
+                "CREATE INDEX transcripts_author_id ON transcripts (guild_id, author_id)"
+            )
+            await db.execute("PRAGMA user_version = 1")
+        except Exception:
+            await db.rollback()
+            raise
+
+        await db.commit()
+
+    async def close(self):
+        if self._connection is None:
+            return
+
+        await self._connection.close()
+        self._connection = None
+        self.is_initialized = False
+
+    async def claim_legacy_data(self, guild_id: int) -> bool:
+        """Assigns transcripts archived before guilds were tracked to this guild.
+
+        Returns whether there were any.
+        """
+        await self.initialize()
+
+        rows = await self._connection.execute_fetchall(
+            "SELECT 1 FROM transcripts WHERE guild_id=:legacy_guild_id LIMIT 1",
+            {"legacy_guild_id": LEGACY_GUILD_ID},
+        )
+        if not rows:
+            return False
+
+        # Any the guild already has an archive for stay where they are
+        await self._connection.execute(
+            "UPDATE OR IGNORE transcripts SET guild_id=:guild_id WHERE guild_id=:legacy_guild_id",
+            {"guild_id": guild_id, "legacy_guild_id": LEGACY_GUILD_ID},
+        )
+        await self._connection.commit()
+        return True
+
+    def writer(
+        self, guild_id: int, ticket_id: int, channel_id: int, author_id: int = None
+    ) -> ArchiveWriter:
+        """Start archiving a transcript.
+
+        Parameters
+        ----------
+        guild_id: int
+        ticket_id: int
+        channel_id: int
+        author_id: int
+            Who opened the ticket
+
+        Returns
+        -------
+        ArchiveWriter
+            Use as an async context manager, write transcript lines to it
+        """
+        return ArchiveWriter(self, guild_id, ticket_id, channel_id, author_id)
+
+    async def append(self, writer: ArchiveWriter) -> None:
+        await self.initialize()
+
+        length = writer.compressed_size
+        loop = asyncio.get_running_loop()
+
+        # Appends must not interleave, or offsets would be wrong
+        async with self._append_lock:
+            path = self._segment_path(self._segment)
+            current_size = await loop.run_in_executor(None, _file_size, path)
+            if current_size and current_size + length > self.segment_size:
+                self._segment += 1
+                path = self._segment_path(self._segment)
+
+            offset = await loop.run_in_executor(None, _append, path, writer._spool)
+
+            await self._connection.execute(
+                """
+                INSERT OR REPLACE INTO transcripts
+                VALUES (:guild_id, :ticket_id, :channel_id, :author_id, :segment,
+                        :offset, :length, :size, :compression, :closed_at)
+                """,
+                {
+                    "guild_id": writer.guild_id,
+                    "ticket_id": writer.ticket_id,
+                    "channel_id": writer.channel_id,
+                    "author_id": writer.author_id,
+                    "segment": self._segment,
+                    "offset": offset,
+                    "length": length,
+                    "size": writer.size,
+                    "compression": writer.codec.name,
+                    "closed_at": time.time(),
+                },
+            )
+            await self._connection.commit()
+
+        log.debug(
+            "Archived ticket %s, %s bytes compressed to %s",
+            writer.ticket_id,
+            writer.size,
+            length,
+        )
+
+    async def read(self, guild_id: int, ticket_id: int) -> Optional[str]:
+        """Read back a single ticket's transcript, or None if it isn't archived."""
+        await self.initialize()
+
+        rows = await self._connection.execute_fetchall(
+            """
+            SELECT segment, offset, length, compression FROM transcripts
+            WHERE guild_id=:guild_id AND ticket_id=:ticket_id
+            """,
+            {"guild_id": guild_id, "ticket_id": ticket_id},
+        )
+        if not rows:
+            return None
+
+        segment, offset, length, compression = rows[0]
+        if compression not in CODECS:
+            raise RuntimeError(
+                f"Ticket {ticket_id} was archived with {compression}, which is not installed"
+            )
+
+        data = await asyncio.get_running_loop().run_in_executor(
+            None, _read, self._segment_path(segment, CODECS[compression]), offset, length
+        )
+        return CODECS[compression].decompress(data).decode("utf8")
+
+    def _segment_path(self, segment: int, codec=None) -> str:
+        codec = codec or self.codec
+        return os.path.join(self.directory, f"segment-{segment:05}.{codec.extension}")
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _spill(spool: Optional[BinaryIO], chunk: bytes) -> BinaryIO:
+    if spool is None:
+        spool = tempfile.TemporaryFile()
+
+    spool.write(chunk)
+    return spool
+
+
+def _append(path: str, spool: BinaryIO) -> int:
+    with open(path, "ab") as file:
+        offset = file.tell()
+        spool.seek(0)
+        shutil.copyfileobj(spool, file)
+        file.flush()
+        os.fsync(file.fileno())
+
+    return offset
+
+
+def _read(path: str, offset: int, length: int) -> bytes:
+    with open(path, "rb") as file:
+        file.seek(offset)
+        return file.read(length)
@@ -0,0 +1,150 @@
+import asyncio
+import datetime
+import logging
+import time
+from typing import Dict, Set, Tuple
+
+import discord
+
+from .db import Base, MessageRecord
+from .debounce import DebouncedFlusher
+from .metrics import metrics
+from .transcript import edited_message, message_record
+
+log = logging.getLogger(__name__)
+
+
+class MessageCapture:
+    """Saves the messages sent in ticket channels as they happen.
+
+    New messages, edits and deletions are buffered and written to
+    the store together, ``flush_delay`` seconds after the first of
+    them or as soon as ``batch_size`` are waiting. Closing a ticket
+    then only needs to ``flush`` and read back what was captured.
+
+    Parameters
+    ----------
+    db: Base
+        The store to save messages to
+    flush_delay: float
+        Seconds to wait for more changes before writing
+    batch_size: int
+        Write straight away once this many changes are waiting
+    """
+
+    def __init__(self, db: Base, *, flush_delay: float = 1.0, batch_size: int = 200):
+        self.db = db
+        self.flush_delay = flush_delay
+        self.batch_size = batch_size
+
+        self._messages: Dict[int, MessageRecord] = {}
+        # message_id -> (content, edited_at, attachments, embeds)
+        self._edits: Dict[int, Tuple[str, float, tuple, tuple]] = {}
+        self._deletes: Set[int] = set()
+
+        self._flusher = DebouncedFlusher(self.flush, flush_delay, name="captured messages")
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def pending(self) -> int:
+        return len(self._messages) + len(self._edits) + len(self._deletes)
+
+    def add(self, message: discord.Message, ticket_id: int) -> None:
+        """Capture a message already known to be in a ticket."""
+        self._messages[message.id] = message_record(message, ticket_id)
+        self._mark_dirty()
+
+    async def on_message(self, message: discord.Message) -> None:
+        ticket = await self.db.get_ticket(message.channel.id)
+        if ticket is None:
+            return
+
+        self.add(message, ticket.ticket_id)
+
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent) -> None:
+        # Discord also sends updates for things like embeds
+        # loading, those carry no content and are not edits
+        if "content" not in payload.data:
+            return
+
+        if not await self.db.check_is_ticket(payload.channel_id):
+            return
+
+        content, attachments, embeds = edited_message(payload.data)
+        edited_at = self._edited_at(payload.data)
+
+        pending = self._messages.get(payload.message_id)
+        if pending is not None:
+            self._messages[payload.message_id] = pending._replace(
+                content=content, edited_at=edited_at, attachments=attachments, embeds=embeds
+            )
+        else:
+            self._edits[payload.message_id] = (content, edited_at, attachments, embeds)
+
+        self._mark_dirty()
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent) -> None:
+        await self._delete(payload.channel_id, {payload.message_id})
+
+    async def on_raw_bulk_message_delete(
+        self, payload: discord.RawBulkMessageDeleteEvent
+    ) -> None:
+        await self._delete(payload.channel_id, payload.message_ids)
+
+    async def flush(self) -> None:
+        """Write everything captured so far to the store now."""
+        async with self._flush_lock:
+            if not self.pending:
+                return
+
+            messages, edits, deletes = self._messages, self._edits, self._deletes
+            self._messages, self._edits, self._deletes = {}, {}, set()
+
+            # In this order, as edits and deletions may
+            # refer to messages saved in the same batch
+            with metrics.timer("message_capture_seconds"):
+                try:
+                    if messages:
+                        await self.db.save_messages(messages.values())
+                    if edits:
+                        await self.db.edit_messages(
+                            (message_id, *edit) for message_id, edit in edits.items()
+                        )
+                    if deletes:
+                        await self.db.delete_messages(deletes)
+                except Exception:
+                    # Put them back so the next flush tries again, anything
+                    # captured in the meantime is newer and so takes priority
+                    self._messages = {**messages, **self._messages}
+                    self._edits = {**edits, **self._edits}
+                    self._deletes |= deletes
+                    raise
+
+            metrics.increment("messages_captured_total", len(messages))
+
+    async def close(self) -> None:
+        await self._flusher.cancel()
+        await self.flush()
+
+    async def _delete(self, channel_id: int, message_ids: Set[int]) -> None:
+        if not await self.db.check_is_ticket(channel_id):
+            return
+
+        for message_id in message_ids:
+            pending = self._messages.get(message_id)
+            if pending is not None:
+                self._messages[message_id] = pending._replace(deleted=True)
+            else:
+                self._deletes.add(message_id)
+
+        self._mark_dirty()
+
+    def _mark_dirty(self) -> None:
+        self._flusher.schedule(now=self.pending >= self.batch_size)
+
+    @staticmethod
+    def _edited_at(data: dict) -> float:
+        try:
+            return datetime.datetime.fromisoformat(data["edited_timestamp"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return time.time()
@@ -0,0 +1,34 @@
+import discord
+from discord.ext import commands
+
+
+def is_configured():
+    """A command check that the guild has been set up with ``configure``."""
+
+    async def predicate(ctx):
+        config = await ctx.bot.ticket_db.get_config(ctx.guild.id)
+        if config is None or not config.is_configured:
+            raise commands.CheckFailure(
+                "This server has not been set up yet, someone with "
+                "Manage Server needs to run the `configure` command."
+            )
+
+        return True
+
+    return commands.check(predicate)
+
+
+def is_staff():
+    """Like ``commands.has_role``, for the guild's configured staff role."""
+
+    async def predicate(ctx):
+        config = await ctx.bot.ticket_db.get_config(ctx.guild.id)
+        if config is None or config.staff_role_id is None:
+            raise commands.CheckFailure("This server has no staff role configured.")
+
+        if discord.utils.get(ctx.author.roles, id=config.staff_role_id) is None:
+            raise commands.MissingRole(config.staff_role_id)
+
+        return True
+
+    return commands.check(predicate)
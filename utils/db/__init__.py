@@ -1,3 +1,5 @@
-from .base import Base
+from .base import LEGACY_GUILD_ID, Base, GuildConfig, MessageRecord, TicketRecord
+from .cached_store import CachedStore
+from .instrumented_store import InstrumentedStore
 from .json_store import JsonStore
 from .sqlite_store import SqliteStore
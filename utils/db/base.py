@@ -1,8 +1,80 @@
-from typing import Protocol, Union
+from typing import (
+    AsyncIterator,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Protocol,
+    Tuple,
+    Union,
+)
+
+
+class TicketRecord(NamedTuple):
+    """A single stored ticket"""
+
+    channel_id: int
+    ticket_id: int
+    reaction_message_id: Optional[int]
+    author_id: Optional[int] = None
+    guild_id: Optional[int] = None
+    # Unix timestamps, used to close tickets left inactive
+    last_active_at: Optional[float] = None
+    warned_at: Optional[float] = None
+
+
+class MessageRecord(NamedTuple):
+    """A single message from a ticket's transcript"""
+
+    message_id: int
+    ticket_id: int
+    channel_id: int
+    author_id: int
+    author_name: str
+    # Unix timestamps
+    created_at: float
+    content: str
+    edited_at: Optional[float] = None
+    deleted: bool = False
+    guild_id: Optional[int] = None
+    # (filename, size, url) and (title, description) of each, also
+    # kept as lines of the content so they are searched with the text
+    attachments: Tuple[Tuple[str, int, str], ...] = ()
+    embeds: Tuple[Tuple[str, str], ...] = ()
+
+
+class GuildConfig(NamedTuple):
+    """How the bot is set up in a single guild"""
+
+    guild_id: int
+    category_id: Optional[int] = None
+    log_channel_id: Optional[int] = None
+    new_ticket_channel_id: Optional[int] = None
+    staff_role_id: Optional[int] = None
+    # Set by save_new_ticket_message rather than save_config
+    ticket_setup_message_id: Optional[int] = None
+
+    @property
+    def is_configured(self) -> bool:
+        return None not in (
+            self.category_id,
+            self.log_channel_id,
+            self.new_ticket_channel_id,
+            self.staff_role_id,
+        )
+
+
+# Data stored before guilds were tracked belongs to this guild id
+LEGACY_GUILD_ID = 0
 
 
 class Base(Protocol):
-    """An implicit interface for a ticket's underlying database"""
+    """An implicit interface for a ticket's underlying database
+
+    Ticket ids, counters and configuration are per guild.
+    Channel and message ids are unique across all of Discord,
+    so anything looked up by them needs no guild.
+    """
 
     async def check_is_ticket(self, channel_id: Union[str, int]):
         raise NotImplementedError
@@ -10,37 +82,136 @@ class Base(Protocol):
     async def check_message_is_reaction_message(self, message_id: Union[str, int]):
         raise NotImplementedError
 
-    async def get_next_ticket_id(self):
+    async def claim_legacy_data(self, guild_id: int) -> bool:
+        """Assigns everything stored before guilds were tracked to this guild
+
+        Returns whether there was anything to assign.
+        """
+        raise NotImplementedError
+
+    async def get_next_ticket_id(self, guild_id: int):
+        """Atomically increments the guild's ticket count and returns the new value"""
+        raise NotImplementedError
+
+    async def close(self):
         raise NotImplementedError
 
     async def create_ticket(
         self,
+        guild_id: int,
         channel_id: Union[str, int],
         ticket_id: int,
         reaction_message_id: Union[str, int],
+        author_id: Union[str, int] = None,
     ):
         raise NotImplementedError
 
-    async def decrement_ticket_count(self):
+    async def decrement_ticket_count(self, guild_id: int):
         raise NotImplementedError
 
-    async def get_config(self):
+    async def delete_messages(self, message_ids: Iterable[int]):
+        """Marks stored messages as deleted, they are kept for the transcript"""
+        raise NotImplementedError
+
+    async def edit_messages(self, edits: Iterable[Tuple[int, str, float, tuple, tuple]]):
+        """Replaces the content of stored messages
+
+        Given (message_id, content, edited_at, attachments, embeds).
+        """
         raise NotImplementedError
 
-    async def get_ticket_count(self):
+    async def get_config(self, guild_id: int) -> Optional[GuildConfig]:
+        """Returns the guild's configuration, or None if it has none"""
+        raise NotImplementedError
+
+    async def get_ticket_count(self, guild_id: int):
+        raise NotImplementedError
+
+    async def get_ticket(self, channel_id: Union[str, int]) -> Optional[TicketRecord]:
+        """Returns everything stored about the ticket in this channel, or None"""
         raise NotImplementedError
 
     async def get_ticket_id(self, channel_id: Union[str, int]):
         raise NotImplementedError
 
-    async def get_ticket_setup_message_id(self):
+    async def get_ticket_setup_message_id(self, guild_id: int):
+        raise NotImplementedError
+
+    async def get_user_ticket(self, guild_id: int, user_id: Union[str, int]):
+        """Returns the channel id of a ticket opened by this user in the guild, or None"""
         raise NotImplementedError
 
-    async def increment_ticket_count(self):
+    async def import_guilds(self, guilds: Iterable[Tuple[GuildConfig, int]]):
+        """Stores many guilds at once, given (config, ticket_count)
+
+        Anything already stored for those guilds is replaced,
+        including the setup message and the ticket count.
+        """
+        raise NotImplementedError
+
+    async def import_tickets(self, tickets: Iterable[TicketRecord]):
+        """Stores many tickets at once, replacing any in the same channel"""
+        raise NotImplementedError
+
+    async def increment_ticket_count(self, guild_id: int):
+        raise NotImplementedError
+
+    async def initialize(self):
+        raise NotImplementedError
+
+    def iter_configs(self) -> AsyncIterator[GuildConfig]:
+        """Yields the configuration of every guild"""
+        raise NotImplementedError
+
+    def iter_messages(self, channel_id: Union[str, int]) -> AsyncIterator[MessageRecord]:
+        """Yields every stored message for a ticket's channel, oldest first"""
+        raise NotImplementedError
+
+    def iter_tickets(self) -> AsyncIterator[TicketRecord]:
+        """Yields a TicketRecord for every stored ticket"""
         raise NotImplementedError
 
     async def remove_ticket(self, channel_id: Union[str, int]):
         raise NotImplementedError
 
-    async def save_new_ticket_message(self, message_id: int):
+    async def remove_tickets(self, channel_ids: Iterable[Union[str, int]]):
+        """Removes many tickets at once, ignoring any that aren't stored"""
+        raise NotImplementedError
+
+    async def save_config(self, config: GuildConfig):
+        """Creates or replaces a guild's configuration, keeping its setup message"""
+        raise NotImplementedError
+
+    async def save_messages(self, messages: Iterable[MessageRecord]):
+        """Stores transcript messages for searching, replacing any with the same id"""
+        raise NotImplementedError
+
+    async def save_new_ticket_message(self, guild_id: int, message_id: int):
+        raise NotImplementedError
+
+    async def save_ticket_activity(
+        self, activity: Iterable[Tuple[int, float, Optional[float]]]
+    ):
+        """Records when tickets were last active and warned about it
+
+        Given (channel_id, last_active_at, warned_at), ignoring any
+        tickets that aren't stored.
+        """
+        raise NotImplementedError
+
+    async def search_messages(
+        self,
+        guild_id: int,
+        text: str = None,
+        *,
+        author_id: Union[str, int] = None,
+        after: float = None,
+        before: float = None,
+        limit: int = 25,
+    ) -> List[MessageRecord]:
+        """Returns the guild's newest stored messages matching every filter given
+
+        Only messages from closed tickets, that weren't deleted, are
+        searched. ``after`` and ``before`` are unix timestamps.
+        """
         raise NotImplementedError
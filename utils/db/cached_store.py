@@ -0,0 +1,327 @@
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from .base import Base, GuildConfig, MessageRecord, TicketRecord
+from ..metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class CachedStore(Base):
+    """
+    A write-through cache that implements the Base class interface
+
+    Wraps another store and keeps the ticket index and every
+    guild's configuration in memory so that the lookups done on
+    every reaction never touch the underlying storage. All writes
+    go to the wrapped store first and are only reflected in memory
+    once they succeed.
+
+    Parameters
+    ----------
+    store: Base
+        The store to cache, this remains the source of truth
+    """
+
+    def __init__(self, store: Base):
+        self.store = store
+
+        self._tickets: Dict[int, TicketRecord] = {}
+        # reaction_message_id -> channel_id
+        self._reaction_messages: Dict[int, int] = {}
+        # (guild_id, author_id) -> channel_id
+        self._user_tickets: Dict[Tuple[int, int], int] = {}
+        self._configs: Dict[int, GuildConfig] = {}
+        self._setup_messages: Set[int] = set()
+
+        self.is_initialized = False
+        self._initialize_lock = asyncio.Lock()
+
+        log.info("Initialised CachedStore around %s", type(store).__name__)
+
+    async def initialize(self):
+        if self.is_initialized:
+            return
+
+        async with self._initialize_lock:
+            if self.is_initialized:
+                return
+
+            await self.store.initialize()
+            await self._load()
+
+            self.is_initialized = True
+            log.info(
+                "Cached %s tickets across %s guilds",
+                len(self._tickets),
+                len(self._configs),
+            )
+
+    async def close(self):
+        await self.store.close()
+
+    async def check_is_ticket(self, channel_id: Union[str, int]):
+        await self.initialize()
+
+        metrics.increment("cache_hits_total", method="check_is_ticket")
+        return self._as_id(channel_id) in self._tickets
+
+    async def check_message_is_reaction_message(self, message_id: Union[str, int]):
+        await self.initialize()
+
+        metrics.increment("cache_hits_total", method="check_message_is_reaction_message")
+        message_id = self._as_id(message_id)
+        if message_id in self._setup_messages:
+            return True
+
+        return message_id in self._reaction_messages
+
+    async def claim_legacy_data(self, guild_id: int) -> bool:
+        await self.initialize()
+
+        if not await self.store.claim_legacy_data(guild_id):
+            return False
+
+        # Rare enough that reloading beats patching every cached record
+        await self._load()
+        return True
+
+    async def create_ticket(
+        self,
+        guild_id: int,
+        channel_id: Union[str, int],
+        ticket_id: int,
+        reaction_message_id: Union[str, int],
+        author_id: Union[str, int] = None,
+    ):
+        await self.initialize()
+
+        await self.store.create_ticket(
+            guild_id, channel_id, ticket_id, reaction_message_id, author_id
+        )
+        self._cache_ticket(
+            channel_id, ticket_id, reaction_message_id, author_id, guild_id
+        )
+
+    async def decrement_ticket_count(self, guild_id: int):
+        await self.store.decrement_ticket_count(guild_id)
+
+    async def delete_messages(self, message_ids: Iterable[int]):
+        await self.store.delete_messages(message_ids)
+
+    async def edit_messages(self, edits: Iterable[Tuple[int, str, float, tuple, tuple]]):
+        await self.store.edit_messages(edits)
+
+    async def get_config(self, guild_id: int):
+        await self.initialize()
+
+        metrics.increment("cache_hits_total", method="get_config")
+        return self._configs.get(self._as_id(guild_id))
+
+    async def get_next_ticket_id(self, guild_id: int):
+        return await self.store.get_next_ticket_id(guild_id)
+
+    async def get_ticket_count(self, guild_id: int):
+        return await self.store.get_ticket_count(guild_id)
+
+    async def get_ticket(self, channel_id: Union[str, int]):
+        await self.initialize()
+
+        metrics.increment("cache_hits_total", method="get_ticket")
+        return self._tickets.get(self._as_id(channel_id))
+
+    async def get_ticket_id(self, channel_id: Union[str, int]):
+        await self.initialize()
+
+        metrics.increment("cache_hits_total", method="get_ticket_id")
+        ticket = self._tickets.get(self._as_id(channel_id))
+        if ticket is None:
+            return None
+
+        return ticket.ticket_id
+
+    async def get_ticket_setup_message_id(self, guild_id: int):
+        await self.initialize()
+
+        metrics.increment("cache_hits_total", method="get_ticket_setup_message_id")
+        config = self._configs.get(self._as_id(guild_id))
+        if config is None:
+            return None
+
+        return config.ticket_setup_message_id
+
+    async def get_user_ticket(self, guild_id: int, user_id: Union[str, int]):
+        await self.initialize()
+
+        metrics.increment("cache_hits_total", method="get_user_ticket")
+        return self._user_tickets.get((self._as_id(guild_id), self._as_id(user_id)))
+
+    async def import_guilds(self, guilds: Iterable[Tuple[GuildConfig, int]]):
+        await self.initialize()
+
+        guilds = list(guilds)
+        await self.store.import_guilds(guilds)
+        for config, _ in guilds:
+            current = self._configs.get(config.guild_id)
+            if current is not None:
+                self._setup_messages.discard(current.ticket_setup_message_id)
+
+            self._configs[config.guild_id] = config
+            if config.ticket_setup_message_id is not None:
+                self._setup_messages.add(config.ticket_setup_message_id)
+
+    async def import_tickets(self, tickets: Iterable[TicketRecord]):
+        await self.initialize()
+
+        tickets = list(tickets)
+        await self.store.import_tickets(tickets)
+        # Any they replace are forgotten first
+        await self._uncache_tickets(ticket.channel_id for ticket in tickets)
+        for ticket in tickets:
+            self._cache_ticket(*ticket)
+
+    async def increment_ticket_count(self, guild_id: int):
+        await self.store.increment_ticket_count(guild_id)
+
+    async def iter_configs(self):
+        await self.initialize()
+
+        for config in list(self._configs.values()):
+            yield config
+
+    def iter_messages(self, channel_id: Union[str, int]):
+        return self.store.iter_messages(channel_id)
+
+    def iter_tickets(self):
+        return self.store.iter_tickets()
+
+    async def remove_ticket(self, channel_id: Union[str, int]):
+        await self.initialize()
+
+        await self.store.remove_ticket(channel_id)
+        await self._uncache_tickets([channel_id])
+
+    async def remove_tickets(self, channel_ids: Iterable[Union[str, int]]):
+        await self.initialize()
+
+        channel_ids = list(channel_ids)
+        await self.store.remove_tickets(channel_ids)
+        await self._uncache_tickets(channel_ids)
+
+    async def save_messages(self, messages: Iterable[MessageRecord]):
+        await self.store.save_messages(messages)
+
+    async def save_config(self, config: GuildConfig):
+        await self.initialize()
+
+        await self.store.save_config(config)
+        # The setup message is only ever changed by save_new_ticket_message
+        current = self._configs.get(config.guild_id)
+        self._configs[config.guild_id] = config._replace(
+            ticket_setup_message_id=current.ticket_setup_message_id if current else None
+        )
+
+    async def save_new_ticket_message(self, guild_id: int, message_id: int):
+        await self.initialize()
+
+        await self.store.save_new_ticket_message(guild_id, message_id)
+        guild_id = self._as_id(guild_id)
+        current = self._configs.get(guild_id) or GuildConfig(guild_id)
+        self._setup_messages.discard(current.ticket_setup_message_id)
+        self._configs[guild_id] = current._replace(
+            ticket_setup_message_id=self._as_id(message_id)
+        )
+        self._setup_messages.add(self._as_id(message_id))
+
+    async def save_ticket_activity(
+        self, activity: Iterable[Tuple[int, float, Optional[float]]]
+    ):
+        await self.initialize()
+
+        activity = list(activity)
+        await self.store.save_ticket_activity(activity)
+        for channel_id, last_active_at, warned_at in activity:
+            ticket = self._tickets.get(self._as_id(channel_id))
+            if ticket is not None:
+                self._tickets[ticket.channel_id] = ticket._replace(
+                    last_active_at=last_active_at, warned_at=warned_at
+                )
+
+    async def search_messages(
+        self, guild_id: int, text: str = None, **filters
+    ) -> List[MessageRecord]:
+        return await self.store.search_messages(guild_id, text, **filters)
+
+    async def _load(self) -> None:
+        self._tickets.clear()
+        self._reaction_messages.clear()
+        self._user_tickets.clear()
+        self._configs.clear()
+        self._setup_messages.clear()
+
+        async for ticket in self.store.iter_tickets():
+            self._cache_ticket(*ticket)
+
+        async for config in self.store.iter_configs():
+            self._configs[config.guild_id] = config
+            if config.ticket_setup_message_id is not None:
+                self._setup_messages.add(config.ticket_setup_message_id)
+
+    def _cache_ticket(
+        self,
+        channel_id,
+        ticket_id,
+        reaction_message_id,
+        author_id=None,
+        guild_id=None,
+        last_active_at=None,
+        warned_at=None,
+    ) -> None:
+        ticket = TicketRecord(
+            self._as_id(channel_id),
+            ticket_id,
+            self._as_id(reaction_message_id),
+            self._as_id(author_id),
+            self._as_id(guild_id),
+            last_active_at,
+            warned_at,
+        )
+
+        self._tickets[ticket.channel_id] = ticket
+        if ticket.reaction_message_id is not None:
+            self._reaction_messages[ticket.reaction_message_id] = ticket.channel_id
+        if ticket.author_id is not None:
+            self._user_tickets[(ticket.guild_id, ticket.author_id)] = ticket.channel_id
+
+    async def _uncache_tickets(self, channel_ids: Iterable[Union[str, int]]) -> None:
+        # (guild_id, user_id) of users whose cached ticket was removed
+        users = set()
+        for channel_id in channel_ids:
+            ticket = self._tickets.pop(self._as_id(channel_id), None)
+            if ticket is None:
+                continue
+
+            self._reaction_messages.pop(ticket.reaction_message_id, None)
+            key = (ticket.guild_id, ticket.author_id)
+            if self._user_tickets.get(key) == ticket.channel_id:
+                self._user_tickets.pop(key)
+                users.add(key)
+
+        # A user may have more than one ticket open, if
+        # one_ticket_per_user was turned on after they opened them
+        for guild_id, user_id in users:
+            channel_id = await self.store.get_user_ticket(guild_id, user_id)
+            if channel_id is not None:
+                # Unless they opened another in the meantime
+                self._user_tickets.setdefault((guild_id, user_id), self._as_id(channel_id))
+
+    @staticmethod
+    def _as_id(value) -> Optional[int]:
+        if value is None:
+            return None
+
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
@@ -0,0 +1,43 @@
+import functools
+import inspect
+import logging
+
+from ..metrics import Metrics
+
+log = logging.getLogger(__name__)
+
+
+class InstrumentedStore:
+    """
+    Times every call to another store, implementing the Base class interface
+
+    Each coroutine method of the wrapped store is recorded in the
+    ``store_seconds`` metric, labelled with the method's name.
+
+    Parameters
+    ----------
+    store: Base
+        The store to time
+    metrics: Metrics
+        Where to record the timings
+    """
+
+    def __init__(self, store, metrics: Metrics):
+        self.store = store
+        self.metrics = metrics
+
+        log.info("Initialised InstrumentedStore around %s", type(store).__name__)
+
+    def __getattr__(self, name):
+        attr = getattr(self.store, name)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def timed(*args, **kwargs):
+            with self.metrics.timer("store_seconds", method=name):
+                return await attr(*args, **kwargs)
+
+        # Only build the wrapper once per method
+        setattr(self, name, timed)
+        return timed
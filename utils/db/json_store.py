@@ -1,18 +1,62 @@
+import asyncio
 import json
 import logging
+import os
+import tempfile
 from pathlib import Path
-from typing import Union
+from typing import Iterable, List, Optional, Set, Tuple, Union
+
+from .base import LEGACY_GUILD_ID, GuildConfig, MessageRecord, TicketRecord
+from ..debounce import DebouncedFlusher
 
 log = logging.getLogger(__name__)
 
 
 # noinspection DuplicatedCode
 class JsonStore:
-    """A database class that implements the Base class interface"""
+    """A database class that implements the Base class interface
+
+    The file is read once and served from memory afterwards. Changes
+    are written back by a background flush which waits ``flush_delay``
+    seconds so that bursts of changes result in a single write. The
+    write happens in a worker thread, via a temporary file which then
+    replaces the original so a crash can never leave it half written.
+
+    File format (version 3)
+    -----------------------
+    - version: int
+    - guilds: {guild_id: {"ticket_count": int, "ticket_setup_message_id": int,
+      "category_id": int, "log_channel_id": int, "new_ticket_channel_id": int,
+      "staff_role_id": int}}
+    - tickets: {channel_id: {"id": int, "reaction_message_id": int,
+      "author_id": int, "guild_id": int, "last_active_at": float,
+      "warned_at": float}}
+    - reaction_messages: {reaction_message_id: channel_id}
+
+    Files written in an older format are upgraded on load, anything
+    stored before guilds were tracked belongs to LEGACY_GUILD_ID.
+    A ``read_only`` store keeps any changes, the upgrade included,
+    in memory and never writes the file.
+    """
 
-    __slots__ = ("cwd", "storage_path")
+    FORMAT_VERSION = 3
 
-    def __init__(self, storage_path="/"):
+    __slots__ = (
+        "cwd",
+        "storage_path",
+        "flush_delay",
+        "read_only",
+        "_data",
+        "_setup_messages",
+        "_dirty",
+        "_flusher",
+        "_flush_lock",
+        "_initialize_lock",
+    )
+
+    def __init__(
+        self, storage_path="/", *, flush_delay: float = 1.0, read_only: bool = False
+    ):
         self.cwd = str(Path(__file__).parents[2])
 
         if not storage_path.startswith("/") or not storage_path.endswith("/"):
@@ -20,100 +64,471 @@ class JsonStore:
                 "Expected a valid storage path string (Start and end with /)"
             )
         self.storage_path = storage_path
+        self.flush_delay = flush_delay
+        self.read_only = read_only
+
+        self._data: Optional[dict] = None
+        # Every guild's ticket_setup_message_id, as the strings
+        # reaction_messages is keyed by, rebuilt when one changes
+        self._setup_messages: Set[str] = set()
+        self._dirty = False
+        self._flusher = DebouncedFlusher(self.flush, flush_delay, name=self.__path)
+        self._flush_lock = asyncio.Lock()
+        self._initialize_lock = asyncio.Lock()
 
         log.info("Initialised JsonStore")
 
+    @property
+    def is_initialized(self) -> bool:
+        return self._data is not None
+
     async def check_is_ticket(self, channel_id: Union[str, int]):
-        return str(channel_id) in await self.get_config()
+        await self.initialize()
+
+        return str(channel_id) in self._data["tickets"]
 
     async def check_message_is_reaction_message(self, message_id: Union[str, int]):
-        data = await self.get_config()
-        try:
-            if data["ticket_setup_message_id"] == message_id:
-                return True
+        await self.initialize()
 
-            data.pop("ticket_count")
-            data.pop("ticket_setup_message_id")
+        message_id = str(message_id)
+        return (
+            message_id in self._setup_messages
+            or message_id in self._data["reaction_messages"]
+        )
 
-            for v in data.values():
-                if message_id == v.get("reaction_message_id"):
-                    return True
+    async def claim_legacy_data(self, guild_id: int) -> bool:
+        await self.initialize()
 
+        # Run on every start, there is usually nothing left to claim
+        # and so no reason to rewrite the file
+        tickets = [
+            ticket
+            for ticket in self._data["tickets"].values()
+            if ticket.get("guild_id", LEGACY_GUILD_ID) == LEGACY_GUILD_ID
+        ]
+        if str(LEGACY_GUILD_ID) not in self._data["guilds"] and not tickets:
             return False
-        except KeyError:
-            log.warning("You should run the `setup` command in discord before making tickets.")
-            return False
+
+        legacy = self._data["guilds"].pop(str(LEGACY_GUILD_ID), None)
+        if legacy is not None:
+            # Only if the guild has no counters of its own yet
+            self._data["guilds"].setdefault(str(guild_id), legacy)
+
+        for ticket in tickets:
+            ticket["guild_id"] = int(guild_id)
+
+        self._index_setup_messages()
+        self._mark_dirty()
+        return True
+
+    async def close(self):
+        await self._flusher.cancel()
+        await self.flush()
 
     async def create_ticket(
         self,
+        guild_id: int,
         channel_id: Union[str, int],
         ticket_id: int,
         reaction_message_id: Union[str, int],
+        author_id: Union[str, int] = None,
     ):
-        data = await self.get_config()
-        data[str(channel_id)] = {
+        await self.initialize()
+
+        self._data["tickets"][str(channel_id)] = {
             "id": ticket_id,
             "reaction_message_id": reaction_message_id,
+            "author_id": author_id,
+            "guild_id": int(guild_id),
         }
-        self.__write(data, "config")
+        self._data["reaction_messages"][str(reaction_message_id)] = str(channel_id)
+        self._mark_dirty()
 
-    async def decrement_ticket_count(self):
-        data = await self.get_config()
-        if "ticket_count" not in data:
+    async def decrement_ticket_count(self, guild_id: int):
+        await self.initialize()
+
+        guild = self._data["guilds"].get(str(guild_id))
+        if guild is None or "ticket_count" not in guild:
             return
 
-        data["ticket_count"] -= 1
-        self.__write(data, "config")
+        guild["ticket_count"] -= 1
+        self._mark_dirty()
+
+    async def flush(self):
+        """Write any outstanding changes to disk now."""
+        # Only one write may be in progress at a time so
+        # an older snapshot can never replace a newer one
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+
+            # Copied on the loop for a consistent snapshot, the slow
+            # part, indented serialising and the disk, happens in a thread
+            snapshot = self._snapshot(self._data)
+            self._dirty = False
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.__write, snapshot
+                )
+            except Exception:
+                self._dirty = True
+                raise
+
+    async def delete_messages(self, message_ids: Iterable[int]):
+        pass
+
+    async def edit_messages(self, edits: Iterable[Tuple[int, str, float, tuple, tuple]]):
+        pass
+
+    async def get_config(self, guild_id: int):
+        await self.initialize()
+
+        guild = self._data["guilds"].get(str(guild_id))
+        if guild is None:
+            return None
+
+        return self._config(guild_id, guild)
 
-    async def get_config(self):
-        return self.__read("config")
+    async def get_next_ticket_id(self, guild_id: int):
+        await self.initialize()
 
-    async def get_next_ticket_id(self):
-        await self.increment_ticket_count()
-        return await self.get_ticket_count()
+        # There is no await between the read and the write,
+        # so concurrent callers are never handed the same id
+        guild = self._guild(guild_id)
+        ticket_count = guild.get("ticket_count", 0) + 1
+        guild["ticket_count"] = ticket_count
+        self._mark_dirty()
+        return ticket_count
 
-    async def get_ticket_count(self):
-        data = await self.get_config()
-        return data.get("ticket_count", 0)
+    async def get_ticket_count(self, guild_id: int):
+        await self.initialize()
+
+        return self._data["guilds"].get(str(guild_id), {}).get("ticket_count", 0)
+
+    async def get_ticket(self, channel_id: Union[str, int]):
+        await self.initialize()
+
+        ticket = self._data["tickets"].get(str(channel_id))
+        if ticket is None:
+            return None
+
+        return self._ticket(channel_id, ticket)
 
     async def get_ticket_id(self, channel_id: Union[str, int]):
-        data = await self.get_config()
-        if str(channel_id) not in data:
+        await self.initialize()
+
+        ticket = self._data["tickets"].get(str(channel_id))
+        if ticket is None:
             return None
 
-        return data[str(channel_id)].get("id")
+        return ticket.get("id")
+
+    async def get_ticket_setup_message_id(self, guild_id: int):
+        await self.initialize()
+
+        return self._data["guilds"].get(str(guild_id), {}).get("ticket_setup_message_id")
+
+    async def get_user_ticket(self, guild_id: int, user_id: Union[str, int]):
+        await self.initialize()
+
+        for channel_id, ticket in self._data["tickets"].items():
+            if (
+                ticket.get("guild_id") == int(guild_id)
+                and str(ticket.get("author_id")) == str(user_id)
+            ):
+                return int(channel_id)
+
+        return None
+
+    async def import_guilds(self, guilds: Iterable[Tuple[GuildConfig, int]]):
+        await self.initialize()
 
-    async def get_ticket_setup_message_id(self):
-        data = await self.get_config()
-        return data.get("ticket_setup_message_id")
+        for config, ticket_count in guilds:
+            guild = {
+                key: value
+                for key, value in config._asdict().items()
+                if key != "guild_id" and value is not None
+            }
+            guild["ticket_count"] = ticket_count
+            self._data["guilds"][str(config.guild_id)] = guild
 
-    async def increment_ticket_count(self):
-        data = await self.get_config()
-        if "ticket_count" not in data:
-            data["ticket_count"] = 0
+        self._index_setup_messages()
+        self._mark_dirty()
 
-        data["ticket_count"] += 1
-        self.__write(data, "config")
+    async def import_tickets(self, tickets: Iterable[TicketRecord]):
+        await self.initialize()
+
+        # Marked dirty once, so it is a single write however many there are
+        for ticket in tickets:
+            previous = self._data["tickets"].get(str(ticket.channel_id))
+            if previous is not None:
+                self._data["reaction_messages"].pop(
+                    str(previous.get("reaction_message_id")), None
+                )
+
+            stored = {
+                "id": ticket.ticket_id,
+                "reaction_message_id": ticket.reaction_message_id,
+                "author_id": ticket.author_id,
+                "guild_id": ticket.guild_id,
+            }
+            # Left out until set, as most tickets never have them
+            if ticket.last_active_at is not None:
+                stored["last_active_at"] = ticket.last_active_at
+            if ticket.warned_at is not None:
+                stored["warned_at"] = ticket.warned_at
+
+            self._data["tickets"][str(ticket.channel_id)] = stored
+            self._data["reaction_messages"][str(ticket.reaction_message_id)] = str(
+                ticket.channel_id
+            )
+
+        self._mark_dirty()
+
+    async def increment_ticket_count(self, guild_id: int):
+        await self.initialize()
+
+        guild = self._guild(guild_id)
+        guild["ticket_count"] = guild.get("ticket_count", 0) + 1
+        self._mark_dirty()
+
+    async def initialize(self):
+        if self.is_initialized:
+            return
+
+        async with self._initialize_lock:
+            if self.is_initialized:
+                return
+
+            data = await asyncio.get_running_loop().run_in_executor(
+                None, self.__read
+            )
+            needs_upgrade = data.get("version") != self.FORMAT_VERSION
+            if needs_upgrade:
+                data = self._upgrade(data)
+
+            self._data = data
+            self._index_setup_messages()
+            if needs_upgrade:
+                # Persist the new format so later starts can skip this
+                self._mark_dirty()
+
+    async def iter_configs(self):
+        await self.initialize()
+
+        for guild_id, guild in list(self._data["guilds"].items()):
+            yield self._config(guild_id, guild)
+
+    async def iter_messages(self, channel_id: Union[str, int]):
+        # Messages are never stored, so transcripts come from the channel history
+        return
+        yield
+
+    async def iter_tickets(self):
+        await self.initialize()
+
+        # Copy the items as the data may change while we are suspended
+        for channel_id, ticket in list(self._data["tickets"].items()):
+            yield self._ticket(channel_id, ticket)
 
     async def remove_ticket(self, channel_id: Union[str, int]):
-        data = await self.get_config()
-        data.pop(str(channel_id))
-        self.__write(data, "config")
+        await self.initialize()
+
+        ticket = self._data["tickets"].pop(str(channel_id), None)
+        if ticket is None:
+            return
+
+        self._data["reaction_messages"].pop(
+            str(ticket.get("reaction_message_id")), None
+        )
+        self._mark_dirty()
+
+    async def remove_tickets(self, channel_ids: Iterable[Union[str, int]]):
+        await self.initialize()
+
+        # Marked dirty once, so it is a single write however many there are
+        for channel_id in channel_ids:
+            ticket = self._data["tickets"].pop(str(channel_id), None)
+            if ticket is not None:
+                self._data["reaction_messages"].pop(
+                    str(ticket.get("reaction_message_id")), None
+                )
+
+        self._mark_dirty()
+
+    async def save_messages(self, messages: Iterable[MessageRecord]):
+        # Keeping every message would make each flush rewrite all of them
+        log.debug("JsonStore does not store messages, searching needs SqliteStore")
+
+    async def save_config(self, config: GuildConfig):
+        await self.initialize()
+
+        self._guild(config.guild_id).update(
+            category_id=config.category_id,
+            log_channel_id=config.log_channel_id,
+            new_ticket_channel_id=config.new_ticket_channel_id,
+            staff_role_id=config.staff_role_id,
+        )
+        self._mark_dirty()
+
+    async def save_new_ticket_message(self, guild_id: int, message_id: int):
+        await self.initialize()
+
+        self._guild(guild_id)["ticket_setup_message_id"] = message_id
+        self._index_setup_messages()
+        self._mark_dirty()
+
+    async def save_ticket_activity(
+        self, activity: Iterable[Tuple[int, float, Optional[float]]]
+    ):
+        await self.initialize()
+
+        for channel_id, last_active_at, warned_at in activity:
+            ticket = self._data["tickets"].get(str(channel_id))
+            if ticket is not None:
+                ticket["last_active_at"] = last_active_at
+                ticket["warned_at"] = warned_at
+
+        self._mark_dirty()
+
+    async def search_messages(
+        self,
+        guild_id: int,
+        text: str = None,
+        *,
+        author_id: Union[str, int] = None,
+        after: float = None,
+        before: float = None,
+        limit: int = 25,
+    ) -> List[MessageRecord]:
+        log.warning("JsonStore does not store messages, searching needs SqliteStore")
+        return []
+
+    @staticmethod
+    def _snapshot(data: dict) -> dict:
+        """A copy no later change can reach, every record is a flat dict"""
+        return {
+            key: {inner: dict(record) for inner, record in value.items()}
+            if key in ("guilds", "tickets")
+            else dict(value) if isinstance(value, dict) else value
+            for key, value in data.items()
+        }
+
+    def _guild(self, guild_id: int) -> dict:
+        return self._data["guilds"].setdefault(str(guild_id), {})
+
+    def _index_setup_messages(self) -> None:
+        self._setup_messages = {
+            str(guild["ticket_setup_message_id"])
+            for guild in self._data["guilds"].values()
+            if guild.get("ticket_setup_message_id") is not None
+        }
+
+    @staticmethod
+    def _config(guild_id, guild: dict) -> GuildConfig:
+        return GuildConfig(
+            int(guild_id),
+            guild.get("category_id"),
+            guild.get("log_channel_id"),
+            guild.get("new_ticket_channel_id"),
+            guild.get("staff_role_id"),
+            guild.get("ticket_setup_message_id"),
+        )
+
+    @staticmethod
+    def _ticket(channel_id, ticket: dict) -> TicketRecord:
+        return TicketRecord(
+            int(channel_id),
+            ticket.get("id"),
+            ticket.get("reaction_message_id"),
+            ticket.get("author_id"),
+            ticket.get("guild_id", LEGACY_GUILD_ID),
+            ticket.get("last_active_at"),
+            ticket.get("warned_at"),
+        )
+
+    @classmethod
+    def _upgrade(cls, data: dict) -> dict:
+        """Convert a file written in an older format into the current one."""
+        log.info("Upgrading config.json to format version %s", cls.FORMAT_VERSION)
+
+        if "version" not in data:
+            data = cls._upgrade_flat(data)
+
+        if data["version"] == 2:
+            data = cls._upgrade_guilds(data)
+
+        return data
+
+    @staticmethod
+    def _upgrade_flat(data: dict) -> dict:
+        """The original flat format stored tickets alongside the counters."""
+        upgraded = {
+            "version": 2,
+            "tickets": {},
+            "reaction_messages": {},
+        }
+        for key, value in data.items():
+            if key in ("ticket_count", "ticket_setup_message_id"):
+                upgraded[key] = value
+                continue
+
+            upgraded["tickets"][key] = value
+            reaction_message_id = value.get("reaction_message_id")
+            if reaction_message_id is not None:
+                upgraded["reaction_messages"][str(reaction_message_id)] = key
+
+        return upgraded
+
+    @staticmethod
+    def _upgrade_guilds(data: dict) -> dict:
+        """Version 2 had a single set of counters, for a single guild."""
+        legacy = {
+            key: data[key]
+            for key in ("ticket_count", "ticket_setup_message_id")
+            if key in data
+        }
+        for ticket in data["tickets"].values():
+            ticket["guild_id"] = LEGACY_GUILD_ID
+
+        return {
+            "version": 3,
+            "guilds": {str(LEGACY_GUILD_ID): legacy} if legacy else {},
+            "tickets": data["tickets"],
+            "reaction_messages": data["reaction_messages"],
+        }
+
+    def _mark_dirty(self) -> None:
+        if self.read_only:
+            return
 
-    async def save_new_ticket_message(self, message_id: int):
-        data = await self.get_config()
-        data["ticket_setup_message_id"] = message_id
-        self.__write(data, "config")
+        self._dirty = True
+        self._flusher.schedule()
 
-    def __read(self, filename: str) -> dict:
+    @property
+    def __path(self) -> str:
+        return self.cwd + self.storage_path + "config.json"
+
+    def __read(self) -> dict:
         try:
-            with open(self.cwd + self.storage_path + filename + ".json", "r") as file:
+            with open(self.__path, "r") as file:
                 data = json.load(file)
         except FileNotFoundError:
             data = {}
 
         return data
 
-    def __write(self, data: dict, filename: str) -> None:
-        with open(self.cwd + self.storage_path + filename + ".json", "w") as file:
-            json.dump(data, file, indent=4)
+    def __write(self, data: dict) -> None:
+        payload = json.dumps(data, indent=4)
+        directory = os.path.dirname(self.__path)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(payload)
+                file.flush()
+                os.fsync(file.fileno())
+
+            os.replace(temp_path, self.__path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
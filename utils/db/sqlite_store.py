@@ -1,11 +1,14 @@
+import asyncio
+import json
 import logging
 import os
+import sqlite3
 from pathlib import Path
-from typing import Union
+from typing import Iterable, List, Optional, Tuple, Union
 
 import aiosqlite
 
-from .base import Base
+from .base import LEGACY_GUILD_ID, Base, GuildConfig, MessageRecord, TicketRecord
 
 
 log = logging.getLogger(__name__)
@@ -16,18 +19,56 @@ class SqliteStore(Base):
     """
     Its on you to clear the database if you want
 
+    A single connection is opened by ``initialize`` and reused for
+    the lifetime of the store, call ``close`` on shutdown to release it.
+
+    The schema is versioned using ``PRAGMA user_version``, any
+    outstanding migrations are applied in order by ``initialize``.
+
     Tables
     ------
     tickets:
-    - channel_id: int
-    - reaction_message_id: int
-    - ticket_id: int
-
-    config:
-    - ticket_setup_message_id: int
+    - channel_id: int (primary key)
+    - reaction_message_id: int (unique)
+    - ticket_id: int (indexed with guild_id)
+    - author_id: int (indexed with guild_id)
+    - guild_id: int
+    - last_active_at: float
+    - warned_at: float
+
+    guilds:
+    - guild_id: int (primary key)
+    - category_id: int
+    - log_channel_id: int
+    - new_ticket_channel_id: int
+    - staff_role_id: int
+    - ticket_setup_message_id: int (indexed)
     - ticket_count: int
+
+    messages:
+    - message_id: int (primary key)
+    - ticket_id: int
+    - channel_id: int (indexed)
+    - author_id: int (indexed with guild_id and created_at)
+    - author_name: str
+    - created_at: float (indexed with guild_id)
+    - content: str (full text indexed by messages_fts)
+    - edited_at: float
+    - deleted: bool
+    - guild_id: int
+    - attachments: str (JSON list of [filename, size, url], or null)
+    - embeds: str (JSON list of [title, description], or null)
     """
 
+    # Applied to the connection once when it is opened
+    pragmas = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8000",
+        "PRAGMA busy_timeout=5000",
+    )
+
     def __init__(self, storage_path: str = None, database_name: str = None):
         storage_path = storage_path.strip("/")
 
@@ -42,170 +83,810 @@ class SqliteStore(Base):
         self.db = os.path.join(self.cwd, self.db_file)
 
         self.is_initialized = False
+        self._connection: Optional[aiosqlite.Connection] = None
+        self._initialize_lock = asyncio.Lock()
+        self._ticket_id_lock = asyncio.Lock()
 
-        log.info("Initialised JsonStore")
+        log.info("Initialised SqliteStore")
 
     async def initialize(self):
         if self.is_initialized:
             return
 
-        async with aiosqlite.connect(self.db) as db:
-            async with db.execute(
-                "SELECT name FROM sqlite_master WHERE type='table' AND name='tickets'"
-            ) as cursor:
-                if not await cursor.fetchone():
-                    await db.execute(
-                        "CREATE TABLE tickets (channel_id number, ticket_id number, reaction_message_id number)"
-                    )
-                    await db.commit()
-
-        async with aiosqlite.connect(self.db) as db:
-            async with db.execute(
-                "SELECT name FROM sqlite_master WHERE type='table' AND name='config'"
-            ) as cursor:
-                if not await cursor.fetchone():
-                    await db.execute(
-                        "CREATE TABLE config (ticket_setup_message_id number, ticket_count number)"
-                    )
-                    await db.execute("INSERT INTO config VALUES (0, 0)")
-                    await db.commit()
-
-        self.is_initialized = True
+        async with self._initialize_lock:
+            if self.is_initialized:
+                # Someone else finished initializing while we waited
+                return
+
+            db = await aiosqlite.connect(self.db)
+            for pragma in self.pragmas:
+                await db.execute(pragma)
+
+            await self._migrate(db)
+
+            self._connection = db
+            self.is_initialized = True
+            log.debug("Opened a persistent connection to %s", self.db)
+
+    async def _migrate(self, db: aiosqlite.Connection) -> None:
+        async with db.execute("PRAGMA user_version") as cursor:
+            version = (await cursor.fetchone())[0]
+
+        for target, migration in enumerate(
+            self.migrations[version:], start=version + 1
+        ):
+            log.info("Migrating %s to schema version %s", self.db, target)
+            await db.execute("BEGIN")
+            try:
+                await migration(self, db)
+                # PRAGMA does not accept bound parameters
+                await db.execute(f"PRAGMA user_version = {int(target)}")
+            except Exception:
+                await db.rollback()
+                raise
+
+            await db.commit()
+
+    async def _fetchone(self, sql: str, parameters=None) -> Optional[tuple]:
+        # The connection is shared, so statements are always run to
+        # completion in a single call. A cursor left open across an
+        # await would make another coroutine's commit fail.
+        rows = await self._connection.execute_fetchall(sql, parameters)
+        return rows[0] if rows else None
+
+    @staticmethod
+    async def _table_exists(db: aiosqlite.Connection, name: str) -> bool:
+        async with db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=:name",
+            {"name": name},
+        ) as cursor:
+            return await cursor.fetchone() is not None
+
+    async def _migration_1(self, db: aiosqlite.Connection) -> None:
+        """Typed columns, primary key and indexes.
+
+        Databases created before the schema was versioned have
+        untyped, unindexed tables which get copied across.
+        """
+        has_legacy_tickets = await self._table_exists(db, "tickets")
+        has_legacy_config = await self._table_exists(db, "config")
+
+        if has_legacy_tickets:
+            await db.execute("ALTER TABLE tickets RENAME TO legacy_tickets")
+        if has_legacy_config:
+            await db.execute("ALTER TABLE config RENAME TO legacy_config")
+
+        await db.execute(
+            """
+            CREATE TABLE tickets (
+                channel_id INTEGER PRIMARY KEY,
+                ticket_id INTEGER NOT NULL,
+                reaction_message_id INTEGER
+            )
+            """
+        )
+        await db.execute(
+            "CREATE UNIQUE INDEX tickets_reaction_message_id ON tickets (reaction_message_id)"
+        )
+        await db.execute("CREATE INDEX tickets_ticket_id ON tickets (ticket_id)")
+        await db.execute(
+            """
+            CREATE TABLE config (
+                ticket_setup_message_id INTEGER NOT NULL DEFAULT 0,
+                ticket_count INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+
+        if has_legacy_tickets:
+            await db.execute(
+                """
+                INSERT OR IGNORE INTO tickets
+                SELECT CAST(channel_id AS INTEGER),
+                       CAST(ticket_id AS INTEGER),
+                       CAST(reaction_message_id AS INTEGER)
+                FROM legacy_tickets
+                """
+            )
+            await db.execute("DROP TABLE legacy_tickets")
+
+        if has_legacy_config:
+            await db.execute(
+                """
+                INSERT INTO config
+                SELECT CAST(ticket_setup_message_id AS INTEGER),
+                       CAST(ticket_count AS INTEGER)
+                FROM legacy_config LIMIT 1
+                """
+            )
+            await db.execute("DROP TABLE legacy_config")
+
+        async with db.execute("SELECT 1 FROM config") as cursor:
+            if not await cursor.fetchone():
+                await db.execute("INSERT INTO config VALUES (0, 0)")
+
+    async def _migration_2(self, db: aiosqlite.Connection) -> None:
+        """Track who opened each ticket."""
+        await db.execute("ALTER TABLE tickets ADD COLUMN author_id INTEGER")
+        await db.execute("CREATE INDEX tickets_author_id ON tickets (author_id)")
+
+    async def _migration_3(self, db: aiosqlite.Connection) -> None:
+        """Transcript messages, full text searchable."""
+        await db.execute(
+            """
+            CREATE TABLE messages (
+                message_id INTEGER PRIMARY KEY,
+                ticket_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                author_id INTEGER NOT NULL,
+                author_name TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                content TEXT NOT NULL
+            )
+            """
+        )
+        await db.execute("CREATE INDEX messages_ticket_id ON messages (ticket_id)")
+        await db.execute(
+            "CREATE INDEX messages_author_id ON messages (author_id, created_at)"
+        )
+        await db.execute("CREATE INDEX messages_created_at ON messages (created_at)")
+
+        # The text lives once, in messages. These triggers keep the
+        # full text index in step with it as rows change.
+        await db.execute(
+            """
+            CREATE VIRTUAL TABLE messages_fts USING fts5(
+                content, content='messages', content_rowid='message_id'
+            )
+            """
+        )
+        await db.execute(
+            """
+            CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, content)
+                VALUES (new.message_id, new.content);
+            END
+            """
+        )
+        await db.execute(
+            """
+            CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content)
+                VALUES ('delete', old.message_id, old.content);
+            END
+            """
+        )
+        await db.execute(
+            """
+            CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content)
+                VALUES ('delete', old.message_id, old.content);
+                INSERT INTO messages_fts (rowid, content)
+                VALUES (new.message_id, new.content);
+            END
+            """
+        )
+
+    async def _migration_4(self, db: aiosqlite.Connection) -> None:
+        """Track edits and deletions of captured messages."""
+        await db.execute("ALTER TABLE messages ADD COLUMN edited_at REAL")
+        await db.execute(
+            "ALTER TABLE messages ADD COLUMN deleted INTEGER NOT NULL DEFAULT 0"
+        )
+
+    async def _migration_5(self, db: aiosqlite.Connection) -> None:
+        """Per guild configuration and counters.
+
+        Everything stored so far is assigned to LEGACY_GUILD_ID,
+        see claim_legacy_data.
+        """
+        await db.execute(
+            """
+            CREATE TABLE guilds (
+                guild_id INTEGER PRIMARY KEY,
+                category_id INTEGER,
+                log_channel_id INTEGER,
+                new_ticket_channel_id INTEGER,
+                staff_role_id INTEGER,
+                ticket_setup_message_id INTEGER,
+                ticket_count INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        await db.execute(
+            "CREATE INDEX guilds_ticket_setup_message_id ON guilds (ticket_setup_message_id)"
+        )
+        await db.execute(
+            """
+            INSERT INTO guilds (guild_id, ticket_setup_message_id, ticket_count)
+            SELECT :guild_id, NULLIF(ticket_setup_message_id, 0), ticket_count
+            FROM config LIMIT 1
+            """,
+            {"guild_id": LEGACY_GUILD_ID},
+        )
+        await db.execute("DROP TABLE config")
+
+        await db.execute(
+            f"ALTER TABLE tickets ADD COLUMN guild_id INTEGER NOT NULL DEFAULT {LEGACY_GUILD_ID}"
+        )
+        await db.execute("DROP INDEX tickets_ticket_id")
+        await db.execute("DROP INDEX tickets_author_id")
+        await db.execute("CREATE INDEX tickets_ticket_id ON tickets (guild_id, ticket_id)")
+        await db.execute("CREATE INDEX tickets_author_id ON tickets (guild_id, author_id)")
+
+        await db.execute(
+            f"ALTER TABLE messages ADD COLUMN guild_id INTEGER NOT NULL DEFAULT {LEGACY_GUILD_ID}"
+        )
+        await db.execute("DROP INDEX messages_ticket_id")
+        await db.execute("DROP INDEX messages_author_id")
+        await db.execute("DROP INDEX messages_created_at")
+        await db.execute("CREATE INDEX messages_channel_id ON messages (channel_id)")
+        await db.execute(
+            "CREATE INDEX messages_author_id ON messages (guild_id, author_id, created_at)"
+        )
+        await db.execute(
+            "CREATE INDEX messages_created_at ON messages (guild_id, created_at)"
+        )
+
+    async def _migration_6(self, db: aiosqlite.Connection) -> None:
+        """Track ticket activity, so idle tickets can be closed."""
+        await db.execute("ALTER TABLE tickets ADD COLUMN last_active_at REAL")
+        await db.execute("ALTER TABLE tickets ADD COLUMN warned_at REAL")
+
+    async def _migration_7(self, db: aiosqlite.Connection) -> None:
+        """Keep message attachments and embeds apart from their text."""
+        await db.execute("ALTER TABLE messages ADD COLUMN attachments TEXT")
+        await db.execute("ALTER TABLE messages ADD COLUMN embeds TEXT")
+
+    # Index n migrates a database from schema version n to n + 1
+    migrations = (
+        _migration_1,
+        _migration_2,
+        _migration_3,
+        _migration_4,
+        _migration_5,
+        _migration_6,
+        _migration_7,
+    )
+
+    async def close(self):
+        """Close the underlying connection, if one was ever opened."""
+        if self._connection is None:
+            return
+
+        await self._connection.close()
+        self._connection = None
+        self.is_initialized = False
+        log.debug("Closed the connection to %s", self.db)
 
     async def check_is_ticket(self, channel_id: Union[str, int]):
         await self.initialize()
 
-        async with aiosqlite.connect(self.db) as db:
-            async with db.execute(
-                "SELECT * FROM tickets WHERE channel_id=:channel_id",
-                {"channel_id": channel_id},
-            ) as cursor:
-                if await cursor.fetchone():
-                    return True
-                return False
+        value = await self._fetchone(
+            "SELECT 1 FROM tickets WHERE channel_id=:channel_id",
+            {"channel_id": int(channel_id)},
+        )
+        return value is not None
 
     async def check_message_is_reaction_message(self, message_id: Union[str, int]):
         await self.initialize()
 
-        async with aiosqlite.connect(self.db) as db:
-            async with db.execute(
-                "SELECT * FROM config WHERE ticket_setup_message_id=:message_id",
-                {"message_id": message_id},
-            ) as cursor:
-                if await cursor.fetchone():
-                    return True
+        message_id = int(message_id)
 
-            async with db.execute(
-                "SELECT * FROM tickets WHERE reaction_message_id=:message_id",
-                {"message_id": message_id},
-            ) as cursor:
-                if await cursor.fetchone():
-                    return True
+        if await self._fetchone(
+            "SELECT 1 FROM guilds WHERE ticket_setup_message_id=:message_id",
+            {"message_id": message_id},
+        ):
+            return True
+
+        value = await self._fetchone(
+            "SELECT 1 FROM tickets WHERE reaction_message_id=:message_id",
+            {"message_id": message_id},
+        )
+        return value is not None
+
+    async def claim_legacy_data(self, guild_id: int) -> bool:
+        await self.initialize()
 
+        parameters = {"guild_id": int(guild_id), "legacy_guild_id": LEGACY_GUILD_ID}
+        # Run on every start, there is usually nothing left to claim
+        row = await self._fetchone(
+            """
+            SELECT EXISTS (SELECT 1 FROM guilds WHERE guild_id=:legacy_guild_id)
+                OR EXISTS (SELECT 1 FROM tickets WHERE guild_id=:legacy_guild_id)
+                OR EXISTS (SELECT 1 FROM messages WHERE guild_id=:legacy_guild_id)
+            """,
+            parameters,
+        )
+        if not row[0]:
             return False
 
-    async def get_next_ticket_id(self):
+        db = self._connection
+        await db.execute("BEGIN")
+        try:
+            await db.execute(
+                "UPDATE tickets SET guild_id=:guild_id WHERE guild_id=:legacy_guild_id",
+                parameters,
+            )
+            await db.execute(
+                "UPDATE messages SET guild_id=:guild_id WHERE guild_id=:legacy_guild_id",
+                parameters,
+            )
+            # Only if the guild has no counters of its own yet
+            await db.execute(
+                """
+                INSERT OR IGNORE INTO guilds (guild_id, ticket_setup_message_id, ticket_count)
+                SELECT :guild_id, ticket_setup_message_id, ticket_count
+                FROM guilds WHERE guild_id=:legacy_guild_id
+                """,
+                parameters,
+            )
+            await db.execute(
+                "DELETE FROM guilds WHERE guild_id=:legacy_guild_id", parameters
+            )
+        except Exception:
+            await db.rollback()
+            raise
+
+        await db.commit()
+        return True
+
+    async def get_next_ticket_id(self, guild_id: int):
         await self.initialize()
 
-        await self.increment_ticket_count()
-        async with aiosqlite.connect(self.db) as db:
-            async with db.execute("SELECT ticket_count FROM config") as cursor:
-                value = await cursor.fetchone()
-                return value[0]
+        db = self._connection
+        parameters = {"guild_id": int(guild_id)}
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            # A single statement, so concurrent callers can never see the same value
+            value = await self._fetchone(
+                """
+                INSERT INTO guilds (guild_id, ticket_count) VALUES (:guild_id, 1)
+                ON CONFLICT (guild_id) DO UPDATE SET ticket_count = ticket_count + 1
+                RETURNING ticket_count
+                """,
+                parameters,
+            )
+            await db.commit()
+            return value[0]
+
+        # Older SQLite builds lack RETURNING, so make the
+        # increment and read a single unit of work instead
+        async with self._ticket_id_lock:
+            await db.execute(
+                """
+                INSERT INTO guilds (guild_id, ticket_count) VALUES (:guild_id, 1)
+                ON CONFLICT (guild_id) DO UPDATE SET ticket_count = ticket_count + 1
+                """,
+                parameters,
+            )
+            value = await self._fetchone(
+                "SELECT ticket_count FROM guilds WHERE guild_id=:guild_id", parameters
+            )
+            await db.commit()
+            return value[0]
 
     async def create_ticket(
         self,
+        guild_id: int,
         channel_id: Union[str, int],
         ticket_id: int,
         reaction_message_id: Union[str, int],
+        author_id: Union[str, int] = None,
     ):
         await self.initialize()
 
         channel_id = int(channel_id)
         reaction_message_id = int(reaction_message_id)
+        author_id = int(author_id) if author_id is not None else None
+
+        await self._connection.execute(
+            """
+            INSERT INTO tickets (channel_id, ticket_id, reaction_message_id, author_id, guild_id)
+            VALUES (:channel_id, :ticket_id, :reaction_message_id, :author_id, :guild_id)
+            """,
+            {
+                "channel_id": channel_id,
+                "ticket_id": ticket_id,
+                "reaction_message_id": reaction_message_id,
+                "author_id": author_id,
+                "guild_id": int(guild_id),
+            },
+        )
+        await self._connection.commit()
+
+    async def decrement_ticket_count(self, guild_id: int):
+        await self.initialize()
 
-        async with aiosqlite.connect(self.db) as db:
-            await db.execute(
-                "INSERT INTO tickets VALUES (:channel_id, :ticket_id, :reaction_message_id)",
-                {
-                    "channel_id": channel_id,
-                    "ticket_id": ticket_id,
-                    "reaction_message_id": reaction_message_id,
-                },
-            )
-            await db.commit()
+        await self._connection.execute(
+            "UPDATE guilds SET ticket_count = ticket_count - 1 WHERE guild_id=:guild_id",
+            {"guild_id": int(guild_id)},
+        )
+        await self._connection.commit()
 
-    async def decrement_ticket_count(self):
+    async def delete_messages(self, message_ids: Iterable[int]):
         await self.initialize()
 
-        async with aiosqlite.connect(self.db) as db:
-            await db.execute("UPDATE config SET ticket_count = ticket_count - 1")
-            await db.commit()
+        await self._connection.executemany(
+            "UPDATE messages SET deleted=1 WHERE message_id=:message_id",
+            ({"message_id": int(message_id)} for message_id in message_ids),
+        )
+        await self._connection.commit()
 
-    async def get_config(self):
+    async def edit_messages(self, edits: Iterable[Tuple[int, str, float, tuple, tuple]]):
         await self.initialize()
 
-        async with aiosqlite.connect(self.db) as db:
-            async with db.execute("SELECT * FROM config") as cursor:
-                value = await cursor.fetchone()
-                return value[0]
+        await self._connection.executemany(
+            """
+            UPDATE messages SET content=:content, edited_at=:edited_at,
+                attachments=:attachments, embeds=:embeds
+            WHERE message_id=:message_id
+            """,
+            (
+                {
+                    "message_id": int(message_id),
+                    "content": content,
+                    "edited_at": edited_at,
+                    "attachments": self._dump(attachments),
+                    "embeds": self._dump(embeds),
+                }
+                for message_id, content, edited_at, attachments, embeds in edits
+            ),
+        )
+        await self._connection.commit()
+
+    async def get_config(self, guild_id: int):
+        await self.initialize()
 
-    async def get_ticket_count(self):
+        value = await self._fetchone(
+            f"SELECT {self._config_columns} FROM guilds WHERE guild_id=:guild_id",
+            {"guild_id": int(guild_id)},
+        )
+        return GuildConfig(*value) if value else None
+
+    async def get_ticket_count(self, guild_id: int):
+        await self.initialize()
+
+        value = await self._fetchone(
+            "SELECT ticket_count FROM guilds WHERE guild_id=:guild_id",
+            {"guild_id": int(guild_id)},
+        )
+        return value[0] if value else 0
+
+    async def get_ticket(self, channel_id: Union[str, int]):
         await self.initialize()
 
-        async with aiosqlite.connect(self.db) as db:
-            async with db.execute("SELECT ticket_count FROM config") as cursor:
-                value = await cursor.fetchone()
-                return value[0]
+        value = await self._fetchone(
+            f"SELECT {self._ticket_columns} FROM tickets WHERE channel_id=:channel_id",
+            {"channel_id": int(channel_id)},
+        )
+        return TicketRecord(*value) if value else None
 
     async def get_ticket_id(self, channel_id: Union[str, int]):
         await self.initialize()
 
         channel_id = int(channel_id)
 
-        async with aiosqlite.connect(self.db) as db:
-            async with db.execute(
-                "SELECT ticket_id FROM tickets WHERE channel_id=:channel_id",
-                {"channel_id": channel_id},
-            ) as cursor:
-                value = await cursor.fetchone()
-                return value[0]
+        value = await self._fetchone(
+            "SELECT ticket_id FROM tickets WHERE channel_id=:channel_id",
+            {"channel_id": channel_id},
+        )
+        return value[0] if value else None
 
-    async def get_ticket_setup_message_id(self):
+    async def get_ticket_setup_message_id(self, guild_id: int):
         await self.initialize()
 
-        async with aiosqlite.connect(self.db) as db:
-            async with db.execute(
-                "SELECT ticket_setup_message_id FROM config",
-            ) as cursor:
-                value = await cursor.fetchone()
-                return value[0]
+        value = await self._fetchone(
+            "SELECT ticket_setup_message_id FROM guilds WHERE guild_id=:guild_id",
+            {"guild_id": int(guild_id)},
+        )
+        return value[0] if value else None
 
-    async def increment_ticket_count(self):
+    async def get_user_ticket(self, guild_id: int, user_id: Union[str, int]):
         await self.initialize()
 
-        async with aiosqlite.connect(self.db) as db:
-            await db.execute("UPDATE config SET ticket_count = ticket_count + 1")
-            await db.commit()
+        value = await self._fetchone(
+            """
+            SELECT channel_id FROM tickets
+            WHERE guild_id=:guild_id AND author_id=:author_id LIMIT 1
+            """,
+            {"guild_id": int(guild_id), "author_id": int(user_id)},
+        )
+        return value[0] if value else None
+
+    async def import_guilds(self, guilds: Iterable[Tuple[GuildConfig, int]]):
+        await self.initialize()
+
+        # A single transaction, however many guilds there are
+        await self._connection.executemany(
+            f"""
+            INSERT OR REPLACE INTO guilds ({self._config_columns}, ticket_count)
+            VALUES (
+                :guild_id, :category_id, :log_channel_id, :new_ticket_channel_id,
+                :staff_role_id, :ticket_setup_message_id, :ticket_count
+            )
+            """,
+            (
+                {**config._asdict(), "ticket_count": ticket_count}
+                for config, ticket_count in guilds
+            ),
+        )
+        await self._connection.commit()
+
+    async def import_tickets(self, tickets: Iterable[TicketRecord]):
+        await self.initialize()
+
+        # A single transaction, however many tickets there are
+        await self._connection.executemany(
+            f"""
+            INSERT OR REPLACE INTO tickets ({self._ticket_columns}) VALUES (
+                :channel_id, :ticket_id, :reaction_message_id, :author_id,
+                :guild_id, :last_active_at, :warned_at
+            )
+            """,
+            (ticket._asdict() for ticket in tickets),
+        )
+        await self._connection.commit()
+
+    async def increment_ticket_count(self, guild_id: int):
+        await self.initialize()
+
+        await self._connection.execute(
+            """
+            INSERT INTO guilds (guild_id, ticket_count) VALUES (:guild_id, 1)
+            ON CONFLICT (guild_id) DO UPDATE SET ticket_count = ticket_count + 1
+            """,
+            {"guild_id": int(guild_id)},
+        )
+        await self._connection.commit()
+
+    async def iter_configs(self):
+        await self.initialize()
+
+        # One row per guild, few enough to fetch at once
+        rows = await self._connection.execute_fetchall(
+            f"SELECT {self._config_columns} FROM guilds"
+        )
+        for row in rows:
+            yield GuildConfig(*row)
+
+    async def iter_messages(self, channel_id: Union[str, int], *, batch_size: int = 500):
+        await self.initialize()
+
+        last_message_id = -1
+        while True:
+            rows = await self._connection.execute_fetchall(
+                f"""
+                SELECT {self._message_columns} FROM messages
+                WHERE channel_id=:channel_id AND message_id > :last_message_id
+                ORDER BY message_id LIMIT :batch_size
+                """,
+                {
+                    "channel_id": int(channel_id),
+                    "last_message_id": last_message_id,
+                    "batch_size": batch_size,
+                },
+            )
+            for row in rows:
+                yield self._message(row)
+
+            if len(rows) < batch_size:
+                return
+
+            last_message_id = rows[-1][0]
+
+    async def iter_tickets(self, *, batch_size: int = 500):
+        await self.initialize()
+
+        # Paged by primary key rather than holding one cursor open,
+        # which would stop anyone else committing until we finished
+        last_channel_id = -1
+        while True:
+            rows = await self._connection.execute_fetchall(
+                f"""
+                SELECT {self._ticket_columns} FROM tickets
+                WHERE channel_id > :last_channel_id
+                ORDER BY channel_id LIMIT :batch_size
+                """,
+                {"last_channel_id": last_channel_id, "batch_size": batch_size},
+            )
+            for row in rows:
+                yield TicketRecord(*row)
+
+            if len(rows) < batch_size:
+                return
+
+            last_channel_id = rows[-1][0]
 
     async def remove_ticket(self, channel_id: Union[str, int]):
         await self.initialize()
 
         channel_id = int(channel_id)
 
-        async with aiosqlite.connect(self.db) as db:
-            await db.execute(
-                "DELETE FROM tickets WHERE channel_id=:channel_id",
-                {"channel_id": channel_id},
+        await self._connection.execute(
+            "DELETE FROM tickets WHERE channel_id=:channel_id",
+            {"channel_id": channel_id},
+        )
+        await self._connection.commit()
+
+    async def remove_tickets(self, channel_ids: Iterable[Union[str, int]]):
+        await self.initialize()
+
+        # A single transaction, however many tickets there are
+        await self._connection.executemany(
+            "DELETE FROM tickets WHERE channel_id=:channel_id",
+            ({"channel_id": int(channel_id)} for channel_id in channel_ids),
+        )
+        await self._connection.commit()
+
+    async def save_config(self, config: GuildConfig):
+        await self.initialize()
+
+        await self._connection.execute(
+            """
+            INSERT INTO guilds (
+                guild_id, category_id, log_channel_id, new_ticket_channel_id, staff_role_id
             )
-            await db.commit()
+            VALUES (
+                :guild_id, :category_id, :log_channel_id, :new_ticket_channel_id, :staff_role_id
+            )
+            ON CONFLICT (guild_id) DO UPDATE SET
+                category_id=excluded.category_id,
+                log_channel_id=excluded.log_channel_id,
+                new_ticket_channel_id=excluded.new_ticket_channel_id,
+                staff_role_id=excluded.staff_role_id
+            """,
+            config._asdict(),
+        )
+        await self._connection.commit()
+
+    async def save_new_ticket_message(self, guild_id: int, message_id: int):
+        await self.initialize()
 
-    async def save_new_ticket_message(self, message_id: int):
+        await self._connection.execute(
+            """
+            INSERT INTO guilds (guild_id, ticket_setup_message_id)
+            VALUES (:guild_id, :ticket_setup_message_id)
+            ON CONFLICT (guild_id) DO UPDATE
+            SET ticket_setup_message_id=excluded.ticket_setup_message_id
+            """,
+            {"guild_id": int(guild_id), "ticket_setup_message_id": message_id},
+        )
+        await self._connection.commit()
+
+    async def save_ticket_activity(
+        self, activity: Iterable[Tuple[int, float, Optional[float]]]
+    ):
         await self.initialize()
 
-        async with aiosqlite.connect(self.db) as db:
-            await db.execute(
-                "UPDATE config SET ticket_setup_message_id=:ticket_setup_message_id",
-                {"ticket_setup_message_id": message_id},
+        # A single transaction, however many tickets there are
+        await self._connection.executemany(
+            """
+            UPDATE tickets SET last_active_at=:last_active_at, warned_at=:warned_at
+            WHERE channel_id=:channel_id
+            """,
+            (
+                {
+                    "channel_id": int(channel_id),
+                    "last_active_at": last_active_at,
+                    "warned_at": warned_at,
+                }
+                for channel_id, last_active_at, warned_at in activity
+            ),
+        )
+        await self._connection.commit()
+
+    async def save_messages(self, messages: Iterable[MessageRecord]):
+        await self.initialize()
+
+        # A single transaction, however many messages there are
+        await self._connection.executemany(
+            f"""
+            INSERT INTO messages ({self._message_columns}) VALUES (
+                :message_id, :ticket_id, :channel_id, :author_id, :author_name,
+                :created_at, :content, :edited_at, :deleted, :guild_id,
+                :attachments, :embeds
             )
-            await db.commit()
+            ON CONFLICT (message_id) DO UPDATE
+            SET content=excluded.content, edited_at=excluded.edited_at,
+                attachments=excluded.attachments, embeds=excluded.embeds
+            """,
+            (
+                {
+                    **message._asdict(),
+                    "attachments": self._dump(message.attachments),
+                    "embeds": self._dump(message.embeds),
+                }
+                for message in messages
+            ),
+        )
+        await self._connection.commit()
+
+    async def search_messages(
+        self,
+        guild_id: int,
+        text: str = None,
+        *,
+        author_id: Union[str, int] = None,
+        after: float = None,
+        before: float = None,
+        limit: int = 25,
+    ) -> List[MessageRecord]:
+        await self.initialize()
+
+        # Only filter on what was asked for, so sqlite
+        # can pick the index that suits the query
+        # Transcripts are what's searched, so only closed tickets'
+        # messages, as they were when the ticket was closed
+        conditions = [
+            "messages.guild_id=:guild_id",
+            "deleted=0",
+            "NOT EXISTS (SELECT 1 FROM tickets WHERE tickets.channel_id = messages.channel_id)",
+        ]
+        parameters = {"guild_id": int(guild_id), "limit": limit}
+        source = "messages"
+        order = "created_at DESC"
+        if text:
+            # Message ids are snowflakes and so already in time order.
+            # Walking the full text index newest first means it can
+            # stop after ``limit`` matches, rather than sort them all.
+            source = "messages_fts JOIN messages ON message_id = messages_fts.rowid"
+            order = "messages_fts.rowid DESC"
+            conditions.append("messages_fts MATCH :text")
+            parameters["text"] = self._fts_query(text)
+        if author_id is not None:
+            conditions.append("author_id=:author_id")
+            parameters["author_id"] = int(author_id)
+        if after is not None:
+            conditions.append("created_at>=:after")
+            parameters["after"] = after
+        if before is not None:
+            conditions.append("created_at<:before")
+            parameters["before"] = before
+
+        columns = self._message_columns.replace("content", "messages.content")
+        rows = await self._connection.execute_fetchall(
+            f"""
+            SELECT {columns} FROM {source}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {order} LIMIT :limit
+            """,
+            parameters,
+        )
+        return [self._message(row) for row in rows]
+
+    # In the order of the matching NamedTuple's fields
+    _config_columns = (
+        "guild_id, category_id, log_channel_id, new_ticket_channel_id,"
+        " staff_role_id, ticket_setup_message_id"
+    )
+    _ticket_columns = (
+        "channel_id, ticket_id, reaction_message_id, author_id, guild_id, "
+        "last_active_at, warned_at"
+    )
+    _message_columns = (
+        "message_id, ticket_id, channel_id, author_id, author_name,"
+        " created_at, content, edited_at, deleted, guild_id, attachments, embeds"
+    )
+
+    @staticmethod
+    def _message(row) -> MessageRecord:
+        message = MessageRecord(*row)
+        return message._replace(
+            deleted=bool(message.deleted),
+            attachments=SqliteStore._load(message.attachments),
+            embeds=SqliteStore._load(message.embeds),
+        )
+
+    @staticmethod
+    def _dump(values: tuple) -> Optional[str]:
+        return json.dumps(values) if values else None
+
+    @staticmethod
+    def _load(value: Optional[str]) -> tuple:
+        return tuple(map(tuple, json.loads(value))) if value else ()
+
+    @staticmethod
+    def _fts_query(text: str) -> str:
+        # Quote every word so punctuation is never read as FTS5
+        # query syntax, the words must then all appear
+        return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
@@ -0,0 +1,251 @@
+"""
+Copies every guild and ticket from one store into another, e.g.
+from JsonStore's config.json into SqliteStore's storage.db.
+
+Usage: python -m utils.db.transfer --from json --to sqlite
+    [--from-path /bot_config/] [--to-path /bot_config/] [--batch-size 5000]
+
+Stop the bot first, anything it changes during the copy may be lost.
+The target must be empty, once the bot has started on it run the copy
+with an empty --to-path and move the result into place.
+A JsonStore source is only read, an older config.json is upgraded in
+memory and left as it is. A SqliteStore source is upgraded to the
+current schema, as starting the bot would.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from collections import Counter
+from typing import AsyncIterator, Dict, List, NamedTuple, Tuple, TypeVar
+
+from .base import LEGACY_GUILD_ID, Base, GuildConfig, TicketRecord
+from .json_store import JsonStore
+from .sqlite_store import SqliteStore
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class TransferReport(NamedTuple):
+    """What transfer copied, and how long it took"""
+
+    guilds: int
+    tickets: int
+    seconds: float
+
+
+async def transfer(source: Base, target: Base, *, batch_size: int = 5000) -> TransferReport:
+    """Copy every guild and ticket in source into target.
+
+    Records are streamed out of the source and imported in batches of
+    ``batch_size``, each batch a single transaction for stores that
+    have them. Anything in the target with the same ids is replaced.
+
+    Captured messages are not copied, JsonStore keeps none.
+
+    Parameters
+    ----------
+    source: Base
+    target: Base
+    batch_size: int
+        How many records to import at once
+
+    Returns
+    -------
+    TransferReport
+    """
+    start = time.perf_counter()
+
+    guilds = 0
+    async for batch in _batches(_guilds(source), batch_size):
+        await target.import_guilds(batch)
+        guilds += len(batch)
+
+    tickets = 0
+    async for batch in _batches(_tickets(source), batch_size):
+        await target.import_tickets(batch)
+        tickets += len(batch)
+        log.debug("Copied %s tickets", tickets)
+
+    return TransferReport(guilds, tickets, time.perf_counter() - start)
+
+
+async def verify(source: Base, target: Base) -> List[str]:
+    """Compare what two stores hold.
+
+    Configuration and ticket counts are compared per guild. Tickets
+    are compared by an order independent checksum, so neither store
+    is held in memory.
+
+    Returns
+    -------
+    List[str]
+        Every difference found, empty if there are none
+    """
+    problems = []
+
+    source_guilds = {config.guild_id: config async for config, _ in _guilds(source)}
+    target_guilds = {config.guild_id: config async for config, _ in _guilds(target)}
+    for guild_id in source_guilds.keys() | target_guilds.keys():
+        if source_guilds.get(guild_id) != target_guilds.get(guild_id):
+            problems.append(f"Guild {guild_id}'s configuration differs")
+            continue
+
+        source_count = await source.get_ticket_count(guild_id)
+        target_count = await target.get_ticket_count(guild_id)
+        if source_count != target_count:
+            problems.append(
+                f"Guild {guild_id}'s ticket count is {target_count}, expected {source_count}"
+            )
+
+    source_tickets = await _summarise(source)
+    target_tickets = await _summarise(target)
+    for guild_id in source_tickets.keys() | target_tickets.keys():
+        source_summary = source_tickets.get(guild_id, (0, 0))
+        target_summary = target_tickets.get(guild_id, (0, 0))
+        if source_summary[0] != target_summary[0]:
+            problems.append(
+                f"Guild {guild_id} has {target_summary[0]} tickets, "
+                f"expected {source_summary[0]}"
+            )
+        elif source_summary != target_summary:
+            problems.append(f"Guild {guild_id}'s tickets differ")
+
+    return problems
+
+
+async def _guilds(store: Base) -> AsyncIterator[Tuple[GuildConfig, int]]:
+    async for config in store.iter_configs():
+        config = GuildConfig(*(_as_id(value) for value in config))
+        ticket_count = await store.get_ticket_count(config.guild_id)
+        if config == GuildConfig(config.guild_id) and not ticket_count:
+            # Nothing stored, a new SqliteStore has one of these for LEGACY_GUILD_ID
+            continue
+
+        yield config, ticket_count
+
+
+async def _tickets(store: Base) -> AsyncIterator[TicketRecord]:
+    async for ticket in store.iter_tickets():
+        if (
+            ticket.guild_id is None
+            or isinstance(ticket.reaction_message_id, str)
+            or isinstance(ticket.author_id, str)
+        ):
+            # Older JSON files may hold ids as strings
+            guild_id = _as_id(ticket.guild_id)
+            ticket = ticket._replace(
+                reaction_message_id=_as_id(ticket.reaction_message_id),
+                author_id=_as_id(ticket.author_id),
+                guild_id=LEGACY_GUILD_ID if guild_id is None else guild_id,
+            )
+
+        yield ticket
+
+
+async def _summarise(store: Base) -> Dict[int, Tuple[int, int]]:
+    """guild_id -> (how many tickets, checksum of them)"""
+    counts = Counter()
+    checksums = Counter()
+    async for ticket in _tickets(store):
+        counts[ticket.guild_id] += 1
+        checksums[ticket.guild_id] = (checksums[ticket.guild_id] + hash(ticket)) % 2 ** 64
+
+    return {guild_id: (counts[guild_id], checksums[guild_id]) for guild_id in counts}
+
+
+async def _batches(records: AsyncIterator[T], size: int) -> AsyncIterator[List[T]]:
+    batch = []
+    async for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def _as_id(value):
+    if value is None:
+        return None
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _open(kind: str, path: str, *, read_only: bool = False) -> Base:
+    if kind == "sqlite":
+        return SqliteStore(storage_path=path)
+
+    # Written once, by close, rather than after every batch
+    return JsonStore(storage_path=path, flush_delay=3600.0, read_only=read_only)
+
+
+async def _is_empty(store: Base) -> bool:
+    async for _ in _guilds(store):
+        return False
+
+    async for _ in store.iter_tickets():
+        return False
+
+    return True
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        epilog="A json source is never written to, a sqlite source is upgraded "
+        "to the current schema first.",
+    )
+    parser.add_argument("--from", dest="source", choices=("json", "sqlite"), required=True)
+    parser.add_argument("--to", dest="target", choices=("json", "sqlite"), required=True)
+    parser.add_argument("--from-path", default="/bot_config/")
+    parser.add_argument("--to-path", default="/bot_config/")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.source == args.target and args.from_path == args.to_path:
+        print("Expected the source and target to be different stores")
+        return 1
+
+    source = _open(args.source, args.from_path, read_only=True)
+    target = _open(args.target, args.to_path)
+    try:
+        if not await _is_empty(target):
+            print(
+                f"The {args.target} store in {args.to_path} already holds data, not copying. "
+                "Use --to-path to copy into a new store instead"
+            )
+            return 1
+
+        report = await transfer(source, target, batch_size=args.batch_size)
+        print(
+            f"Copied {report.guilds} guilds and {report.tickets} tickets in "
+            f"{report.seconds:.2f}s ({report.tickets / max(report.seconds, 1e-9):.0f} tickets/s)"
+        )
+
+        start = time.perf_counter()
+        problems = await verify(source, target)
+        print(f"Verified in {time.perf_counter() - start:.2f}s")
+    finally:
+        try:
+            await target.close()
+        finally:
+            # Or its connection's thread keeps the process alive
+            await source.close()
+
+    for problem in problems:
+        print(problem)
+
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main()))
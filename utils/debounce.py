@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+log = logging.getLogger(__name__)
+
+
+class DebouncedFlusher:
+    """Calls ``flush`` once changes have settled, so a burst of them
+    results in a single write.
+
+    The first ``schedule`` after a flush starts a timer, those made
+    before it runs only ride along with it. The flush is shielded so
+    that ``cancel`` can't interrupt a write part way through, if it
+    fails the error is logged and the next change tries again.
+
+    Parameters
+    ----------
+    flush: Callable[[], Awaitable[None]]
+        Writes whatever has changed
+    delay: float
+        Seconds to wait for more changes before flushing
+    name: str
+        What is being written, for the log if a flush fails
+    """
+
+    def __init__(self, flush: Callable[[], Awaitable[None]], delay: float, *, name: str):
+        self.flush = flush
+        self.delay = delay
+        self.name = name
+
+        self._task: Optional[asyncio.Task] = None
+        self._now = asyncio.Event()
+
+    def schedule(self, *, now: bool = False) -> None:
+        """Flush after ``delay`` seconds, or straight away if ``now``."""
+        if now:
+            self._now.set()
+
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def cancel(self) -> None:
+        """Forget a scheduled flush, one already writing carries on."""
+        task, self._task = self._task, None
+        if task is None:
+            return
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.wait_for(self._now.wait(), self.delay)
+        except asyncio.TimeoutError:
+            pass
+
+        # Changes made while we write should schedule another flush
+        self._task = None
+        self._now.clear()
+        try:
+            await asyncio.shield(self.flush())
+        except Exception:
+            log.exception("Failed to write %s, will retry on the next change", self.name)
@@ -0,0 +1,496 @@
+import asyncio
+import datetime
+import gzip
+import html
+import io
+import logging
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+from string import Template
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import discord
+
+from .archive import ATTACHMENT_LIMIT
+from .db import MessageRecord
+from .metrics import metrics
+from .transcript import extra_lines
+
+log = logging.getLogger(__name__)
+
+# Bits of a message's flags in the intermediate form
+EDITED = 1
+DELETED = 2
+
+# (ticket_id, guild name, channel name, authors, messages), where authors
+# is ((author_id, name, avatar_url), ...) and messages is ((index into
+# authors, created_at, text, flags, attachments, embeds), ...)
+Payload = Tuple[int, str, str, tuple, tuple]
+
+# Messages from the same author this close together share a header
+_GROUP_SECONDS = 7 * 60
+_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+# Attachments and avatars are only linked to or shown from here
+_CDN_HOSTS = ("cdn.discordapp.com", "media.discordapp.net")
+
+
+class TranscriptRenderer:
+    """Renders closed tickets as HTML transcripts in worker processes.
+
+    Captured messages are serialised into a compact intermediate form
+    in the bot, which is all rendering needs from it, then turned into
+    HTML by a pool of ``workers`` processes. Each compiles its templates
+    once when it starts, and however large a ticket is the event loop
+    only pays for handing it over, so closing many tickets at once
+    spreads across cores rather than delaying the gateway.
+
+    Transcripts larger than ``compress_over`` bytes are gzipped.
+
+    Parameters
+    ----------
+    workers: int
+        How many processes render at once, 0 to disable
+    compress_over: int
+        Size in bytes after which transcripts are compressed
+    """
+
+    def __init__(self, *, workers: int = 2, compress_over: int = ATTACHMENT_LIMIT // 2):
+        self.workers = workers
+        self.compress_over = compress_over
+
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def start(self) -> None:
+        if not self.enabled or self._pool is not None:
+            return
+
+        # Spawned rather than forked, the bot has threads running
+        # (the store's connection) which a fork would copy mid use
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+
+    async def close(self) -> None:
+        """Wait for anything being rendered, then stop the workers."""
+        if self._pool is None:
+            return
+
+        pool = self._pool
+        self._pool = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, pool.shutdown)
+
+    async def render(
+        self,
+        channel: discord.TextChannel,
+        ticket_id: int,
+        records: Iterable[MessageRecord],
+    ) -> Optional[bytes]:
+        """Render a ticket's messages as an HTML page.
+
+        Parameters
+        ----------
+        channel: discord.TextChannel
+            The ticket's channel, for its name and its guild's members
+        ticket_id: int
+        records: Iterable[MessageRecord]
+            The ticket's messages, oldest first
+
+        Returns
+        -------
+        Optional[bytes]
+            The page, gzipped if larger than ``compress_over``. None
+            if rendering is disabled or failed.
+        """
+        if not self.enabled:
+            return None
+
+        self.start()
+        guild = channel.guild
+        payload = serialise(
+            records,
+            ticket_id=ticket_id,
+            guild_name=guild.name if guild is not None else "",
+            channel_name=channel.name,
+            avatar=lambda author_id: _avatar_url(guild, author_id),
+        )
+
+        loop = asyncio.get_running_loop()
+        try:
+            with metrics.timer("transcript_render_seconds"):
+                return await loop.run_in_executor(
+                    self._pool, render_payload, payload, self.compress_over
+                )
+        except Exception:
+            log.exception("Failed to render the HTML transcript for ticket %s", ticket_id)
+            return None
+
+    @staticmethod
+    def to_file(data: bytes, filename: str) -> discord.File:
+        """A rendered transcript as an attachment, named for whether it was compressed"""
+        if data[:2] == b"\x1f\x8b":
+            filename += ".gz"
+
+        return discord.File(io.BytesIO(data), filename=filename)
+
+
+def serialise(
+    records: Iterable[MessageRecord],
+    *,
+    ticket_id: int,
+    guild_name: str,
+    channel_name: str,
+    avatar: Callable[[int], str],
+) -> Payload:
+    """Everything rendering needs from a ticket, in a form cheap to pickle.
+
+    Each author is stored once, messages refer to them by index. The
+    lines attachments and embeds add to a message's content are left
+    out of its text, they are rendered from the record's own fields.
+
+    Parameters
+    ----------
+    avatar: Callable[[int], str]
+        Gives the avatar url for an author id, called once per author
+    """
+    authors: List[Tuple[int, str, str]] = []
+    # author id -> index into authors
+    indexes: Dict[int, int] = {}
+    messages = []
+    for record in records:
+        index = indexes.get(record.author_id)
+        if index is None:
+            index = indexes[record.author_id] = len(authors)
+            authors.append((record.author_id, record.author_name, avatar(record.author_id)))
+
+        text = record.content
+        extras = extra_lines(record.attachments, record.embeds)
+        if extras and text.endswith(extras):
+            text = text[: -len(extras)]
+
+        flags = (EDITED if record.edited_at else 0) | (DELETED if record.deleted else 0)
+        messages.append(
+            (index, record.created_at, text, flags, record.attachments, record.embeds)
+        )
+
+    return ticket_id, guild_name, channel_name, tuple(authors), tuple(messages)
+
+
+def _avatar_url(guild: Optional[discord.Guild], author_id: int) -> str:
+    member = guild.get_member(author_id) if guild is not None else None
+    if member is not None and member.avatar_url:
+        return str(member.avatar_url)
+
+    # The member cache is usually empty, see Bot.intent_profile
+    return _default_avatar(author_id)
+
+
+def _default_avatar(author_id: int) -> str:
+    return f"https://cdn.discordapp.com/embed/avatars/{(author_id >> 22) % 6}.png"
+
+
+# <-- Everything below runs in the worker processes -->
+
+_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>Ticket $ticket_id - #$channel</title>
+<style>$style</style>
+</head>
+<body>
+<header><h1>$guild</h1><p>#$channel &middot; Ticket $ticket_id &middot; $count messages</p></header>
+<main>
+$groups
+</main>
+</body>
+</html>
+"""
+
+_STYLE = (
+    "body{margin:0;background:#36393f;color:#dcddde;font:15px/1.4 sans-serif}"
+    "header{padding:16px 20px;border-bottom:1px solid #2f3136}"
+    "header h1{margin:0;font-size:20px;color:#fff}header p{margin:4px 0 0;color:#b9bbbe}"
+    ".group{display:flex;padding:8px 20px}"
+    ".avatar{width:40px;height:40px;border-radius:50%;margin-right:16px;flex-shrink:0}"
+    ".body{min-width:0;flex:1}.author{font-weight:600;color:#fff;margin-right:8px}"
+    ".time,.note{font-size:12px;color:#72767d}"
+    ".message{white-space:pre-wrap;word-wrap:break-word}"
+    ".deleted{color:#ed4245;text-decoration:line-through}"
+    "code{background:#2f3136;border-radius:3px;padding:0 3px;font-size:85%}"
+    "pre{background:#2f3136;border-radius:4px;padding:8px;white-space:pre-wrap}"
+    "pre code{background:none;padding:0}"
+    "blockquote{margin:0;padding-left:8px;border-left:4px solid #4f545c}"
+    ".spoiler{background:#202225;color:transparent}.spoiler:hover{color:inherit}"
+    ".mention{background:#414675;color:#dee0fc;border-radius:3px;padding:0 2px}"
+    "a{color:#00aff4}"
+    ".embed{border-left:4px solid #202225;background:#2f3136;border-radius:4px;"
+    "padding:8px 12px;margin-top:4px;max-width:520px}"
+    ".attachment{display:inline-block;background:#2f3136;border-radius:4px;"
+    "padding:8px 12px;margin-top:4px}"
+    ".attachment img{display:block;max-width:400px;max-height:300px}"
+)
+
+_GROUP = (
+    '<div class="group"><img class="avatar" src="$avatar" alt="" loading="lazy">'
+    '<div class="body"><div><span class="author">$author</span>'
+    '<span class="time">$time</span></div>\n$messages</div></div>'
+)
+_MESSAGE = '<div class="message$classes" title="$time">$content$extras$note</div>\n'
+_IMAGE = (
+    '<div class="attachment"><a href="$url"><img src="$url" alt="$name" '
+    'loading="lazy"></a></div>'
+)
+_ATTACHMENT = '<div class="attachment"><a href="$url">$name</a> <span class="note">$size</span></div>'
+# Anywhere other than Discord's CDN isn't linked to
+_UNLINKED = '<div class="attachment">$name <span class="note">$size $url</span></div>'
+_EMBED = '<div class="embed">$content</div>'
+
+# Set once per worker by _init_worker
+_compiled = None
+
+
+class _Compiled:
+    """Templates and patterns, built once per worker process"""
+
+    def __init__(self):
+        self.page = Template(_PAGE)
+        self.group = Template(_GROUP)
+        self.message = Template(_MESSAGE)
+        self.image = Template(_IMAGE)
+        self.attachment = Template(_ATTACHMENT)
+        self.unlinked = Template(_UNLINKED)
+        self.embed = Template(_EMBED)
+
+        self.code_block = re.compile(r"```(?:[\w+-]*\n)?(.*?)```", re.DOTALL)
+        self.quote = re.compile(r"> (.*)")
+        self.inline = re.compile(
+            r"`(?P<code>[^`\n]+)`"
+            r"|(?P<url>https?://[^\s<>\"']+)"
+            r"|\*\*(?P<bold>.+?)\*\*"
+            r"|__(?P<underline>.+?)__"
+            r"|~~(?P<strike>.+?)~~"
+            r"|\|\|(?P<spoiler>.+?)\|\|"
+            r"|\*(?P<italic>[^*\s](?:[^*]*[^*\s])?)\*"
+            r"|(?<!\w)_(?P<underscore>[^_\s](?:[^_]*[^_\s])?)_(?!\w)"
+            r"|<@!?(?P<user>\d+)>"
+            r"|<@&(?P<role>\d+)>"
+            r"|<#(?P<channel>\d+)>"
+        )
+
+
+def _init_worker() -> None:
+    global _compiled
+    _compiled = _Compiled()
+
+
+def render_payload(payload: Payload, compress_over: int = ATTACHMENT_LIMIT // 2) -> bytes:
+    """Render serialised messages as an HTML page.
+
+    Runs in a worker process, though nothing stops it running in
+    this one, compiling the templates on first use.
+    """
+    if _compiled is None:
+        _init_worker()
+
+    ticket_id, guild_name, channel_name, authors, messages = payload
+    compiled = _compiled
+    names = {author_id: name for author_id, name, _ in authors}
+
+    groups = []
+    current: List[str] = []
+    last_author = last_at = None
+    for index, created_at, text, flags, attachments, embeds in messages:
+        if current and (index != last_author or created_at - last_at > _GROUP_SECONDS):
+            groups.append(_group(compiled, authors[last_author], group_at, current))
+            current = []
+        if not current:
+            group_at = created_at
+        last_author, last_at = index, created_at
+
+        current.append(
+            _message(compiled, text, flags, created_at, attachments, embeds, names)
+        )
+
+    if current:
+        groups.append(_group(compiled, authors[last_author], group_at, current))
+
+    page = compiled.page.substitute(
+        ticket_id=ticket_id,
+        guild=html.escape(guild_name),
+        channel=html.escape(channel_name),
+        count=len(messages),
+        style=_STYLE,
+        groups="\n".join(groups),
+    ).encode("utf8")
+
+    if len(page) > compress_over:
+        return gzip.compress(page, 6)
+
+    return page
+
+
+def _group(compiled: _Compiled, author: tuple, created_at: float, messages: List[str]) -> str:
+    author_id, name, avatar = author
+    if not _is_cdn_url(avatar):
+        avatar = _default_avatar(author_id)
+
+    return compiled.group.substitute(
+        avatar=html.escape(avatar),
+        author=html.escape(name),
+        time=_format_time(created_at),
+        messages="".join(messages),
+    )
+
+
+def _message(
+    compiled: _Compiled,
+    text: str,
+    flags: int,
+    created_at: float,
+    attachments: tuple,
+    embeds: tuple,
+    names: Dict[int, str],
+) -> str:
+    extras = []
+    for name, size, url in attachments:
+        name = str(name)
+        if not _is_cdn_url(url):
+            template = compiled.unlinked
+        elif name.lower().endswith(_IMAGE_EXTENSIONS):
+            template = compiled.image
+        else:
+            template = compiled.attachment
+
+        extras.append(
+            template.substitute(
+                url=html.escape(str(url)), name=html.escape(name), size=_format_size(size)
+            )
+        )
+
+    for title, description in embeds:
+        content = _markdown(compiled, f"{title} {description}".strip(), names)
+        extras.append(compiled.embed.substitute(content=content))
+
+    note = ""
+    classes = ""
+    if flags & DELETED:
+        classes = " deleted"
+        note = ' <span class="note">(deleted)</span>'
+    elif flags & EDITED:
+        note = ' <span class="note">(edited)</span>'
+
+    return compiled.message.substitute(
+        classes=classes,
+        time=_format_time(created_at),
+        content=_markdown(compiled, text, names),
+        extras="".join(extras),
+        note=note,
+    )
+
+
+def _markdown(compiled: _Compiled, text: str, names: Dict[int, str]) -> str:
+    """The subset of Discord's markdown transcripts need, escaping everything else"""
+    parts = []
+    position = 0
+    for match in compiled.code_block.finditer(text):
+        parts.append(_blocks(compiled, text[position : match.start()], names))
+        parts.append(f"<pre><code>{html.escape(match[1])}</code></pre>")
+        position = match.end()
+
+    parts.append(_blocks(compiled, text[position:], names))
+    return "".join(parts)
+
+
+def _blocks(compiled: _Compiled, text: str, names: Dict[int, str]) -> str:
+    lines = []
+    quoted = []
+    for line in text.split("\n"):
+        match = compiled.quote.match(line)
+        if match:
+            quoted.append(_inline(compiled, match[1], names))
+            continue
+
+        if quoted:
+            lines.append(f"<blockquote>{'<br>'.join(quoted)}</blockquote>")
+            quoted = []
+        lines.append(_inline(compiled, line, names))
+
+    if quoted:
+        lines.append(f"<blockquote>{'<br>'.join(quoted)}</blockquote>")
+
+    return "\n".join(lines)
+
+
+def _inline(compiled: _Compiled, text: str, names: Dict[int, str]) -> str:
+    parts = []
+    position = 0
+    for match in compiled.inline.finditer(text):
+        parts.append(html.escape(text[position : match.start()]))
+        position = match.end()
+
+        kind = match.lastgroup
+        value = match[kind]
+        if kind == "code":
+            parts.append(f"<code>{html.escape(value)}</code>")
+        elif kind == "url":
+            url = html.escape(value)
+            parts.append(f'<a href="{url}" rel="noopener">{url}</a>')
+        elif kind == "user":
+            name = names.get(int(value), value)
+            parts.append(f'<span class="mention">@{html.escape(name)}</span>')
+        elif kind == "role":
+            parts.append(f'<span class="mention">@{value}</span>')
+        elif kind == "channel":
+            parts.append(f'<span class="mention">#{value}</span>')
+        else:
+            tag, attributes = _TAGS[kind]
+            parts.append(f"<{tag}{attributes}>{_inline(compiled, value, names)}</{tag}>")
+
+    parts.append(html.escape(text[position:]))
+    return "".join(parts)
+
+
+_TAGS = {
+    "bold": ("strong", ""),
+    "underline": ("u", ""),
+    "strike": ("s", ""),
+    "spoiler": ("span", ' class="spoiler"'),
+    "italic": ("em", ""),
+    "underscore": ("em", ""),
+}
+
+
+def _format_time(created_at: float) -> str:
+    value = datetime.datetime.fromtimestamp(created_at, datetime.timezone.utc)
+    return value.strftime("%d/%m/%Y %H:%M")
+
+
+def _is_cdn_url(url) -> bool:
+    try:
+        parts = urlsplit(str(url))
+    except ValueError:
+        return False
+
+    return parts.scheme == "https" and parts.hostname in _CDN_HOSTS
+
+
+def _format_size(size) -> str:
+    if not isinstance(size, int):
+        return ""
+
+    if size < 1024:
+        return f"{size} bytes"
+
+    if size < 1024 * 1024:
+        return f"{size / 1024:.1f} KB"
+
+    return f"{size / 1024 / 1024:.1f} MB"
@@ -0,0 +1,326 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import discord
+
+from .debounce import DebouncedFlusher
+from .metrics import metrics
+from .request_scheduler import BACKGROUND, request_scheduler
+from .ticket import Ticket
+
+log = logging.getLogger(__name__)
+
+
+class InactivityScheduler:
+    """Warns, then closes, tickets nobody has spoken in for a while.
+
+    Each tracked ticket has a single deadline, for either its warning
+    or its closing, kept in a min-heap so the next one due is always
+    on top. The scheduler sleeps until then rather than polling every
+    ticket. A new message only moves the ticket's last activity
+    forward, its heap entry is checked when it comes due and pushed
+    back if the ticket has been active since, so a busy ticket costs
+    a dict write per message and never grows the heap.
+
+    Activity is saved to the store ``flush_delay`` seconds after the
+    first change, in a single batch, so deadlines survive restarts.
+    Tickets with no stored activity start from the channel's last
+    message, or its creation if the channel isn't cached.
+
+    Parameters
+    ----------
+    bot
+        Provides the store and channels, and is what closes tickets
+    close_after: float
+        Seconds without a message before a ticket is closed,
+        None to never close tickets for inactivity
+    warn_before: float
+        Seconds before closing that the ticket is warned
+    flush_delay: float
+        Seconds to wait for more activity before saving it
+    max_concurrent: int
+        How many tickets may be warned or closed at once
+    """
+
+    def __init__(
+        self,
+        bot,
+        *,
+        close_after: Optional[float] = None,
+        warn_before: float = 3600.0,
+        flush_delay: float = 10.0,
+        max_concurrent: int = 5,
+    ):
+        if close_after is not None and warn_before >= close_after:
+            raise RuntimeError("Expected warn_before to be less than close_after")
+
+        self.bot = bot
+        self.close_after = close_after
+        self.warn_before = warn_before
+        self.flush_delay = flush_delay
+
+        # channel_id -> (last_active_at, warned_at)
+        self._activity: Dict[int, Tuple[float, Optional[float]]] = {}
+        # channel_id -> the deadline of its live heap entry, any
+        # other entries for the channel are stale and skipped
+        self._scheduled: Dict[int, float] = {}
+        self._heap: List[Tuple[float, int]] = []
+        self._dirty: Set[int] = set()
+
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._task: Optional[asyncio.Task] = None
+        self._flusher = DebouncedFlusher(self.flush, flush_delay, name="ticket activity")
+        self._flush_lock = asyncio.Lock()
+        self._actions: Set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.close_after is not None
+
+    @property
+    def tracked(self) -> int:
+        """How many tickets have a deadline"""
+        return len(self._activity)
+
+    def start(self) -> None:
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run(), name="inactivity-scheduler")
+
+    async def close(self) -> None:
+        tasks = [self._task] if self._task is not None else []
+        tasks.extend(self._actions)
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, self._flusher.cancel(), return_exceptions=True)
+        self._task = None
+        await self.flush()
+
+    def track(self, channel_id: int, when: float = None) -> None:
+        """Record activity in a ticket, tracking it if it wasn't already.
+
+        Parameters
+        ----------
+        channel_id: int
+            The ticket's channel
+        when: float
+            Unix timestamp of the activity, defaults to now
+        """
+        if not self.enabled:
+            return
+
+        when = time.time() if when is None else when
+        current = self._activity.get(channel_id)
+        if current is not None and current[0] >= when:
+            return
+
+        # Any warning no longer applies
+        self._activity[channel_id] = (when, None)
+        self._schedule(channel_id)
+        self._mark_dirty(channel_id)
+
+    def forget(self, channel_id: int) -> None:
+        """Stop tracking a ticket, e.g. as it was closed."""
+        self._activity.pop(channel_id, None)
+        self._scheduled.pop(channel_id, None)
+        self._dirty.discard(channel_id)
+
+    async def on_message(self, message: discord.Message) -> None:
+        # Our own messages, like the warning, don't count as activity
+        if not self.enabled or message.author.bot:
+            return
+
+        channel_id = message.channel.id
+        if channel_id not in self._activity:
+            if not await self.bot.ticket_db.check_is_ticket(channel_id):
+                return
+
+        self.track(channel_id)
+
+    async def load(self) -> int:
+        """Track every stored ticket, from its stored activity.
+
+        Returns
+        -------
+        int
+            How many tickets were loaded
+        """
+        loaded = 0
+        async for ticket in self.bot.ticket_db.iter_tickets():
+            last_active_at = ticket.last_active_at
+            if last_active_at is None:
+                last_active_at = self._last_message_at(ticket.channel_id)
+
+            current = self._activity.get(ticket.channel_id)
+            if current is not None and current[0] >= last_active_at:
+                # Active since we started
+                continue
+
+            self._activity[ticket.channel_id] = (last_active_at, ticket.warned_at)
+            self._schedule(ticket.channel_id)
+            loaded += 1
+
+        log.info("Tracking %s tickets for inactivity", len(self._activity))
+        return loaded
+
+    async def flush(self) -> None:
+        """Save the activity recorded so far to the store now."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+
+            dirty, self._dirty = self._dirty, set()
+            activity = [
+                (channel_id, *self._activity[channel_id])
+                for channel_id in dirty
+                if channel_id in self._activity
+            ]
+            try:
+                await self.bot.ticket_db.save_ticket_activity(activity)
+            except Exception:
+                # Anything recorded in the meantime is already marked
+                self._dirty |= {channel_id for channel_id, *_ in activity}
+                raise
+
+    def _deadline(self, channel_id: int) -> float:
+        last_active_at, warned_at = self._activity[channel_id]
+        if warned_at is None:
+            return last_active_at + self.close_after - self.warn_before
+
+        # The full warning is given, even if it went out late
+        return max(last_active_at + self.close_after, warned_at + self.warn_before)
+
+    def _schedule(self, channel_id: int) -> None:
+        """Give the ticket a heap entry, unless it has one due no later."""
+        deadline = self._deadline(channel_id)
+        scheduled = self._scheduled.get(channel_id)
+        if scheduled is not None and scheduled <= deadline:
+            # Checked when it comes due, and pushed back then
+            return
+
+        if not self._heap or deadline < self._heap[0][0]:
+            # The scheduler is sleeping until something later
+            self._wakeup.set()
+
+        self._scheduled[channel_id] = deadline
+        heapq.heappush(self._heap, (deadline, channel_id))
+
+    def _pop_due(self, now: float) -> List[int]:
+        """Remove and return every ticket whose deadline has passed."""
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, channel_id = heapq.heappop(heap)
+            if self._scheduled.get(channel_id) != deadline:
+                # Forgotten, or superseded by an earlier entry
+                continue
+
+            del self._scheduled[channel_id]
+            if self._deadline(channel_id) > now:
+                # Active since this was scheduled
+                self._schedule(channel_id)
+                continue
+
+            due.append(channel_id)
+
+        return due
+
+    async def _run(self) -> None:
+        # Channels must be cached to tell when they were last active
+        await self.bot.wait_until_ready()
+        await self.load()
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            for channel_id in self._pop_due(now):
+                last_active_at, warned_at = self._activity[channel_id]
+                if warned_at is None:
+                    self._activity[channel_id] = (last_active_at, now)
+                    self._schedule(channel_id)
+                    self._mark_dirty(channel_id)
+                    self._spawn(self._warn(channel_id))
+                else:
+                    self.forget(channel_id)
+                    self._spawn(self._close(channel_id))
+
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.get_running_loop().create_task(self._limited(coro))
+        self._actions.add(task)
+        task.add_done_callback(self._actions.discard)
+
+    async def _limited(self, coro) -> None:
+        async with self._semaphore:
+            try:
+                await coro
+            except Exception:
+                log.exception("Failed to act on an inactive ticket")
+
+    async def _ticket_channel(self, channel_id: int) -> Optional[discord.TextChannel]:
+        channel = self.bot.get_channel(channel_id)
+        if channel is None or not await self.bot.ticket_db.check_is_ticket(channel_id):
+            # Closed, or left for the reconciler
+            self.forget(channel_id)
+            return None
+
+        return channel
+
+    async def _warn(self, channel_id: int) -> None:
+        channel = await self._ticket_channel(channel_id)
+        if channel is None:
+            return
+
+        embed = discord.Embed(
+            description=f"This ticket will be closed in {_duration(self.warn_before)} "
+            f"unless somebody replies.",
+            color=0xF42069,
+        )
+        await request_scheduler.request(
+            "send_message", channel.send(embed=embed), major=channel.id, priority=BACKGROUND
+        )
+        metrics.increment("inactive_tickets_total", action="warned")
+
+    async def _close(self, channel_id: int) -> None:
+        channel = await self._ticket_channel(channel_id)
+        if channel is None:
+            return
+
+        log.info("Closing ticket channel %s for inactivity", channel_id)
+        await Ticket.inactive_close_ticket(
+            self.bot,
+            channel,
+            f"No messages for {_duration(self.close_after)}.",
+        )
+        metrics.increment("inactive_tickets_total", action="closed")
+
+    def _last_message_at(self, channel_id: int) -> float:
+        channel = self.bot.get_channel(channel_id)
+        snowflake = getattr(channel, "last_message_id", None) or channel_id
+        return discord.utils.snowflake_time(snowflake).replace(
+            tzinfo=datetime.timezone.utc
+        ).timestamp()
+
+    def _mark_dirty(self, channel_id: int) -> None:
+        self._dirty.add(channel_id)
+        self._flusher.schedule()
+
+
+def _duration(seconds: float) -> str:
+    """Roughly how long this is, e.g. '2 hours'"""
+    for unit, size in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds >= size:
+            count = round(seconds / size)
+            return f"{count} {unit}{'s' if count != 1 else ''}"
+
+    count = round(seconds)
+    return f"{count} second{'s' if count != 1 else ''}"
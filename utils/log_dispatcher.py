@@ -0,0 +1,224 @@
+import asyncio
+import inspect
+import logging
+import os
+from collections import deque
+from typing import Deque, List, NamedTuple, Optional, Tuple
+
+import discord
+from discord.http import Route
+
+from .archive import ATTACHMENT_LIMIT
+from .metrics import metrics
+from .request_scheduler import BACKGROUND, request_scheduler
+
+log = logging.getLogger(__name__)
+
+# Discord's limits for a single message
+MAX_EMBEDS = 10
+MAX_EMBED_CHARACTERS = 6000
+MAX_FILES = 10
+
+
+class _Entry(NamedTuple):
+    channel: discord.TextChannel
+    embed: discord.Embed
+    files: Tuple[discord.File, ...]
+    size: int
+
+
+class LogDispatcher:
+    """Sends log channel embeds in the background, several per message.
+
+    Logs are queued by ``submit``, which never waits. Every
+    ``flush_interval`` seconds whatever has been queued is merged
+    into as few messages as Discord's limits allow, each file
+    travelling in the same message as the embed it belongs to.
+
+    Parameters
+    ----------
+    flush_interval: float
+        Seconds to collect logs for before sending them
+    max_size: int
+        How many logs may be waiting before new ones are dropped
+    """
+
+    def __init__(self, *, flush_interval: float = 1.0, max_size: int = 1000):
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+
+        self._entries: Deque[_Entry] = deque()
+        self._wakeup = asyncio.Event()
+        self._send_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        """How many logs are waiting to be sent"""
+        return len(self._entries)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="log-dispatcher")
+
+    async def close(self) -> None:
+        """Stop the background task, then send anything still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        await self.flush()
+
+    def submit(
+        self,
+        channel: discord.TextChannel,
+        embed: discord.Embed,
+        file: discord.File = None,
+        *,
+        files: List[discord.File] = None,
+    ) -> bool:
+        """Queue a log to be sent, with a file or several.
+
+        Returns
+        -------
+        bool
+            False if the queue was full and the log was dropped
+        """
+        if len(self._entries) >= self.max_size:
+            log.warning("Log queue is full, dropping '%s'", embed.title)
+            metrics.increment("log_events_dropped_total")
+            return False
+
+        files = tuple(files or ()) + ((file,) if file is not None else ())
+        self._entries.append(
+            _Entry(channel, embed, files, sum(_file_size(f) for f in files))
+        )
+        self._wakeup.set()
+        return True
+
+    async def flush(self) -> None:
+        """Send everything queued now."""
+        # One flush at a time, so logs arrive in the order they were made
+        async with self._send_lock:
+            while self._entries:
+                entries = list(self._entries)
+                self._entries.clear()
+
+                # Each guild logs to its own channel, those are
+                # independent of each other so are sent concurrently
+                channels = {}
+                for batch in self._batches(entries):
+                    channels.setdefault(batch[0].channel.id, []).append(batch)
+
+                await asyncio.gather(
+                    *(self._send_in_order(batches) for batches in channels.values())
+                )
+
+    async def _send_in_order(self, batches: List[List[_Entry]]) -> None:
+        for batch in batches:
+            try:
+                # Behind anything a user is waiting on
+                await request_scheduler.request(
+                    "send_logs",
+                    self._send(batch),
+                    major=batch[0].channel.id,
+                    priority=BACKGROUND,
+                )
+            except Exception:
+                log.exception("Failed to send %s logs", len(batch))
+                metrics.increment("log_events_dropped_total", len(batch))
+            else:
+                metrics.increment("log_messages_sent_total")
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            # Give anything else happening at the same time a chance to join in
+            await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+
+            # Shielded so that close() can't interrupt a send part way through
+            await asyncio.shield(self.flush())
+
+    @staticmethod
+    def _batches(entries: List[_Entry]) -> List[List[_Entry]]:
+        """Group entries per channel into batches within Discord's limits."""
+        batches: List[List[_Entry]] = []
+        # channel id -> the batch currently being filled for it
+        current = {}
+        for entry in entries:
+            batch = current.get(entry.channel.id)
+            if batch is not None and not _fits(batch, entry):
+                batch = None
+
+            if batch is None:
+                batch = current[entry.channel.id] = []
+                batches.append(batch)
+
+            batch.append(entry)
+
+        return batches
+
+    @staticmethod
+    async def _send(batch: List[_Entry]) -> None:
+        channel = batch[0].channel
+        embeds = [entry.embed for entry in batch]
+        files = [file for entry in batch for file in entry.files]
+
+        if "embeds" in inspect.signature(channel.send).parameters:
+            await channel.send(embeds=embeds, files=files or None)
+            return
+
+        # discord.py 1.7 only sends a single embed per message,
+        # so build the request it would have made ourselves
+        route = Route("POST", "/channels/{channel_id}/messages", channel_id=channel.id)
+        payload = {"embeds": [embed.to_dict() for embed in embeds]}
+        http = channel._state.http
+        if not files:
+            await http.request(route, json=payload)
+            return
+
+        form = [{"name": "payload_json", "value": discord.utils.to_json(payload)}]
+        for index, file in enumerate(files):
+            form.append(
+                {
+                    "name": f"file{index}",
+                    "value": file.fp,
+                    "filename": file.filename,
+                    "content_type": "application/octet-stream",
+                }
+            )
+
+        try:
+            await http.request(route, form=form, files=files)
+        finally:
+            for file in files:
+                file.close()
+
+
+def _fits(batch: List[_Entry], entry: _Entry) -> bool:
+    if len(batch) >= MAX_EMBEDS:
+        return False
+
+    if sum(len(e.embed) for e in batch) + len(entry.embed) > MAX_EMBED_CHARACTERS:
+        return False
+
+    if not entry.files:
+        return True
+
+    return (
+        sum(len(e.files) for e in batch) + len(entry.files) <= MAX_FILES
+        and sum(e.size for e in batch) + entry.size <= ATTACHMENT_LIMIT
+    )
+
+
+def _file_size(file: discord.File) -> int:
+    try:
+        return file.fp.getbuffer().nbytes
+    except AttributeError:
+        pass
+
+    try:
+        return os.fstat(file.fp.fileno()).st_size
+    except (AttributeError, OSError):
+        return 0
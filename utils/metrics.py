@@ -0,0 +1,234 @@
+import asyncio
+import bisect
+import logging
+import time
+from typing import Callable, Dict, Tuple
+
+log = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the histogram buckets timers are sorted into
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class _NullTimer:
+    """Handed out while metrics are disabled so timing costs nothing"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: "_Histogram"):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        index = bisect.bisect_left(BUCKETS, seconds)
+        if index < len(BUCKETS):
+            self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+
+class Metrics:
+    """Timers, counters and gauges for the bot's hot paths.
+
+    Everything is a no-op until ``enabled`` is set, so the
+    instrumentation can stay in place at no real cost.
+
+    Parameters
+    ----------
+    prefix: str
+        Prepended to every metric name when exported
+    """
+
+    def __init__(self, prefix: str = "ticketbot"):
+        self.prefix = prefix
+        self.enabled = False
+
+        self._histograms: Dict[Key, _Histogram] = {}
+        self._counters: Dict[Key, float] = {}
+        self._gauges: Dict[Key, Callable[[], float]] = {}
+
+    def timer(self, name: str, **labels):
+        """A context manager recording how long its body took.
+
+        Parameters
+        ----------
+        name: str
+            The metric to record into, should end in ``_seconds``
+        labels
+            Used to tell apart timings recorded into the same metric
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = _Histogram()
+
+        return _Timer(histogram)
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, func: Callable[[], float], **labels) -> None:
+        """Register a function which is read whenever metrics are exported."""
+        self._gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def reset(self) -> None:
+        self._histograms.clear()
+        self._counters.clear()
+
+    def render(self) -> str:
+        """Everything collected so far, in the Prometheus text format."""
+        lines = []
+        typed = set()
+
+        def header(name: str, kind: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            name = f"{self.prefix}_{name}"
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(
+                    f"{name}_bucket{self._labels(labels, le=bound)} {cumulative}"
+                )
+            lines.append(
+                f"{name}_bucket{self._labels(labels, le='+Inf')} {histogram.count}"
+            )
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.total}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+
+        for (name, labels), value in sorted(self._counters.items()):
+            name = f"{self.prefix}_{name}"
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+
+        for (name, labels), func in sorted(self._gauges.items(), key=lambda i: i[0]):
+            name = f"{self.prefix}_{name}"
+            header(name, "gauge")
+            lines.append(f"{name}{self._labels(labels)} {func()}")
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """A short human readable version of ``render``, for the logs."""
+        lines = []
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            if not histogram.count:
+                continue
+
+            lines.append(
+                f"{name}{self._labels(labels)}: {histogram.count} calls, "
+                f"avg {histogram.total / histogram.count * 1000:.2f}ms, "
+                f"max {histogram.max * 1000:.2f}ms"
+            )
+
+        for (name, labels), value in sorted(self._counters.items()):
+            lines.append(f"{name}{self._labels(labels)}: {value:g}")
+
+        for (name, labels), func in sorted(self._gauges.items(), key=lambda i: i[0]):
+            lines.append(f"{name}{self._labels(labels)}: {func():g}")
+
+        return "\n".join(lines)
+
+    async def log_periodically(self, interval: float) -> None:
+        """Log a summary every ``interval`` seconds, until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            summary = self.summary()
+            if summary:
+                log.info("Metrics since start up:\n%s", summary)
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 9100):
+        """Expose ``render`` over HTTP at /metrics.
+
+        Returns
+        -------
+        aiohttp.web.AppRunner
+            Call ``cleanup`` on this to stop serving
+        """
+        # aiohttp comes with discord.py, so only import it if we need it
+        from aiohttp import web
+
+        async def handler(request):
+            return web.Response(text=self.render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        log.info("Serving metrics on http://%s:%s/metrics", host, port)
+        return runner
+
+    @staticmethod
+    def _labels(labels, **extra) -> str:
+        pairs = list(labels) + list(extra.items())
+        if not pairs:
+            return ""
+
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class RateLimitCounter(logging.Handler):
+    """Counts the rate limit warnings discord.py logs.
+
+    discord.py handles rate limits internally and only tells
+    us about them through its logger, so listen there.
+    """
+
+    def __init__(self, metrics: Metrics):
+        super().__init__(level=logging.WARNING)
+        self.metrics = metrics
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if "rate limited" in record.getMessage():
+            self.metrics.increment("rate_limits_total")
+
+
+# Shared by everything in the bot, enabled from Bot
+metrics = Metrics()
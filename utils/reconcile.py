@@ -0,0 +1,146 @@
+import asyncio
+import datetime
+import logging
+from typing import List, Optional
+
+import discord
+
+from .db import TicketRecord
+from .metrics import metrics
+from .transcript import write_stored_transcript
+
+log = logging.getLogger(__name__)
+
+
+class TicketReconciler:
+    """Forgets tickets whose channels no longer exist.
+
+    Channels deleted by hand, or while the bot was offline, leave
+    their ticket behind in the store. Those are found on start up
+    and every ``interval`` seconds after by checking every stored
+    ticket against the guilds' cached channels, no requests needed,
+    and removed in a single batch. ``on_guild_channel_delete``
+    catches the rest as they happen.
+
+    Anything captured from an orphaned ticket is archived first, so
+    its transcript is still available to the `transcript` command.
+
+    Parameters
+    ----------
+    bot
+        Provides the store, guilds, message capture and archive
+    interval: float
+        Seconds between reconciliations, None to only run on start up
+    grace_period: float
+        Channels younger than this many seconds are left alone, as
+        they may not have reached the cache yet
+    """
+
+    def __init__(
+        self,
+        bot,
+        *,
+        interval: Optional[float] = 3600.0,
+        grace_period: float = 300.0,
+    ):
+        self.bot = bot
+        self.interval = interval
+        self.grace_period = grace_period
+
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="ticket-reconciler")
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def reconcile(self) -> int:
+        """Remove every ticket whose channel is gone.
+
+        Guilds that aren't available are skipped, as their
+        channels can't be told apart from deleted ones.
+
+        Returns
+        -------
+        int
+            How many tickets were removed
+        """
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=self.grace_period
+        )
+        orphans: List[TicketRecord] = []
+        with metrics.timer("reconcile_seconds"):
+            async for ticket in self.bot.ticket_db.iter_tickets():
+                guild = self.bot.get_guild(ticket.guild_id)
+                if guild is None or guild.unavailable:
+                    continue
+
+                if guild.get_channel(ticket.channel_id) is not None:
+                    continue
+
+                # Naive in discord.py 1.7, aware from 2.0, UTC either way
+                created_at = discord.utils.snowflake_time(ticket.channel_id).replace(
+                    tzinfo=datetime.timezone.utc
+                )
+                if created_at > cutoff:
+                    continue
+
+                orphans.append(ticket)
+
+            await self.finalise(orphans)
+
+        if orphans:
+            log.info("Removed %s tickets whose channels no longer exist", len(orphans))
+        return len(orphans)
+
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel) -> None:
+        ticket = await self.bot.ticket_db.get_ticket(channel.id)
+        if ticket is None:
+            # Not a ticket, or closed with the close command
+            return
+
+        log.info("Ticket %s's channel was deleted, removing it", ticket.ticket_id)
+        await self.finalise([ticket])
+
+    async def finalise(self, tickets: List[TicketRecord]) -> None:
+        """Archive whatever was captured from these tickets, then remove them."""
+        if not tickets:
+            return
+
+        bot = self.bot
+        await bot.message_capture.flush()
+        for ticket in tickets:
+            try:
+                async with bot.transcript_archive.writer(
+                    ticket.guild_id, ticket.ticket_id, ticket.channel_id, ticket.author_id
+                ) as writer:
+                    await write_stored_transcript(
+                        bot.ticket_db, writer, ticket.ticket_id, ticket.channel_id
+                    )
+            except Exception:
+                # Losing the transcript is better than keeping the ticket forever
+                log.exception("Failed to archive ticket %s", ticket.ticket_id)
+
+        await bot.ticket_db.remove_tickets(ticket.channel_id for ticket in tickets)
+        metrics.increment("tickets_reconciled_total", len(tickets))
+
+    async def _run(self) -> None:
+        # The guilds' channels must be cached before anything is compared
+        await self.bot.wait_until_ready()
+        while True:
+            try:
+                await self.reconcile()
+            except Exception:
+                log.exception("Failed to reconcile tickets, will retry next time")
+
+            if self.interval is None:
+                return
+
+            await asyncio.sleep(self.interval)
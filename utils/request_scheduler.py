@@ -0,0 +1,267 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Deque, Dict, Optional, Tuple, TypeVar
+
+from .metrics import metrics
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Someone is waiting on these, e.g. their ticket channel appearing
+INTERACTIVE = "interactive"
+# Nobody is, e.g. log messages, transcripts and refilling the channel pool
+BACKGROUND = "background"
+# Highest priority first
+PRIORITIES = (INTERACTIVE, BACKGROUND)
+
+# Discord allows this many requests, per this many seconds, across every route
+GLOBAL_LIMIT = (50, 1.0)
+# The limits Discord applies to the routes the bot uses most, for each
+# channel or guild. Discord may change these, discord.py still waits
+# out any rate limit that gets through.
+ROUTE_LIMITS: Dict[str, Tuple[int, float]] = {
+    "send_message": (5, 5.0),
+    "add_reaction": (1, 0.25),
+}
+# Routes which Discord counts against another route's limit
+SHARED_LIMITS = {
+    "send_logs": "send_message",
+    "remove_reaction": "add_reaction",
+}
+
+
+class _Window:
+    """The times of the last ``limit`` requests, as Discord counts them"""
+
+    __slots__ = ("limit", "per", "sent")
+
+    def __init__(self, limit: int, per: float):
+        self.limit = limit
+        self.per = per
+        self.sent: Deque[float] = deque(maxlen=limit)
+
+    def ready_at(self, now: float, limit: int = None) -> float:
+        """When another request can be sent, now or later, keeping
+        within ``limit`` rather than the window's own"""
+        limit = self.limit if limit is None else limit
+        if len(self.sent) < limit:
+            return now
+
+        return max(now, self.sent[len(self.sent) - limit] + self.per)
+
+    def take(self, now: float) -> None:
+        self.sent.append(now)
+
+
+class _Waiter:
+    __slots__ = ("key", "future")
+
+    def __init__(self, key, future: asyncio.Future):
+        self.key = key
+        self.future = future
+
+
+class RequestScheduler:
+    """Sends requests to Discord in priority order, within its rate limits.
+
+    Every request belongs to a route, optionally per channel or guild
+    (its major parameter) as Discord's limits are. A request is sent
+    straight away while its route and the global limit have room,
+    otherwise it waits. Waiting interactive requests always go before
+    waiting background ones, so a flood of logs never delays a user's
+    ticket. Within a priority, requests go in the order they were made,
+    though one stuck behind its route's limit doesn't hold up others.
+
+    Routes without a limit in ``route_limits`` are only held back by
+    ``global_limit``. Both are None and empty by default, making this
+    a pass through until configured. Call ``reset`` after changing
+    them once requests have been made.
+
+    Background requests never use the last ``interactive_reserve`` of
+    the global limit. Opening a ticket takes a few requests one after
+    another, without it each would wait for background ones to give
+    up a slot.
+
+    Parameters
+    ----------
+    global_limit: Tuple[int, float]
+        (requests, per seconds) across every route, None for no limit
+    route_limits: Dict[str, Tuple[int, float]]
+        Route -> (requests, per seconds), for each major parameter
+    interactive_reserve: float
+        Share of the global limit kept for interactive requests
+    """
+
+    def __init__(
+        self,
+        *,
+        global_limit: Optional[Tuple[int, float]] = None,
+        route_limits: Dict[str, Tuple[int, float]] = None,
+        interactive_reserve: float = 0.2,
+    ):
+        self.global_limit = global_limit
+        self.route_limits = route_limits or {}
+        self.interactive_reserve = interactive_reserve
+
+        self._global: Optional[_Window] = None
+        self._windows: Dict[Tuple[str, Optional[int]], _Window] = {}
+        self._waiting: Dict[str, Deque[_Waiter]] = {
+            priority: deque() for priority in PRIORITIES
+        }
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def reset(self) -> None:
+        """Forget every request sent so far, e.g. after changing the limits."""
+        self._global = None
+        self._windows.clear()
+
+    def depth(self, priority: str) -> int:
+        """How many requests of this priority are waiting"""
+        return len(self._waiting[priority])
+
+    async def request(
+        self,
+        route: str,
+        coro: Awaitable[T],
+        *,
+        major: int = None,
+        priority: str = INTERACTIVE,
+    ) -> T:
+        """Await a request to Discord once it is its turn.
+
+        Parameters
+        ----------
+        route: str
+            What the request does, e.g. ``send_message``, it is
+            timed under this in the ``discord_request_seconds`` metric
+        coro
+            The request itself, not yet awaited
+        major: int
+            The channel or guild id Discord's limit for the route is per
+        priority: str
+            INTERACTIVE or BACKGROUND
+        """
+        try:
+            with metrics.timer("request_queue_seconds", priority=priority):
+                await self._acquire(route, major, priority)
+        except BaseException:
+            # Never going to be sent
+            coro.close()
+            raise
+
+        with metrics.timer("discord_request_seconds", route=route):
+            return await coro
+
+    async def _acquire(self, route: str, major: Optional[int], priority: str) -> None:
+        key = (SHARED_LIMITS.get(route, route), major)
+        loop = asyncio.get_running_loop()
+
+        # Nobody to queue behind, the usual case
+        ahead = any(self._waiting[p] for p in PRIORITIES[: PRIORITIES.index(priority) + 1])
+        if not ahead and self._ready_at(key, loop.time(), priority) <= loop.time():
+            self._take(key, loop.time())
+            return
+
+        waiter = _Waiter(key, loop.create_future())
+        self._waiting[priority].append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if not waiter.future.done():
+                self._waiting[priority].remove(waiter)
+            raise
+
+    def _dispatch(self) -> None:
+        """Let every waiting request that can go, go."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        next_at = None
+        for priority in PRIORITIES:
+            waiting = self._waiting[priority]
+            remaining: Deque[_Waiter] = deque()
+            # Routes with a request already stuck, those behind it must wait too
+            blocked = set()
+            while waiting:
+                waiter = waiting.popleft()
+                if waiter.future.done():
+                    # Cancelled
+                    continue
+
+                if self._global is not None:
+                    global_at = self._global.ready_at(now, self._global_limit(priority))
+                    if global_at > now:
+                        # Nothing else can go, lower priorities included
+                        remaining.append(waiter)
+                        remaining.extend(waiting)
+                        waiting.clear()
+                        self._waiting[priority] = remaining
+                        self._schedule(loop, global_at)
+                        return
+
+                ready_at = self._ready_at(waiter.key, now, priority)
+                if waiter.key in blocked or ready_at > now:
+                    blocked.add(waiter.key)
+                    remaining.append(waiter)
+                    next_at = ready_at if next_at is None else min(next_at, ready_at)
+                    continue
+
+                self._take(waiter.key, now)
+                waiter.future.set_result(None)
+
+            self._waiting[priority] = remaining
+
+        if next_at is not None:
+            self._schedule(loop, next_at)
+
+    def _schedule(self, loop: asyncio.AbstractEventLoop, when: float) -> None:
+        self._timer = loop.call_at(when, self._dispatch)
+
+    def _global_limit(self, priority: str) -> int:
+        limit = self.global_limit[0]
+        if priority == INTERACTIVE:
+            return limit
+
+        return max(1, limit - int(limit * self.interactive_reserve))
+
+    def _ready_at(self, key: Tuple[str, Optional[int]], now: float, priority: str) -> float:
+        ready_at = now
+        if self.global_limit is not None:
+            if self._global is None:
+                self._global = _Window(*self.global_limit)
+            ready_at = self._global.ready_at(now, self._global_limit(priority))
+
+        window = self._window(key)
+        if window is not None:
+            ready_at = max(ready_at, window.ready_at(now))
+
+        return ready_at
+
+    def _take(self, key: Tuple[str, Optional[int]], now: float) -> None:
+        if self._global is not None:
+            self._global.take(now)
+
+        window = self._window(key)
+        if window is not None:
+            window.take(now)
+
+    def _window(self, key: Tuple[str, Optional[int]]) -> Optional[_Window]:
+        window = self._windows.get(key)
+        if window is None:
+            limit = self.route_limits.get(key[0])
+            if limit is None:
+                return None
+
+            window = self._windows[key] = _Window(*limit)
+
+        return window
+
+
+# Shared by everything that talks to Discord, configured by the bot
+request_scheduler = RequestScheduler()
@@ -0,0 +1,83 @@
+import datetime
+import re
+from typing import List, NamedTuple, Optional
+
+import discord
+
+from .db import MessageRecord
+
+_FILTER = re.compile(r"^(from|after|before):(\S+)$")
+_MENTION = re.compile(r"^<@!?(\d+)>$")
+
+
+class SearchQuery(NamedTuple):
+    text: Optional[str]
+    author_id: Optional[int]
+    # Unix timestamps
+    after: Optional[float]
+    before: Optional[float]
+
+
+def parse_query(query: str) -> SearchQuery:
+    """Split a search into its text and filters.
+
+    ``from:<user>``, ``after:YYYY-MM-DD`` and ``before:YYYY-MM-DD``
+    are recognised anywhere in the query, everything else is text.
+
+    Raises
+    ------
+    ValueError
+        A filter's value could not be understood
+    """
+    words = []
+    filters = {}
+    for word in query.split():
+        match = _FILTER.match(word)
+        if match is None:
+            words.append(word)
+            continue
+
+        name, value = match.groups()
+        if name == "from":
+            mention = _MENTION.match(value)
+            filters["author_id"] = int(mention.group(1) if mention else value)
+        else:
+            date = datetime.datetime.strptime(value, "%Y-%m-%d").replace(
+                tzinfo=datetime.timezone.utc
+            )
+            filters[name] = date.timestamp()
+
+    return SearchQuery(
+        " ".join(words) or None,
+        filters.get("author_id"),
+        filters.get("after"),
+        filters.get("before"),
+    )
+
+
+def format_results(messages: List[MessageRecord], *, width: int = 80) -> str:
+    """One line per message, newest first, for sending in Discord.
+
+    Contents and names are escaped so a result can't ping anyone or
+    break the formatting of the lines around it.
+    """
+    lines = []
+    for message in messages:
+        created_at = datetime.datetime.fromtimestamp(
+            message.created_at, datetime.timezone.utc
+        )
+        content = " ".join(message.content.split())
+        if len(content) > width:
+            content = content[: width - 3] + "..."
+        content = _escape(content)
+
+        lines.append(
+            f"`#{message.ticket_id}` {created_at.strftime('%d/%m/%Y')} "
+            f"**{_escape(message.author_name)}**: {content}"
+        )
+
+    return "\n".join(lines)
+
+
+def _escape(text: str) -> str:
+    return discord.utils.escape_mentions(discord.utils.escape_markdown(text))
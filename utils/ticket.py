@@ -1,11 +1,26 @@
-import os
-from pathlib import Path
-from typing import Iterable
+import asyncio
+import logging
+from typing import Iterable, List, Optional, Set
 
 import discord
 
-from utils.db import Base
+from utils.db import Base, GuildConfig
+from .archive import ATTACHMENT_LIMIT
+from .metrics import metrics
 from .reaction_context import ReactionContext, Message
+from .request_scheduler import INTERACTIVE, request_scheduler
+from .transcript import TranscriptIndexer, write_stored_transcript, write_transcript
+
+log = logging.getLogger(__name__)
+
+# Ids of the channels being closed right now, a reaction, the close
+# command and inactivity may all try to close the same ticket at once
+_closing: Set[int] = set()
+
+
+async def _request(route: str, coro, major: int = None, priority: str = INTERACTIVE):
+    """Await a request to Discord once the scheduler allows, see RequestScheduler.request"""
+    return await request_scheduler.request(route, coro, major=major, priority=priority)
 
 
 # noinspection DuplicatedCode
@@ -20,44 +35,96 @@ class Ticket:
     with events that don't have an attached context.
     """
 
-    __slots__ = ("ctx", "db", "path")
+    __slots__ = ("ctx", "db")
 
     def __init__(self, ctx, db: Base):
         self.ctx = ctx
         self.db = db
-        self.path = str(Path(__file__).parents[1])
 
     async def close_ticket(self, reason=None, *, reaction_event=False):
+        channel = self.ctx.channel
+        # Checked and claimed before awaiting anything, so
+        # the transcript and log are only produced once
+        if channel.id in _closing:
+            log.debug("Channel %s is already being closed", channel.id)
+            return
+
+        _closing.add(channel.id)
+        try:
+            await self.__close_ticket(reason, reaction_event)
+        finally:
+            _closing.discard(channel.id)
+
+    async def __close_ticket(self, reason, reaction_event):
         ctx = self.ctx
         channel = self.ctx.channel
         if not await self.db.check_is_ticket(channel.id) and not reaction_event:
             return await ctx.send("I can only close channels that are actual tickets.")
 
         reason = reason or "No closing reason specified."
-        ticket_id = await self.db.get_ticket_id(channel.id)
-        messages = await channel.history(limit=None, oldest_first=True).flatten()
-        ticket_content = " ".join(
-            [
-                f"{message.created_at.strftime('%d/%m/%Y')} {message.author.name:<15} -> {message.content}\n"
-                for message in messages
-            ]
-        )
-        with open(
-            os.path.join(self.path, "tickets", f"{ticket_id}.txt"), "w", encoding="utf8"
-        ) as f:
-            f.write(
-                f"Here is the message log for ticket ID {ticket_id}\n----------\n\n"
-            )
-            f.write(ticket_content)
+        config = await self.db.get_config(channel.guild.id)
+        ticket = await self.db.get_ticket(channel.id)
+        ticket_id = ticket.ticket_id if ticket else None
+        author_id = ticket.author_id if ticket else None
 
-        file_object = discord.File(f"tickets/{ticket_id}.txt")
-        await self.__send_log(
+        bot = self.ctx.bot
+        # Compressed into the archive as it is read, the log
+        # attachment is then built from memory rather than disk
+        with metrics.timer("transcript_seconds"):
+            await bot.message_capture.flush()
+            if bot.reconcile_transcripts:
+                async with TranscriptIndexer(self.db, ticket_id) as indexer:
+                    async for message in channel.history(limit=None, oldest_first=True):
+                        await indexer.add(message)
+
+            # Kept for the HTML transcript, rendered in another process,
+            # left empty if the ticket is too large for it to be attached
+            records = [] if bot.transcript_renderer.enabled else None
+            async with bot.transcript_archive.writer(
+                channel.guild.id, ticket_id, channel.id, author_id
+            ) as writer:
+                # Nothing is captured if the store doesn't keep messages,
+                # and the capture is only whole if it starts with the
+                # welcome message, the history was just read otherwise
+                if not await write_stored_transcript(
+                    self.db,
+                    writer,
+                    ticket_id,
+                    channel.id,
+                    records=records,
+                    first_message_id=(
+                        ticket.reaction_message_id
+                        if ticket and not bot.reconcile_transcripts
+                        else None
+                    ),
+                ):
+                    async with TranscriptIndexer(self.db, ticket_id) as indexer:
+                        await write_transcript(
+                            channel, writer, ticket_id, indexer=indexer, records=records
+                        )
+
+        text = writer.to_file(f"{ticket_id}.txt")
+        files = [text]
+        if records:
+            page = await bot.transcript_renderer.render(channel, ticket_id, records)
+            if page is not None and len(page) + writer.attachment_size > ATTACHMENT_LIMIT:
+                # Or the whole log would be refused
+                log.warning("HTML transcript for ticket %s is too large to upload", ticket_id)
+            elif page is not None:
+                files.append(bot.transcript_renderer.to_file(page, f"{ticket_id}.html"))
+
+        self.__send_log(
+            config,
             f"Closed Ticked: Id {ticket_id}",
             f"Close Reason: {reason}",
             0xF42069,
-            file=file_object,
+            files=files,
         )
-        await channel.delete()
+        # Forgotten first, so deleting the channel isn't
+        # then mistaken for a ticket deleted by hand
+        if ticket is not None:
+            await self.db.remove_ticket(channel.id)
+        await _request("delete_channel", channel.delete(), channel.id)
 
     async def create_ticket(self, subject=None, *, sudo_author=None):
         guild = self.ctx.guild
@@ -66,8 +133,14 @@ class Ticket:
 
         author = sudo_author or ctx.message.author
 
-        new_ticket_id = await self.db.get_next_ticket_id()
-        staff_role = guild.get_role(bot.staff_role_id)
+        config = await self.db.get_config(guild.id)
+        if config is None or not config.is_configured:
+            # Commands check this up front, reactions can't get this far
+            log.warning("Guild %s has not been configured, not creating a ticket", guild.id)
+            return
+
+        new_ticket_id = await self.db.get_next_ticket_id(guild.id)
+        staff_role = guild.get_role(config.staff_role_id)
 
         overwrites = {
             guild.default_role: discord.PermissionOverwrite(read_messages=False),
@@ -76,14 +149,18 @@ class Ticket:
             author: discord.PermissionOverwrite(read_messages=True),
         }
 
-        category = bot.get_channel(bot.category_id)
+        category = bot.get_channel(config.category_id)
         if not category:
-            await bot.fetch_channel(bot.category_id)
+            category = await _request(
+                "fetch_channel", bot.fetch_channel(config.category_id), config.category_id
+            )
 
-        channel = await guild.create_text_channel(
+        # Claimed from the pool if there is one, overflowing
+        # into further categories once this one is full
+        channel = await bot.ticket_channels.open(
+            category,
             name=f"Support Ticket #{new_ticket_id}",
             overwrites=overwrites,
-            category=category,
         )
 
         content = f"""
@@ -94,11 +171,21 @@ class Ticket:
         `Our team will be with you shortly.`
         """
         embed = discord.Embed(description=content, color=0x808080)
-        m = await channel.send(
-            f"{author.mention} | <@&{bot.staff_role_id}>", embed=embed
+        m = await _request(
+            "send_message",
+            channel.send(f"{author.mention} | <@&{config.staff_role_id}>", embed=embed),
+            channel.id,
         )
-        await m.add_reaction("🔒")
-
+        # Its on_message may arrive before the ticket is saved below
+        bot.message_capture.add(m, new_ticket_id)
+        bot.inactivity_scheduler.track(channel.id)
+
+        # Nothing below depends on anything else below,
+        # so there is no need to wait on each in turn
+        steps = [
+            _request("add_reaction", m.add_reaction("🔒"), channel.id),
+            self.db.create_ticket(guild.id, channel.id, new_ticket_id, m.id, author.id),
+        ]
         if subject:
             embed = discord.Embed(
                 title="Provided subject for ticket:",
@@ -106,15 +193,16 @@ class Ticket:
                 color=0x808080,
             )
             embed.set_author(name=author.name, icon_url=author.avatar_url)
-            await channel.send(embed=embed)
+            steps.append(_request("send_message", channel.send(embed=embed), channel.id))
 
-        await self.db.create_ticket(channel.id, new_ticket_id, m.id)
-        await self.__send_log(
+        self.__send_log(
+            config,
             f"Created ticket with ID {new_ticket_id}",
             f"Ticket Creator: {author.mention}(`{author.id}`)\nChannel: "
             f"{channel.mention}({channel.name})\nSubject: {subject}",
             0xB4DA55,
         )
+        await self.__gather(steps, f"creating ticket {new_ticket_id}")
 
     async def remove_user(self, user: discord.Member):
         channel = self.ctx.channel
@@ -123,7 +211,11 @@ class Ticket:
                 "This is not a ticket! Users can only be removed from a ticket channel."
             )
 
-        await channel.set_permissions(user, read_messages=False, send_messages=False)
+        await _request(
+            "set_permissions",
+            channel.set_permissions(user, read_messages=False, send_messages=False),
+            channel.id,
+        )
 
     async def add_user(self, user: discord.Member):
         channel = self.ctx.channel
@@ -132,40 +224,69 @@ class Ticket:
                 "This is not a ticket! Users can only be added to a ticket channel."
             )
 
-        await channel.set_permissions(user, read_messages=True, send_messages=True)
+        await _request(
+            "set_permissions",
+            channel.set_permissions(user, read_messages=True, send_messages=True),
+            channel.id,
+        )
 
     async def setup_new_ticket_message(self):
         bot = self.ctx.bot
-        channel = bot.get_channel(bot.new_ticket_channel_id)
+        guild = self.ctx.guild
+        config = await self.db.get_config(guild.id)
+        channel = bot.get_channel(config.new_ticket_channel_id)
 
         embed = discord.Embed(
             title="Our Services",
             description="To purchase a service or enquire about one you must react with a tick",
             color=0xB4DA55,
         )
-        m = await channel.send(embed=embed)
-        await m.add_reaction("✅")
+        m = await _request("send_message", channel.send(embed=embed), channel.id)
+        await _request("add_reaction", m.add_reaction("✅"), channel.id)
 
-        await self.db.save_new_ticket_message(m.id)
+        await self.db.save_new_ticket_message(guild.id, m.id)
 
-    async def __send_log(
+    def __send_log(
         self,
+        config: Optional[GuildConfig],
         title: str,
         description: str,
         color: hex = 0x808080,
         file: discord.File = None,
+        *,
+        files: List[discord.File] = None,
     ):
         bot = self.ctx.bot
         ctx = self.ctx
 
-        log_channel = bot.get_channel(bot.log_channel_id)
+        log_channel = bot.get_channel(config.log_channel_id) if config else None
+        if log_channel is None:
+            log.warning("No log channel for guild %s, dropping '%s'", ctx.guild.id, title)
+            return
 
         embed = discord.Embed(title=title, description=description, color=color)
         embed.set_author(name=ctx.author.name, icon_url=ctx.author.avatar_url)
-        await log_channel.send(embed=embed)
+        # Sent in the background, batched with any other logs
+        bot.log_dispatcher.submit(log_channel, embed, file, files=files)
 
-        if file:
-            await log_channel.send(file=file)
+    @staticmethod
+    async def __gather(coros, action: str) -> None:
+        """Run coroutines concurrently, letting them all finish.
+
+        Every failure is logged, then the first one is raised so the
+        caller still sees the operation fail.
+        """
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        for error in errors:
+            log.error(
+                "Step failed while %s",
+                action,
+                exc_info=(type(error), error, error.__traceback__),
+            )
+
+        if errors:
+            raise errors[0]
 
     @classmethod
     async def reaction_create_ticket(cls, bot, payload):
@@ -174,7 +295,7 @@ class Ticket:
 
         guild = bot.get_guild(payload.guild_id)
         channel = bot.get_channel(payload.channel_id)
-        member = payload.member or guild.get_member(payload.user_id)
+        member = await cls.resolve_member(guild, payload.user_id, payload.member)
         ctx = ReactionContext(
             guild=guild,
             bot=bot,
@@ -183,17 +304,22 @@ class Ticket:
             author=member,
         )
 
-        await Ticket(ctx, bot.ticket_db).create_ticket()
+        # Creation is queued so bursts of reactions are smoothed
+        # out, the reaction is removed straight away regardless
+        await bot.ticket_queue.submit(
+            guild.id, member.id, Ticket(ctx, bot.ticket_db).create_ticket
+        )
 
-        # Once we create the ticket, remove there reaction
-        message = await channel.fetch_message(payload.message_id)
-        await message.remove_reaction("✅", member)
+        message = channel.get_partial_message(payload.message_id)
+        await _request(
+            "remove_reaction", message.remove_reaction("✅", member), channel.id
+        )
 
     @classmethod
     async def reaction_close_ticket(cls, bot, payload):
         guild = bot.get_guild(payload.guild_id)
         channel = bot.get_channel(payload.channel_id)
-        member = payload.member or guild.get_member(payload.user_id)
+        member = await cls.resolve_member(guild, payload.user_id, payload.member)
         ctx = ReactionContext(
             guild=guild,
             bot=bot,
@@ -204,6 +330,49 @@ class Ticket:
 
         await Ticket(ctx, bot.ticket_db).close_ticket(reaction_event=True)
 
+    @classmethod
+    async def inactive_close_ticket(cls, bot, channel: discord.TextChannel, reason: str):
+        """Close a ticket on the bot's behalf, as nobody is using it"""
+        guild = channel.guild
+        ctx = ReactionContext(
+            guild=guild,
+            bot=bot,
+            message=Message(author=guild.me),
+            channel=channel,
+            author=guild.me,
+        )
+
+        await Ticket(ctx, bot.ticket_db).close_ticket(reason, reaction_event=True)
+
+    @staticmethod
+    async def resolve_member(
+        guild: discord.Guild, user_id: int, member: discord.Member = None
+    ) -> discord.Member:
+        """Find a member without relying on them being cached.
+
+        Parameters
+        ----------
+        guild: discord.Guild
+            The guild the member is in
+        user_id: int
+            The member's id
+        member: discord.Member
+            A member the event already provided, if any
+
+        Returns
+        -------
+        discord.Member
+        """
+        if member is not None:
+            return member
+
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member
+
+        # The member cache is usually empty, see Bot.intent_profile
+        return await _request("fetch_member", guild.fetch_member(user_id), guild.id)
+
     @staticmethod
     async def validate_reaction_event(bot, payload, emojis: Iterable[str]) -> bool:
         if payload.user_id == bot.user.id:
@@ -213,8 +382,12 @@ class Ticket:
         if reaction not in emojis:
             return False
 
+        config = await bot.ticket_db.get_config(payload.guild_id)
+        if config is None or not config.is_configured:
+            return False
+
         if (
-            not payload.channel_id == bot.new_ticket_channel_id
+            not payload.channel_id == config.new_ticket_channel_id
             and not await bot.ticket_db.check_is_ticket(payload.channel_id)
         ):
             return False
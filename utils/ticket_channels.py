@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import re
+from typing import Dict, List, Set
+
+import discord
+
+from .metrics import metrics
+from .request_scheduler import BACKGROUND, INTERACTIVE, request_scheduler
+
+log = logging.getLogger(__name__)
+
+# Discord's limit on channels in a single category
+CATEGORY_LIMIT = 50
+# Pooled channels are found again after a restart by their name
+POOL_CHANNEL_NAME = "pooled-ticket"
+
+
+class TicketChannels:
+    """Finds or makes the channel for each new ticket.
+
+    Tickets go in the guild's configured category until it is full,
+    then in overflow categories named after it, ``Tickets 2``,
+    ``Tickets 3`` and so on, which are made as they are needed.
+
+    With ``pool_size`` set, that many hidden channels are kept ready
+    per category. Opening a ticket then claims one, renaming it and
+    setting its permissions in a single edit instead of creating a
+    channel, and the pool is topped back up in the background.
+
+    Parameters
+    ----------
+    pool_size: int
+        How many channels to keep ready, 0 to disable the pool
+    category_limit: int
+        How many channels fit in a category
+    """
+
+    def __init__(self, *, pool_size: int = 0, category_limit: int = CATEGORY_LIMIT):
+        self.pool_size = pool_size
+        self.category_limit = category_limit
+
+        # category_id -> channels ready to be claimed, oldest first
+        self._pools: Dict[int, List[discord.TextChannel]] = {}
+        # category_id -> overflow categories made by us, as
+        # they only appear in the cache once Discord tells us
+        self._overflow: Dict[int, Dict[int, discord.CategoryChannel]] = {}
+        # category_id -> ids of channels made but not yet cached
+        self._created: Dict[int, Set[int]] = {}
+        # category_id -> channels being made in it right now
+        self._in_flight: Dict[int, int] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._refills: Dict[int, asyncio.Task] = {}
+
+    @property
+    def pooled(self) -> int:
+        """How many channels are ready to be claimed"""
+        return sum(len(pool) for pool in self._pools.values())
+
+    async def close(self) -> None:
+        for task in self._refills.values():
+            task.cancel()
+
+        await asyncio.gather(*self._refills.values(), return_exceptions=True)
+        self._refills.clear()
+
+    async def open(
+        self,
+        category: discord.CategoryChannel,
+        *,
+        name: str,
+        overwrites: Dict,
+    ) -> discord.TextChannel:
+        """A channel for a new ticket, in or overflowing from this category.
+
+        Parameters
+        ----------
+        category: discord.CategoryChannel
+            The guild's configured ticket category
+        name: str
+        overwrites: Dict
+            The ticket's permission overwrites
+
+        Returns
+        -------
+        discord.TextChannel
+        """
+        pool = self._pool(category)
+        while pool:
+            channel = pool.pop(0)
+            try:
+                await request_scheduler.request(
+                    "edit_channel",
+                    channel.edit(name=name, overwrites=overwrites),
+                    major=channel.id,
+                )
+            except discord.NotFound:
+                # Deleted by hand while it waited
+                continue
+
+            metrics.increment("ticket_channel_pool_total", result="hit")
+            self.refill(category)
+            return channel
+
+        if self.pool_size:
+            metrics.increment("ticket_channel_pool_total", result="miss")
+            self.refill(category)
+
+        return await self._create(category, name, overwrites, INTERACTIVE)
+
+    def refill(self, category: discord.CategoryChannel) -> None:
+        """Top the category's pool back up in the background."""
+        if not self.pool_size:
+            return
+
+        task = self._refills.get(category.id)
+        if task is not None and not task.done():
+            return
+
+        self._refills[category.id] = asyncio.get_running_loop().create_task(
+            self._refill(category)
+        )
+
+    async def fill(self, category: discord.CategoryChannel) -> None:
+        """Make channels until the category's pool is full."""
+        guild = category.guild
+        overwrites = {
+            guild.default_role: discord.PermissionOverwrite(read_messages=False),
+            guild.me: discord.PermissionOverwrite(read_messages=True),
+        }
+        pool = self._pool(category)
+        while len(pool) < self.pool_size:
+            # Nobody is waiting on these, tickets being opened go first
+            pool.append(
+                await self._create(category, POOL_CHANNEL_NAME, overwrites, BACKGROUND)
+            )
+
+    async def _refill(self, category: discord.CategoryChannel) -> None:
+        try:
+            await self.fill(category)
+        except Exception:
+            log.exception("Failed to refill the channel pool for %s", category.id)
+
+    async def _create(
+        self,
+        category: discord.CategoryChannel,
+        name: str,
+        overwrites: Dict,
+        priority: str,
+    ) -> discord.TextChannel:
+        target = await self._reserve(category, priority)
+        try:
+            channel = await request_scheduler.request(
+                "create_text_channel",
+                category.guild.create_text_channel(
+                    name=name, overwrites=overwrites, category=target
+                ),
+                major=category.guild.id,
+                priority=priority,
+            )
+        finally:
+            self._in_flight[target.id] -= 1
+
+        self._created.setdefault(target.id, set()).add(channel.id)
+        return channel
+
+    async def _reserve(
+        self, category: discord.CategoryChannel, priority: str
+    ) -> discord.CategoryChannel:
+        """Pick a category with room for one more channel, and hold that room."""
+        # Per category, so two tickets can't both take its last space
+        lock = self._locks.setdefault(category.id, asyncio.Lock())
+        async with lock:
+            for target in self._categories(category):
+                if self._count(target) < self.category_limit:
+                    break
+            else:
+                target = await self._add_overflow(category, priority)
+
+            self._in_flight[target.id] = self._in_flight.get(target.id, 0) + 1
+            return target
+
+    async def _add_overflow(
+        self, category: discord.CategoryChannel, priority: str
+    ) -> discord.CategoryChannel:
+        pattern = _overflow_pattern(category)
+        numbers = [
+            int(pattern.fullmatch(overflow.name).group(1))
+            for overflow in self._categories(category)[1:]
+        ]
+        # One past the highest, as any below it may have been deleted
+        number = max(numbers, default=1) + 1
+        overflow = await request_scheduler.request(
+            "create_category",
+            category.guild.create_category(
+                f"{category.name} {number}", overwrites=category.overwrites
+            ),
+            major=category.guild.id,
+            priority=priority,
+        )
+
+        log.info("Category %s is full, overflowing into %s", category.name, overflow.name)
+        self._overflow.setdefault(category.id, {})[overflow.id] = overflow
+        return overflow
+
+    def _categories(self, category: discord.CategoryChannel) -> List[discord.CategoryChannel]:
+        """The category followed by its overflow categories, in order."""
+        pattern = _overflow_pattern(category)
+        overflow = dict(self._overflow.get(category.id, {}))
+        for candidate in category.guild.categories:
+            if pattern.fullmatch(candidate.name):
+                overflow[candidate.id] = candidate
+
+        return [category] + sorted(
+            overflow.values(), key=lambda c: int(pattern.fullmatch(c.name).group(1))
+        )
+
+    def _count(self, category: discord.CategoryChannel) -> int:
+        cached = {channel.id for channel in category.channels}
+        created = self._created.get(category.id)
+        if created:
+            # Once cached they are counted there instead
+            created -= cached
+
+        return len(cached) + len(created or ()) + self._in_flight.get(category.id, 0)
+
+    def _pool(self, category: discord.CategoryChannel) -> List[discord.TextChannel]:
+        pool = self._pools.get(category.id)
+        if pool is None:
+            # Channels pooled before a restart are still there
+            pool = self._pools[category.id] = [
+                channel
+                for target in self._categories(category)
+                for channel in target.text_channels
+                if channel.name == POOL_CHANNEL_NAME
+            ]
+
+        return pool
+
+
+def _overflow_pattern(category: discord.CategoryChannel) -> re.Pattern:
+    """Matches the names of the category's overflow categories, e.g. ``Tickets 2``"""
+    return re.compile(re.escape(category.name) + r" (\d+)")
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from utils.db import Base
+
+log = logging.getLogger(__name__)
+
+
+class TicketQueue:
+    """A bounded work queue for creating tickets.
+
+    Bursts of ticket creation, for example everyone reacting to
+    the setup message at once, are worked through by a fixed
+    number of workers instead of all hitting Discord together.
+
+    A user can only have one creation waiting at a time in each
+    guild, so double clicks don't result in two tickets.
+
+    Parameters
+    ----------
+    db: Base
+        Used to check whether a user already has a ticket open
+    workers: int
+        How many tickets may be created at the same time
+    max_size: int
+        How many creations may be waiting before new ones are rejected
+    one_ticket_per_user: bool
+        Reject users who already have a ticket open
+    """
+
+    def __init__(
+        self,
+        db: Base,
+        *,
+        workers: int = 2,
+        max_size: int = 50,
+        one_ticket_per_user: bool = False,
+    ):
+        self.db = db
+        self.workers = workers
+        self.max_size = max_size
+        self.one_ticket_per_user = one_ticket_per_user
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        # (guild_id, user_id)
+        self._pending: Set[Tuple[int, int]] = set()
+
+        self.stats: Dict[str, int] = {
+            "submitted": 0,
+            "deduplicated": 0,
+            "already_open": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0,
+            "max_depth": 0,
+        }
+
+    @property
+    def depth(self) -> int:
+        """How many creations are waiting for a worker"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    @property
+    def in_flight(self) -> int:
+        """How many creations are waiting or running"""
+        return len(self._pending)
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"ticket-queue-{i}")
+            for i in range(self.workers)
+        ]
+
+    async def close(self) -> None:
+        """Stop the workers, anything still queued is dropped."""
+        for task in self._tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        if self.depth:
+            log.warning("Dropped %s queued ticket creations on close", self.depth)
+
+    async def join(self) -> None:
+        """Wait until every queued creation has been worked through."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def submit(
+        self, guild_id: int, user_id: int, create: Callable[[], Awaitable[None]]
+    ) -> bool:
+        """Queue a ticket creation for a user.
+
+        Parameters
+        ----------
+        guild_id: int
+            The guild the ticket is in
+        user_id: int
+            The user the ticket is for
+        create: Callable[[], Awaitable[None]]
+            Called by a worker to create the ticket
+
+        Returns
+        -------
+        bool
+            Whether the creation was queued
+        """
+        self.start()
+
+        key = (guild_id, user_id)
+        if key in self._pending:
+            self.stats["deduplicated"] += 1
+            log.debug("User %s already has a ticket being created", user_id)
+            return False
+
+        if self.one_ticket_per_user and await self.db.get_user_ticket(
+            guild_id, user_id
+        ):
+            self.stats["already_open"] += 1
+            log.debug("User %s already has an open ticket", user_id)
+            return False
+
+        # Checked again as the lookup above may have let someone else in
+        if key in self._pending:
+            self.stats["deduplicated"] += 1
+            return False
+
+        try:
+            self._queue.put_nowait((key, create))
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            log.warning(
+                "Ticket queue is full (%s waiting), rejecting creation for %s",
+                self.depth,
+                user_id,
+            )
+            return False
+
+        self._pending.add(key)
+        self.stats["submitted"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.depth)
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            key, create = await self._queue.get()
+            try:
+                await create()
+            except Exception:
+                self.stats["failed"] += 1
+                log.exception("Failed to create a ticket for %s in %s", key[1], key[0])
+            else:
+                self.stats["completed"] += 1
+            finally:
+                self._pending.discard(key)
+                self._queue.task_done()
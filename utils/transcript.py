@@ -0,0 +1,258 @@
+import datetime
+import logging
+from typing import List, Optional, Tuple
+
+import discord
+
+from .archive import ATTACHMENT_LIMIT
+from .db import Base, MessageRecord
+
+log = logging.getLogger(__name__)
+
+
+class TranscriptIndexer:
+    """Saves transcript messages to the store, in batches, for searching.
+
+    Parameters
+    ----------
+    db: Base
+        The store to save messages to
+    ticket_id: int
+        The ticket the messages belong to
+    batch_size: int
+        How many messages to hold before saving them
+    """
+
+    def __init__(self, db: Base, ticket_id: int, *, batch_size: int = 500):
+        self.db = db
+        self.ticket_id = ticket_id
+        self.batch_size = batch_size
+
+        self._batch: List[MessageRecord] = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.flush()
+
+    async def add(self, message: discord.Message) -> None:
+        self._batch.append(message_record(message, self.ticket_id))
+        if len(self._batch) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._batch:
+            return
+
+        batch = self._batch
+        self._batch = []
+        await self.db.save_messages(batch)
+
+
+def message_record(message: discord.Message, ticket_id: int) -> MessageRecord:
+    """Everything a transcript keeps about a message.
+
+    Attachments and embeds are kept as extra lines of the
+    content, so they are searchable along with the text,
+    as well as on their own.
+    """
+    edited_at = getattr(message, "edited_at", None)
+    attachments = tuple((a.filename, a.size, a.url) for a in message.attachments)
+    embeds = tuple((e.title or "", e.description or "") for e in message.embeds)
+    return MessageRecord(
+        message.id,
+        ticket_id,
+        message.channel.id,
+        message.author.id,
+        message.author.name,
+        _timestamp(message.created_at),
+        message.content + extra_lines(attachments, embeds),
+        _timestamp(edited_at) if edited_at else None,
+        guild_id=message.guild.id if message.guild else None,
+        attachments=attachments,
+        embeds=embeds,
+    )
+
+
+def edited_message(data: dict) -> Tuple[str, tuple, tuple]:
+    """The (content, attachments, embeds) of an edited message, from a raw message edit's data."""
+    attachments = tuple(
+        (a.get("filename"), a.get("size"), a.get("url")) for a in data.get("attachments", [])
+    )
+    embeds = tuple(
+        (e.get("title") or "", e.get("description") or "") for e in data.get("embeds", [])
+    )
+    return data.get("content", "") + extra_lines(attachments, embeds), attachments, embeds
+
+
+def extra_lines(attachments, embeds) -> str:
+    """The lines attachments and embeds add to the end of a message's content"""
+    lines = []
+    for filename, size, url in attachments:
+        lines.append(f"\n[Attachment] {filename} ({size} bytes) {url}")
+
+    for title, description in embeds:
+        lines.append(f"\n[Embed] {title or ''} {description or ''}".rstrip())
+
+    return "".join(lines)
+
+
+def format_record(record: MessageRecord) -> str:
+    """Formats a stored message as transcript lines.
+
+    Parameters
+    ----------
+    record: MessageRecord
+        The message to format
+
+    Returns
+    -------
+    str
+        One or more newline terminated lines
+    """
+    created_at = datetime.datetime.fromtimestamp(
+        record.created_at, datetime.timezone.utc
+    )
+    first, *rest = record.content.split("\n")
+    if record.deleted:
+        first += " [deleted]"
+    elif record.edited_at:
+        first += " [edited]"
+
+    lines = [f"{created_at.strftime('%d/%m/%Y')} {record.author_name:<15} -> {first}\n"]
+    lines.extend(f"    {line}\n" for line in rest)
+    return "".join(lines)
+
+
+def _timestamp(value: datetime.datetime) -> float:
+    if value.tzinfo is None:
+        # discord.py 1.7 hands out naive datetimes in UTC
+        value = value.replace(tzinfo=datetime.timezone.utc)
+
+    return value.timestamp()
+
+
+def _collect(
+    records: Optional[List[MessageRecord]], record: MessageRecord, size: int, ticket_id: int
+) -> Optional[List[MessageRecord]]:
+    """Keeps a record for the HTML transcript, while the text so far (in
+    characters, roughly its size) is small enough for one to be attached."""
+    if records is None:
+        return None
+
+    if size > ATTACHMENT_LIMIT:
+        log.debug("Ticket %s is too large for an HTML transcript", ticket_id)
+        records.clear()
+        return None
+
+    records.append(record)
+    return records
+
+
+def _header(ticket_id: int) -> str:
+    return f"Here is the message log for ticket ID {ticket_id}\n----------\n\n"
+
+
+async def write_stored_transcript(
+    db: Base,
+    writer,
+    ticket_id: int,
+    channel_id: int,
+    *,
+    records: List[MessageRecord] = None,
+    first_message_id: int = None,
+) -> int:
+    """Writes a transcript from the messages captured in the store.
+
+    Nothing is written if no messages were captured, or if they don't
+    start with ``first_message_id``, so the caller can fall back to
+    ``write_transcript``.
+
+    Parameters
+    ----------
+    db: Base
+        The store the messages were captured in
+    writer
+        Anything with an async ``write(line)``
+    ticket_id: int
+        The id of the ticket, used in the header
+    channel_id: int
+        The ticket's channel, which its messages are stored by
+    records: List[MessageRecord]
+        If given, every message written is also appended to it, until
+        the transcript grows past ``ATTACHMENT_LIMIT``. It is emptied
+        then, as the HTML transcript would be too large to attach.
+    first_message_id: int
+        If given, the message the capture must start with to be
+        complete, such as the ticket's welcome message
+
+    Returns
+    -------
+    int
+        How many messages were written
+    """
+    count = size = 0
+    async for record in db.iter_messages(channel_id):
+        if not count:
+            if first_message_id is not None and record.message_id != first_message_id:
+                # Captured since a restart, or the capture started late
+                log.debug("Stored messages for ticket %s are incomplete", ticket_id)
+                return 0
+            await writer.write(_header(ticket_id))
+
+        line = format_record(record)
+        await writer.write(line)
+        size += len(line)
+        records = _collect(records, record, size, ticket_id)
+        count += 1
+
+    log.debug("Wrote %s stored messages for ticket %s", count, ticket_id)
+    return count
+
+
+async def write_transcript(
+    channel: discord.TextChannel,
+    writer,
+    ticket_id: int,
+    *,
+    indexer: TranscriptIndexer = None,
+    records: List[MessageRecord] = None,
+) -> int:
+    """Streams a channel's entire history into a transcript.
+
+    Parameters
+    ----------
+    channel: discord.TextChannel
+        The ticket channel to read
+    writer
+        Anything with an async ``write(line)``, such as an
+        ArchiveWriter
+    ticket_id: int
+        The id of the ticket, used in the header
+    indexer: TranscriptIndexer
+        If given, every message is also saved for searching
+    records: List[MessageRecord]
+        If given, every message written is also appended to it, until
+        the transcript grows past ``ATTACHMENT_LIMIT``. It is emptied
+        then, as the HTML transcript would be too large to attach.
+
+    Returns
+    -------
+    int
+        How many messages were written
+    """
+    count = size = 0
+    await writer.write(_header(ticket_id))
+    async for message in channel.history(limit=None, oldest_first=True):
+        record = message_record(message, ticket_id)
+        line = format_record(record)
+        await writer.write(line)
+        size += len(line)
+        if indexer is not None:
+            await indexer.add(message)
+        records = _collect(records, record, size, ticket_id)
+        count += 1
+
+    log.debug("Wrote %s messages for ticket %s", count, ticket_id)
+    return count